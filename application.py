@@ -1,42 +1,103 @@
+from datetime import timedelta
 from functools import wraps
 from flask import Flask, render_template, flash
 from flask import request, redirect, jsonify, url_for, make_response
+from flask import Response, stream_with_context, abort
 from flask import session as login_session
-from sqlalchemy import create_engine, asc
+from sqlalchemy import asc
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.pool import SingletonThreadPool
-from database_setup import Base, Item, Category, User
+from database_setup import Base, Item, Category, User, CatalogState, engine
+from database_setup import envSetting, parsePrice
+from queries import itemDetailQuery, itemPage, itemCount, cheapestItemPage
+from queries import adjustItemCounts, catalogRevision, recordChange
+from queries import changesSince, deleteCategoryItems, pageSize
+from queries import DEFAULT_CHANGE_BATCH, MAX_CHANGE_BATCH
+from batch import MAX_BATCH_SIZE, applyItemBatch
+from cache import createPageCache
+from search import searchItems
+from serializers import categoryDict, categorySelect, dumps, fetchBatches
+from serializers import itemDict, itemSelect, jsonResponse
+from sessions import createSessionInterface
+from snapshots import createSnapshotCache
+from instrumentation import instrumentApp
+from templating import createBytecodeCache, createFragmentCache
+from oauth import LoginError, LoginQueue, ProviderRegistry
+import os
 import random
 import string
 from pprint import pprint
 
-from oauth2client.client import flow_from_clientsecrets, FlowExchangeError
-import httplib2
 import json
-import requests
 
 
 app = Flask(__name__)
 
+# Templates are compiled once into JINJA_CACHE_DIR (set it empty to turn
+# this off), and {% cache %} fragments are kept rendered, see templating.py
+app.jinja_options = dict(
+    Flask.jinja_options, extensions=Flask.jinja_options['extensions'] + [
+        'templating.FragmentCacheExtension'])
+if os.environ.get('JINJA_CACHE_DIR', 'jinja_cache'):
+    app.jinja_options['bytecode_cache'] = createBytecodeCache(
+        os.environ.get('JINJA_CACHE_DIR', 'jinja_cache'))
+app.jinja_env.fragment_cache = createFragmentCache()
+
 
-CLIENT_ID = json.loads(
-    open('client_secrets.json', 'r').read())['web']['client_id']
 APPLICATION_NAME = "Item Catalog"
 
+# Google and Facebook login, see oauth.py. The client secrets are read
+# again on SIGHUP and, with OAUTH_RELOAD_INTERVAL set, when they change.
+providers = ProviderRegistry(logger=app.logger)
+providers.reloadOnSignal()
+if envSetting('OAUTH_RELOAD_INTERVAL', 0):
+    providers.watch(envSetting('OAUTH_RELOAD_INTERVAL', 0))
+
+# Logins run off the request workers when LOGIN_WORKERS is set
+loginQueue = None
+if envSetting('LOGIN_WORKERS', 0):
+    loginQueue = LoginQueue(envSetting('LOGIN_WORKERS', 0))
+
 
 # Connect to Database and create database session
-engine = create_engine('sqlite:///itemcatalog.db',
-                       poolclass=SingletonThreadPool)
 Base.metadata.bind = engine
 
 session = scoped_session(sessionmaker(bind=engine))
 
+# Login sessions are kept in the database and the session cookie only
+# holds their id, see sessions.py
+sessionInterface = createSessionInterface(engine)
+if sessionInterface is not None:
+    app.session_interface = sessionInterface
+
+# Rendered pages served to visitors who are not logged in
+pageCache = createPageCache()
+
+# Users and categories shown on most pages, invalidated through the page
+# cache so that all app processes sharing it see writes
+snapshots = createSnapshotCache(pageCache)
+
+# Request timings, SQL statement counts and /metrics, see instrumentation.py
+if envSetting('INSTRUMENTATION', 0):
+    instrumentApp(
+        app, engine,
+        n_plus_one_threshold=envSetting('N_PLUS_ONE_THRESHOLD', 5),
+        profile_rate=envSetting('PROFILE_SAMPLE_PERCENT', 0) / 100.0,
+        profile_threshold=envSetting('PROFILE_THRESHOLD_MS', 500) / 1000.0,
+        profile_dir=os.environ.get('PROFILE_DIR', 'profiles'),
+        metrics_access=os.environ.get('METRICS_ACCESS', 'local'))
+
 # Unauthorized alert
 ALERT_UNAUTHORIZED = ("<script>function myFunction() {"
                       "alert('You are not authorized!')}"
                       "</script><body onload='myFunction()'>")
 
 
+@app.teardown_appcontext
+def removeSession(exception=None):
+    """Return the request's database connection to the pool"""
+    session.remove()
+
+
 def login_required(f):
     """Login required decorator."""
     @wraps(f)
@@ -47,6 +108,86 @@ def login_required(f):
     return decorated_function
 
 
+def cached_for_anonymous(*tags):
+    """Page cache decorator for visitors who are not logged in.
+
+    Args:
+        tags (str): The catalog data the page shows, formatted with the
+                    view arguments, e.g. 'category:{category_id}'.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if (request.method != 'GET' or 'username' in login_session or
+                    '_flashes' in login_session):
+                return f(*args, **kwargs)
+            key = 'anonymous:' + request.full_path
+            pageTags = [tag.format(**kwargs) for tag in tags]
+            page = pageCache.get(key, pageTags)
+            if page is None:
+                versions = pageCache.tagVersions(pageTags)
+                page = f(*args, **kwargs)
+                if isinstance(page, type(u'')):
+                    pageCache.set(key, versions, page)
+            return page
+        return decorated_function
+    return decorator
+
+
+def wholeSeconds(moment):
+    """Round a datetime up to the whole second.
+
+    HTTP dates have no fractions of a second, and a resource changed at
+    10:00:00.5 was modified since 10:00:00.
+    """
+    if moment.microsecond:
+        moment += timedelta(seconds=1)
+    return moment.replace(microsecond=0)
+
+
+def isNotModified(etag, last_modified=None):
+    """Check whether the client's cached copy of a resource is current.
+
+    The ETag decides when the client sent If-None-Match; If-Modified-Since
+    is only honoured without it.
+
+    Args:
+        etag          (str): The strong ETag of the current resource.
+        last_modified (datetime): When the resource last changed, in UTC.
+
+    Returns:
+        bool: True when a 304 Not Modified response can be sent.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified:
+        return (wholeSeconds(last_modified) <=
+                request.if_modified_since.replace(tzinfo=None))
+    return False
+
+
+def conditionalResponse(response, etag, last_modified=None):
+    """Add validators to a response, or replace it by 304 Not Modified.
+
+    Args:
+        response      (Response or callable): The response, or a function
+                      building it, called only if the client needs it.
+        etag          (str): The strong ETag of the resource.
+        last_modified (datetime): When the resource last changed, in UTC.
+
+    Returns:
+        Response: The response to send.
+    """
+    if isNotModified(etag, last_modified):
+        response = Response(status=304)
+    elif not isinstance(response, Response):
+        response = response()
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = wholeSeconds(last_modified)
+    return response
+
+
 # --------------------------------------
 # JSON APIs to show Catalog information
 # --------------------------------------
@@ -54,8 +195,103 @@ def login_required(f):
 @app.route('/api/v1/catalog/json')
 def showCatalogJSON():
     """Return JSON of all items in catalog"""
-    items = session.query(Item).order_by(Item.id.desc())
-    return jsonify(Items=[i.serialize for i in items])
+    revision, updated_at = catalogRevision(session)
+
+    def build():
+        items = session.execute(itemSelect(newest_first=True))
+        return jsonResponse({'Items': [itemDict(row) for row in items]})
+    return conditionalResponse(build, 'catalog-%d' % revision, updated_at)
+
+
+@app.route('/api/v2/catalog/JSON')
+@app.route('/api/v2/catalog/json')
+def streamCatalogJSON():
+    """Stream the items in catalog as JSON, oldest first
+
+    The optional `after_id` and `limit` query string arguments select a
+    range of items. The response ends with `next_after_id`, the cursor for
+    the next range, when `limit` cut the stream short. With `format=ndjson`
+    the items are streamed one JSON object per line instead.
+    """
+    revision, updated_at = catalogRevision(session)
+    etag = 'catalog-%d' % revision
+    if isNotModified(etag, updated_at):
+        return conditionalResponse(None, etag, updated_at)
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        limit = None
+    items = itemSelect(request.args.get('after_id', type=int), limit)
+
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            for rows in fetchBatches(session, items):
+                yield ''.join(dumps(itemDict(row)) + '\n' for row in rows)
+        return conditionalResponse(
+            Response(stream_with_context(generate()),
+                     mimetype='application/x-ndjson'),
+            etag, updated_at)
+
+    def generate():
+        yield '{"Items": ['
+        separator = ''
+        count = 0
+        last_id = None
+        for rows in fetchBatches(session, items):
+            # Encode the batch as one array and drop its brackets
+            yield separator + dumps([itemDict(row) for row in rows])[1:-1]
+            separator = ', '
+            count += len(rows)
+            last_id = rows[-1][0]
+        next_after_id = last_id if limit and count == limit else None
+        yield '], "next_after_id": %s}' % json.dumps(next_after_id)
+    return conditionalResponse(
+        Response(stream_with_context(generate()),
+                 mimetype='application/json'),
+        etag, updated_at)
+
+
+@app.route('/api/v2/changes')
+def changesJSON():
+    """Return the item and category changes after a catalog revision
+
+    Mirror clients pass the last revision they applied as `since` (0 for a
+    full log) and get at most `limit` changes, oldest first. Creates and
+    updates carry the current data of the row, or null if it was deleted
+    since; clients should apply both as upserts. A category delete implies
+    the delete of all its items. When the log was truncated past `since`
+    the response is 410 Gone and the client must reload the catalog.
+    """
+    since = request.args.get('since', 0, type=int)
+    limit = pageSize(request.args.get('limit', type=int),
+                     default=DEFAULT_CHANGE_BATCH, maximum=MAX_CHANGE_BATCH)
+    state = session.query(CatalogState).filter_by(id=1).one()
+    if since < state.compacted_revision:
+        response = jsonify(
+            error='Change log truncated, reload the catalog.',
+            revision=state.revision)
+        response.status_code = 410
+        return response
+
+    changes = changesSince(session, since, limit)
+    rows = {}
+    for entity, model in (('item', Item), ('category', Category)):
+        ids = [c.entity_id for c in changes
+               if c.entity == entity and c.action != 'delete']
+        if ids:
+            for row in session.query(model).filter(model.id.in_(ids)):
+                rows[(entity, row.id)] = row.serialize
+
+    return jsonify(
+        Changes=[{
+            'revision': c.revision,
+            'entity': c.entity,
+            'id': c.entity_id,
+            'action': c.action,
+            'data': rows.get((c.entity, c.entity_id)),
+        } for c in changes],
+        next_since=changes[-1].revision if changes else since,
+        more=len(changes) == limit,
+        revision=state.revision)
 
 
 @app.route(
@@ -64,17 +300,130 @@ def showCatalogJSON():
     '/api/v1/categories/<int:category_id>/item/<int:catalog_item_id>/json')
 def ItemJSON(category_id, catalog_item_id):
     """Return JSON of selected item in catalog"""
-    Catalog_Item = session.query(
-        Item).filter_by(id=catalog_item_id).first()
-    return jsonify(Catalog_Item=Catalog_Item.serialize)
+    revision = session.query(
+        Item.revision).filter_by(id=catalog_item_id).scalar()
+    if revision is None:
+        abort(404)
+
+    def build():
+        Catalog_Item = session.query(
+            Item).filter_by(id=catalog_item_id).first()
+        return jsonify(Catalog_Item=Catalog_Item.serialize)
+    return conditionalResponse(
+        build, 'item-%d-%d' % (catalog_item_id, revision))
 
 
 @app.route('/api/v1/categories/JSON')
 @app.route('/api/v1/categories/json')
 def categoriesJSON():
     """Return JSON with all categories in catalog"""
-    categories = session.query(Category).all()
-    return jsonify(Categories=[r.serialize for r in categories])
+    revision, updated_at = catalogRevision(session)
+
+    def build():
+        categories = session.execute(categorySelect())
+        return jsonResponse(
+            {'Categories': [categoryDict(row) for row in categories]})
+    return conditionalResponse(
+        build, 'categories-%d' % revision, updated_at)
+
+
+def itemListPage(category_id=None):
+    """Return the page of items selected by the current request
+
+    `sort=price` lists the cheapest items first, otherwise the newest come
+    first. `min_price` and `max_price` (in dollars) filter by price, and
+    `limit` sets the page size. Newest first pages are selected with
+    `before_id`, cheapest first pages with `after_price` (in cents) and
+    `after_id`.
+
+    Args:
+        category_id (int): Only list items of this category (optional).
+
+    Returns:
+        ItemPage: The page of items.
+    """
+    try:
+        min_price = parsePrice(request.args.get('min_price'))
+        max_price = parsePrice(request.args.get('max_price'))
+    except ValueError:
+        abort(400)
+    limit = request.args.get('limit', type=int)
+    if request.args.get('sort') == 'price':
+        after = (request.args.get('after_price', type=int),
+                 request.args.get('after_id', type=int))
+        return cheapestItemPage(
+            session, category_id, after if None not in after else None,
+            limit, min_price, max_price)
+    return itemPage(session, category_id,
+                    request.args.get('before_id', type=int), limit,
+                    min_price, max_price)
+
+
+@app.route('/api/v2/items')
+def itemsJSON():
+    """Return JSON of a page of items
+
+    Takes the arguments of itemListPage, plus `category_id` to list the
+    items of one category. `next` and `prev` hold the query string
+    arguments of the next and previous pages (null if there is none).
+    """
+    revision, updated_at = catalogRevision(session)
+
+    def build():
+        page = itemListPage(request.args.get('category_id', type=int))
+        return jsonify(Items=[i.serialize for i in page.items],
+                       next=page.next_args, prev=page.prev_args)
+    return conditionalResponse(build, 'items-%d' % revision, updated_at)
+
+
+# --------------------------------------
+# Search
+# --------------------------------------
+def searchArguments():
+    """Read the search query string arguments of the current request
+
+    Returns:
+        tuple: (query, category_id, page number, page size)
+    """
+    return (request.args.get('q', ''),
+            request.args.get('category_id', type=int),
+            max(1, request.args.get('page', 1, type=int)),
+            pageSize(request.args.get('limit', type=int)))
+
+
+@app.route('/search')
+def searchCatalog():
+    """Return the items matching the `q` query string argument
+
+    The search can be narrowed to a category with `category_id`; results
+    are paged with `page` and `limit`.
+    """
+    query, category_id, page, limit = searchArguments()
+    items = searchItems(
+        session, query, category_id, limit + 1, (page - 1) * limit)
+    categories = snapshots.categories(session)
+    return render_template(
+        'search.html',
+        categories=categories,
+        items=items[:limit],
+        quantity=len(items[:limit]),
+        query=query,
+        category_id=category_id,
+        search_page=page,
+        more=len(items) > limit)
+
+
+@app.route('/api/v2/search')
+def searchJSON():
+    """Return JSON of the items matching the `q` query string argument
+
+    Takes the same arguments as the search page.
+    """
+    query, category_id, page, limit = searchArguments()
+    items = searchItems(
+        session, query, category_id, limit + 1, (page - 1) * limit)
+    return jsonify(Items=[i.serialize for i in items[:limit]],
+                   page=page, more=len(items) > limit)
 
 
 # --------------------------------------
@@ -83,19 +432,26 @@ def categoriesJSON():
 # READ - home page: shows categories and recently added items
 @app.route('/')
 @app.route('/categories/')
+@cached_for_anonymous('categories', 'items')
 def showCatalog():
-    """Return catalog page with all categories and recently added items"""
-    categories = session.query(Category).all()
-    items = session.query(Item).order_by(Item.id.desc())
-    quantity = items.count()
+    """Return catalog page with all categories and recently added items
+
+    Items are sorted, filtered and paged with the query string arguments
+    of itemListPage.
+    """
+    categories = snapshots.categories(session)
+    page = itemListPage()
+    quantity = itemCount(session)
     if 'username' not in login_session:
         return render_template(
             'public_catalog.html',
-            categories=categories, items=items, quantity=quantity)
+            categories=categories, items=page.items, page=page,
+            quantity=quantity)
     else:
         return render_template(
             'catalog.html',
-            categories=categories, items=items, quantity=quantity)
+            categories=categories, items=page.items, page=page,
+            quantity=quantity)
 
 
 # CREATE - New category
@@ -104,7 +460,8 @@ def showCatalog():
 def newCategory():
     """Allow user to create new category"""
     if request.method == 'POST':
-        print(login_session)
+        app.logger.debug('New category by user %s',
+                         login_session.get('user_id'))
         if 'user_id' not in login_session and 'email' in login_session:
             login_session['user_id'] = getUserId(login_session['email'])
         newCategory = Category(
@@ -114,7 +471,12 @@ def newCategory():
             flash("Category name is required.", "warning")
             return render_template('new_category.html')
         session.add(newCategory)
+        session.flush()
+        newCategory.revision = recordChange(
+            session, 'category', newCategory.id, 'create')
         session.commit()
+        snapshots.invalidateCategories()
+        pageCache.invalidate('categories')
         flash("New category created!", 'success')
         return redirect(url_for('showCatalog'))
     else:
@@ -133,8 +495,12 @@ def editCategory(category_id):
     if request.method == 'POST':
         if request.form['name']:
             editedCategory.name = request.form['name']
+            editedCategory.revision = recordChange(
+                session, 'category', category_id, 'update')
             session.add(editedCategory)
             session.commit()
+            snapshots.invalidateCategories()
+            pageCache.invalidate('categories', 'category:%d' % category_id)
             flash(
                 'Successfully edited category "%s".' % editedCategory.name,
                 'success')
@@ -158,9 +524,15 @@ def deleteCategory(category_id):
     if categoryToDelete.user_id != login_session['user_id']:
         return ALERT_UNAUTHORIZED
     if request.method == 'POST':
+        recordChange(session, 'category', category_id, 'delete')
+        adjustItemCounts(session, None, -categoryToDelete.item_count)
         session.delete(categoryToDelete)
         flash('%s Successfully Deleted' % categoryToDelete.name, 'success')
         session.commit()
+        snapshots.invalidateCategories()
+        pageCache.invalidate(
+            'categories', 'items', 'category:%d' % category_id,
+            'category-items:%d' % category_id)
         return redirect(
             url_for('showCatalog', category_id=category_id))
     else:
@@ -168,14 +540,46 @@ def deleteCategory(category_id):
             'delete_category.html', category=categoryToDelete)
 
 
+# DELETE all items in a category
+@app.route('/categories/<int:category_id>/items/delete/',
+           methods=['GET', 'POST'])
+@login_required
+def emptyCategory(category_id):
+    """Allow user to delete all items in a category they created"""
+    category = session.query(Category).filter_by(id=category_id).first()
+    if category is None:
+        abort(404)
+    if category.user_id != login_session['user_id']:
+        return ALERT_UNAUTHORIZED
+    if request.method == 'POST':
+        deleted = deleteCategoryItems(session, category_id)
+        session.commit()
+        snapshots.invalidateCategories()
+        pageCache.invalidate(
+            'categories', 'items', 'category:%d' % category_id,
+            'category-items:%d' % category_id)
+        flash('Deleted %d items from %s' % (deleted, category.name),
+              'success')
+        return redirect(
+            url_for('showCategoryItems', category_id=category_id))
+    else:
+        return render_template(
+            'delete_category_items.html', category=category)
+
+
 # --------------------------------------
 # CRUD for category items
 # --------------------------------------
 # READ - show category items
 @app.route('/categories/<int:category_id>/')
 @app.route('/categories/<int:category_id>/items/')
+@cached_for_anonymous('categories', 'category:{category_id}',
+                      'category-items:{category_id}')
 def showCategoryItems(category_id):
-    """Return all items in given category.
+    """Return a page of items in given category.
+
+    Items are sorted, filtered and paged with the query string arguments
+    of itemListPage.
 
     Args:
         category_id (int): The id of the category of the items.
@@ -183,24 +587,25 @@ def showCategoryItems(category_id):
     Returns:
         The rendered catalog template with all item data.
     """
-    category = session.query(Category).filter_by(id=category_id).first()
-    categories = session.query(Category).all()
+    category = snapshots.category(session, category_id)
+    if category is None:
+        abort(404)
+    categories = snapshots.categories(session)
     creator = getUserInfo(category.user_id)
-    items = session.query(
-        Item).filter_by(
-            category_id=category_id).order_by(Item.id.desc())
-    quantity = items.count()
+    page = itemListPage(category_id)
     return render_template(
         'catalog_menu.html',
         categories=categories,
         category=category,
-        items=items,
-        quantity=quantity,
+        items=page.items,
+        page=page,
+        quantity=category.item_count,
         creator=creator)
 
 
 # READ ITEM - shows specific information for a given item
 @app.route('/categories/<int:category_id>/item/<int:catalog_item_id>/')
+@cached_for_anonymous('category:{category_id}', 'item:{catalog_item_id}')
 def showItem(category_id, catalog_item_id):
     """Return a single catalog item
 
@@ -211,33 +616,67 @@ def showItem(category_id, catalog_item_id):
     Returns:
         The rendered catalog template.
     """
-    category = session.query(Category).filter_by(id=category_id).first()
-    item = session.query(
-        Item).filter_by(id=catalog_item_id).first()
+    category = snapshots.category(session, category_id)
+    item = itemDetailQuery(session, catalog_item_id).first()
+    if category is None or item is None:
+        abort(404)
     creator = getUserInfo(category.user_id)
     return render_template(
         'catalog_menu_item.html',
         category=category, item=item, creator=creator)
 
 
+def formCategoryId():
+    """Return the id of the category chosen in an item form.
+
+    Returns:
+        int: The id of an existing category, or None if the form holds
+             something else.
+    """
+    try:
+        category_id = int(request.form['category'])
+    except ValueError:
+        return None
+    if session.query(Category.id).filter_by(id=category_id).first():
+        return category_id
+    return None
+
+
 # CREATE NEW ITEM
 @app.route('/categories/item/new', methods=['GET', 'POST'])
 @login_required
 def newItem():
     """Handle new catalog item creation"""
-    categories = session.query(Category).all()
+    categories = snapshots.categories(session)
     if request.method == 'POST':
+        try:
+            price_cents = parsePrice(request.form['price'])
+        except ValueError:
+            flash("Price must be an amount in dollars.", "warning")
+            return render_template('new_item.html', categories=categories)
+        category_id = formCategoryId()
+        if category_id is None:
+            flash("Choose one of the categories.", "warning")
+            return render_template('new_item.html', categories=categories)
         addNewItem = Item(
             name=request.form['name'],
             description=request.form['description'],
-            price=request.form['price'],
-            category_id=request.form['category'],
+            price_cents=price_cents,
+            category_id=category_id,
             user_id=login_session['user_id'])
         if not addNewItem.name:
             flash("Item name is required.", "warning")
             return render_template('new_item.html', categories=categories)
         session.add(addNewItem)
+        session.flush()
+        addNewItem.revision = recordChange(
+            session, 'item', addNewItem.id, 'create')
+        adjustItemCounts(session, addNewItem.category_id, 1)
         session.commit()
+        snapshots.invalidateCategories()
+        pageCache.invalidate(
+            'categories', 'items',
+            'category-items:%d' % addNewItem.category_id)
         flash("New item created.", 'success')
         return redirect(url_for('showCatalog'))
     else:
@@ -261,20 +700,49 @@ def editItem(category_id, catalog_item_id):
     if editedItem.user_id != login_session['user_id']:
         return ALERT_UNAUTHORIZED
     if request.method == 'POST':
+        try:
+            price_cents = parsePrice(request.form['price'])
+        except ValueError:
+            flash("Price must be an amount in dollars.", "warning")
+            return render_template(
+                'edit_catalog_item.html',
+                categories=snapshots.categories(session),
+                item=editedItem)
+        category_id = None
+        if request.form['category']:
+            category_id = formCategoryId()
+            if category_id is None:
+                flash("Choose one of the categories.", "warning")
+                return render_template(
+                    'edit_catalog_item.html',
+                    categories=snapshots.categories(session),
+                    item=editedItem)
+        previous_category_id = editedItem.category_id
         if request.form['name']:
             editedItem.name = request.form['name']
         if request.form['description']:
             editedItem.description = request.form['description']
-        if request.form['price']:
-            editedItem.price = request.form['price']
-        if request.form['category']:
-            editedItem.category_id = int(request.form['category'])
+        if price_cents is not None:
+            editedItem.price_cents = price_cents
+        if category_id is not None:
+            editedItem.category_id = category_id
+        editedItem.revision = recordChange(
+            session, 'item', catalog_item_id, 'update')
+        if editedItem.category_id != previous_category_id:
+            adjustItemCounts(session, previous_category_id, -1, 0)
+            adjustItemCounts(session, editedItem.category_id, 1, 0)
         session.add(editedItem)
         session.commit()
+        if editedItem.category_id != previous_category_id:
+            snapshots.invalidateCategories()
+        pageCache.invalidate(
+            'categories', 'items', 'item:%d' % catalog_item_id,
+            'category-items:%d' % previous_category_id,
+            'category-items:%d' % editedItem.category_id)
         flash("Catalog item updated!", 'success')
         return redirect(url_for('showCatalog'))
     else:
-        categories = session.query(Category).all()
+        categories = snapshots.categories(session)
         return render_template(
             'edit_catalog_item.html',
             categories=categories,
@@ -298,8 +766,14 @@ def deleteItem(category_id, catalog_item_id):
     if itemToDelete.user_id != login_session['user_id']:
         return ALERT_UNAUTHORIZED
     if request.method == 'POST':
+        recordChange(session, 'item', catalog_item_id, 'delete')
+        adjustItemCounts(session, itemToDelete.category_id, -1)
         session.delete(itemToDelete)
         session.commit()
+        snapshots.invalidateCategories()
+        pageCache.invalidate(
+            'categories', 'items', 'item:%d' % catalog_item_id,
+            'category-items:%d' % itemToDelete.category_id)
         flash('Catalog Item Successfully Deleted', 'success')
         return redirect(url_for('showCatalog'))
     else:
@@ -307,6 +781,48 @@ def deleteItem(category_id, catalog_item_id):
             'delete_catalog_item.html', item=itemToDelete)
 
 
+# CREATE, UPDATE and DELETE items in batches
+@app.route('/api/v2/items:batch', methods=['POST'])
+def itemsBatchJSON():
+    """Apply a batch of item creates, updates and deletes
+
+    The request body is a JSON object with the list of `operations` (see
+    batch.py), at most MAX_BATCH_SIZE of them, and optionally `atomic`:
+    true to apply nothing if any operation is rejected. The valid
+    operations are applied in one transaction. The response has the
+    result of every operation, in order, and the catalog revision.
+    """
+    if 'user_id' not in login_session:
+        return jsonMessage('Login required.', 401)
+    batch = request.get_json(silent=True)
+    if not isinstance(batch, dict) or not isinstance(
+            batch.get('operations'), list):
+        return jsonMessage('Expected a JSON object with operations.', 400)
+    if len(batch['operations']) > MAX_BATCH_SIZE:
+        return jsonMessage(
+            'At most %d operations per batch.' % MAX_BATCH_SIZE, 413)
+    outcome = applyItemBatch(session, batch['operations'],
+                             login_session['user_id'],
+                             atomic=bool(batch.get('atomic')))
+    if outcome['applied']:
+        session.commit()
+        if outcome['counts_changed']:
+            snapshots.invalidateCategories()
+        pageCache.invalidate(
+            'categories', 'items',
+            *(['item:%d' % i for i in outcome['item_ids']] +
+              ['category-items:%d' % i for i in outcome['category_ids']]))
+    else:
+        session.rollback()
+    response = jsonify(Results=outcome['results'],
+                       applied=outcome['applied'],
+                       revision=catalogRevision(session)[0])
+    if batch.get('atomic') and any(
+            result['status'] >= 400 for result in outcome['results']):
+        response.status_code = 422
+    return response
+
+
 # --------------------------------------
 # Login Handling
 # --------------------------------------
@@ -317,55 +833,124 @@ def showLogin():
     """Show the login screen"""
     state = ''.join(
         random.choice(
-            string.ascii_uppercase + string.digits) for x in xrange(32))
+            string.ascii_uppercase + string.digits) for x in range(32))
     login_session['state'] = state
-    return render_template('login.html', STATE=state)
+    return render_template(
+        'login.html', STATE=state,
+        GOOGLE_CLIENT_ID=providers['google'].client_id,
+        FACEBOOK_APP_ID=providers['facebook'].app_id)
 
 
-@app.route('/fbconnect', methods=['POST'])
-def fbconnect():
-    """Handle Facebook OAuth login"""
-    if request.args.get('state') != login_session['state']:
-        response = make_response(json.dumps('Invalid state parameter.'), 401)
-        response.headers['Content-Type'] = 'application/json'
-        return response
-    access_token = request.data
-    print("access token received %s " % access_token)
-
-    app_id = json.loads(open('fb_client_secrets.json', 'r').read())[
-        'web']['app_id']
-    app_secret = json.loads(
-        open('fb_client_secrets.json', 'r').read())['web']['app_secret']
-    url = ('https://graph.facebook.com/oauth/access_token?grant_type='
-           'fb_exchange_token&client_id=%s&client_secret=%s&'
-           'fb_exchange_token=%s') % (app_id, app_secret, access_token)
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-
-    # Use token to get user info from API
-    userinfo_url = "https://graph.facebook.com/v3.1/me"
-    # strip expire tag from access token
-    token = result.split("&")[0]
-
-    url = ('https://graph.facebook.com/v3.1/me?fields=id'
-           '%2Cname%2Cemail%2Cpicture&access_token=') + access_token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-    data = json.loads(result)
-
-    login_session['provider'] = 'facebook'
-    login_session['username'] = data["name"]
-    login_session['email'] = data["email"]
-    login_session['facebook_id'] = data["id"]
+def jsonMessage(message, status):
+    """Return a JSON encoded message
+
+    Args:
+        message (str): The message.
+        status  (int): The HTTP status of the response.
+
+    Returns:
+        Response: The response.
+    """
+    response = make_response(json.dumps(message), status)
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+def startLogin(provider, credential):
+    """Log in with the code or token a provider gave the login page
+
+    With LOGIN_WORKERS set the login runs on the login queue and the
+    response is 202 Accepted with the URL to poll in its Location header.
+
+    Args:
+        provider   (str): 'google' or 'facebook'.
+        credential (str): The one-time code (Google) or access token
+                          (Facebook).
+
+    Returns:
+        Response: The response to the login request.
+    """
+    if request.args.get('state') != login_session.get('state'):
+        return jsonMessage('Invalid state parameter.', 401)
+    if loginQueue is None:
+        try:
+            profile = providers[provider].login(credential)
+        except LoginError as e:
+            return jsonMessage(e.message, e.status)
+        return finishLogin(profile)
+    job_id = loginQueue.submit(providers[provider].login, credential)
+    login_session['login_job'] = job_id
+    return loginPending(job_id)
+
+
+def loginPending(job_id):
+    """Return 202 Accepted for a login still running on the login queue
+
+    Args:
+        job_id (str): The id of the login.
+
+    Returns:
+        Response: The response, with the URL to poll as `status` and in
+                  the Location header.
+    """
+    status_url = url_for('loginStatus', job_id=job_id)
+    response = make_response(json.dumps({'status': status_url}), 202)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Location'] = status_url
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+@app.route('/login/status/<job_id>')
+def loginStatus(job_id):
+    """Poll a login running on the login queue"""
+    if loginQueue is None or login_session.get('login_job') != job_id:
+        abort(404)
+    try:
+        profile = loginQueue.result(job_id)
+    except KeyError:
+        abort(404)
+    except LoginError as e:
+        del login_session['login_job']
+        return jsonMessage(e.message, e.status)
+    if profile is None:
+        return loginPending(job_id)
+    del login_session['login_job']
+    return finishLogin(profile)
+
+
+def regenerateSession():
+    """Move the login_session to a new session id
+
+    Cookie sessions (SESSION_STORE=cookie) have no id; their cookie changes
+    with their content anyway.
+    """
+    if hasattr(login_session, 'regenerate'):
+        login_session.regenerate()
+
+
+def finishLogin(profile):
+    """Log in the user a provider vouched for, creating them if needed
+
+    Args:
+        profile (dict): The profile returned by the provider's login.
 
+    Returns:
+        Response: The welcome message shown by the login page.
+    """
+    if (profile['provider'] == 'google' and
+            login_session.get('access_token') is not None and
+            login_session.get('gplus_id') == profile['gplus_id']):
+        return jsonMessage('Current user is already connected.', 200)
+
+    # A new session id for the logged in user, so that an id planted in
+    # the browser before the login can't be used to ride on the login
+    regenerateSession()
     # The token must be stored in the login_session
     # in order to properly logout
-    login_session['access_token'] = access_token
-
-    # Get user picture
-    login_session['picture'] = data["picture"]["data"]["url"]
+    login_session.update(profile)
 
-    # see if user exists
+    # see if user exists, if it doesn't make a new one
     user_id = getUserId(login_session['email'])
     if not user_id:
         user_id = createUser(login_session)
@@ -374,27 +959,28 @@ def fbconnect():
     output = ''
     output += '<h1>Welcome, '
     output += login_session['username']
-
     output += '!</h1>'
     output += '<img src="'
-    output += login_session['picture']
+    output += login_session['picture'] or ''
     output += (' " style = "width: 300px; height: 300px;border-radius: 150px;'
                '-webkit-border-radius: 150px;-moz-border-radius: 150px;"> ')
-
-    flash("Now logged in as %s." % login_session['username'], 'success')
+    flash("You are now logged in as %s" % login_session['username'], 'success')
+    app.logger.info('User %s logged in with %s', user_id, profile['provider'])
     return output
 
 
+@app.route('/fbconnect', methods=['POST'])
+def fbconnect():
+    """Handle Facebook OAuth login"""
+    return startLogin('facebook', request.get_data().decode('utf-8'))
+
+
 @app.route('/fbdisconnect')
 def fbdisconnect():
     """Handle Facebook OAuth logout"""
-    facebook_id = login_session['facebook_id']
     # The access token must me included to successfully logout
-    access_token = login_session['access_token']
-    url = 'https://graph.facebook.com/%s/permissions?access_token=%s' % (
-        facebook_id, access_token)
-    h = httplib2.Http()
-    result = h.request(url, 'DELETE')[1]
+    providers['facebook'].revoke(login_session['facebook_id'],
+                                 login_session['access_token'])
     return "You have been logged out."
 
 
@@ -402,101 +988,8 @@ def fbdisconnect():
 @app.route('/gconnect', methods=['POST'])
 def gconnect():
     """Handle Google OAuth login"""
-    # Validate state token
-    if request.args.get('state') != login_session['state']:
-        response = make_response(json.dumps('Invalid state parameter.'), 401)
-        response.headers['Content-Type'] = 'application/json'
-        return response
     # Obtain authorization code, now compatible with Python3
-    request.get_data()
-    code = request.data.decode('utf-8')
-
-    try:
-        # Upgrade the authorization code into a credentials object
-        oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
-    except FlowExchangeError:
-        response = make_response(
-            json.dumps('Failed to upgrade the authorization code.'), 401)
-        response.headers['Content-Type'] = 'application/json'
-        return response
-
-    # Check that the access token is valid.
-    access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-           % access_token)
-    # Submit request, parse response - Python3 compatible
-    h = httplib2.Http()
-    response = h.request(url, 'GET')[1]
-    str_response = response.decode('utf-8')
-    result = json.loads(str_response)
-
-    # If there was an error in the access token info, abort.
-    if result.get('error') is not None:
-        response = make_response(json.dumps(result.get('error')), 500)
-        response.headers['Content-Type'] = 'application/json'
-        return response
-
-    # Verify that the access token is used for the intended user.
-    gplus_id = credentials.id_token['sub']
-    if result['user_id'] != gplus_id:
-        response = make_response(
-            json.dumps("Token's user ID doesn't match given user ID."), 401)
-        response.headers['Content-Type'] = 'application/json'
-        return response
-
-    # Verify that the access token is valid for this app.
-    if result['issued_to'] != CLIENT_ID:
-        response = make_response(
-            json.dumps("Token's client ID does not match app's."), 401)
-        response.headers['Content-Type'] = 'application/json'
-        return response
-
-    stored_access_token = login_session.get('access_token')
-    stored_gplus_id = login_session.get('gplus_id')
-    if stored_access_token is not None and gplus_id == stored_gplus_id:
-        dumpMessage = 'Current user is already connected.'
-        response = make_response(json.dumps(dumpMessage), 200)
-        response.headers['Content-Type'] = 'application/json'
-        return response
-
-    # Store the access token in the session for later use.
-    login_session['access_token'] = access_token
-    login_session['gplus_id'] = gplus_id
-
-    # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-
-    data = answer.json()
-    print(data)
-    login_session['provider'] = 'google'
-    if 'name' in data:
-        login_session['username'] = data['name']
-    else:
-        login_session['username'] = data['email'].split("@")[0]
-    login_session['picture'] = data['picture']
-    login_session['email'] = data['email']
-
-    # see if user exists, if it doesn't make a new one
-    user_id = getUserId(login_session['email'])
-    if not user_id:
-        user_id = createUser(login_session)
-    login_session['user_id'] = user_id
-
-    output = ''
-    output += '<h1>Welcome, '
-    output += login_session['username']
-    output += '!</h1>'
-    output += '<img src="'
-    output += login_session['picture']
-    output += (' " style = "width: 300px; height: 300px;border-radius: 150px;'
-               '-webkit-border-radius: 150px;-moz-border-radius: 150px;"> ')
-    flash("You are now logged in as %s" % login_session['username'], 'success')
-    print("done!")
-    return output
+    return startLogin('google', request.get_data().decode('utf-8'))
 
 
 # DISCONNECT - Revoke a current user's token and reset their login_session
@@ -504,36 +997,19 @@ def gconnect():
 def gdisconnect():
     """Handle Google OAuth logout"""
     # only disconnect a connected user
-    credentials = login_session.get('credentials')
-    if credentials is None:
-        response = make_response(
-            json.dumps('Current user not connected.'), 401)
-        response.headers['Content-type'] = 'application/json'
-        return response
-    # execute HTTP GET request to revoke current token
-    access_token = credentials.access_token
-    url = 'https://accounts.google.com/o/oauth2/revoke?token=%s' % access_toke
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
+    access_token = login_session.get('access_token')
+    if access_token is None:
+        return jsonMessage('Current user not connected.', 401)
 
-    if result['status'] == '200':
+    if providers['google'].revoke(access_token):
         # reset the user's session
-        del login_session['credentials']
-        del login_session['gplus_id']
-        del login_session['username']
-        del login_session['email']
-        del login_session['picture']
-
-        response = make_response(json.dumps('Successfully disconnected.'), 200)
-        response.headers['Content-Type'] = 'application/json'
-        return response
-
+        for key in ('access_token', 'gplus_id', 'username', 'email',
+                    'picture'):
+            login_session.pop(key, None)
+        return jsonMessage('Successfully disconnected.', 200)
     else:
         # token given is invalid
-        response = make_response(
-            json.dumps('Failed to revoke token for given user.'), 400)
-        response.headers['Content-Type'] = 'application/json'
-        return response
+        return jsonMessage('Failed to revoke token for given user.', 400)
 
 
 # User helper functions
@@ -560,10 +1036,9 @@ def getUserInfo(user_id):
         user_id (int): The user's id
 
     Returns:
-        User: The user object
+        UserSnapshot: The user, or None
     """
-    user = session.query(User).filter_by(id=user_id).first()
-    return user
+    return snapshots.user(session, user_id)
 
 
 def createUser(login_session):
@@ -582,23 +1057,24 @@ def createUser(login_session):
     session.add(newUser)
     session.commit()
     user = session.query(User).filter_by(email=login_session['email']).first()
+    snapshots.invalidateUser(user.id)
     return user.id
 
 
 @app.route('/disconnect')
 def disconnect():
     """Handle logout/disconnect based on provider"""
-    print(login_session)
+    app.logger.debug('Logging out user %s', login_session.get('user_id'))
     if 'provider' in login_session:
         if login_session['provider'] == 'google':
             gdisconnect()
             if 'gplus_id' in login_session:
                 del login_session['gplus_id']
-            if 'credentials' in login_session:
-                del login_session['credentials']
         if login_session['provider'] == 'facebook':
             fbdisconnect()
             del login_session['facebook_id']
+        if 'access_token' in login_session:
+            del login_session['access_token']
         if 'username' in login_session:
             del login_session['username']
         if 'email' in login_session:
@@ -608,6 +1084,7 @@ def disconnect():
         if 'user_id' in login_session:
             del login_session['user_id']
         del login_session['provider']
+        regenerateSession()
         flash("You have successfully been logged out.", 'success')
         return redirect(url_for('showCatalog'))
     else:
@@ -615,7 +1092,35 @@ def disconnect():
         return redirect(url_for('showCatalog'))
 
 
+def create_app(config=None):
+    """Configure the catalog app for serving and return it.
+
+    The views, database session and caches are set up once per process
+    when this module is imported; create_app() applies the settings that
+    differ between the development server, the production server (see
+    server.py) and other WSGI servers.
+
+    Args:
+        config (dict): Flask settings, e.g. {'DEBUG': True}. SECRET_KEY
+                       defaults to the SECRET_KEY environment variable.
+
+    Returns:
+        Flask: The app.
+
+    Raises:
+        RuntimeError: If no secret key is configured.
+    """
+    app.config.update(config or {})
+    if not app.config.get('SECRET_KEY'):
+        app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+    if not app.secret_key:
+        raise RuntimeError('Set SECRET_KEY to sign the session cookies.')
+    return app
+
+
 if __name__ == '__main__':
-    app.secret_key = 'super_secret_key'
-    app.debug = True
+    # Development server; run server.py in production
+    create_app({
+        'DEBUG': True,
+        'SECRET_KEY': os.environ.get('SECRET_KEY', 'super_secret_key')})
     app.run(host='0.0.0.0', port=8000)
@@ -0,0 +1,256 @@
+"""
+    Batched item writes for the /api/v2/items:batch endpoint.
+
+    A batch is a list of create, update and delete operations on the items
+    of one user:
+
+        {"op": "create", "name": "Ball", "category_id": 3, "price": "2.50"}
+        {"op": "update", "id": 17, "price": "1.99", "category_id": 4}
+        {"op": "delete", "id": 18}
+
+    Creates need a name and a category_id and may have a description and a
+    price; updates only change the fields they carry. All operations are
+    checked before anything is written, with one query for the items they
+    touch and one for the categories they name. The valid operations are
+    then applied in the caller's transaction: the creates with one
+    executemany statement, the updates with one per set of changed fields,
+    the deletes with one DELETE statement, and all of them logged in the
+    change log with one insert per kind of operation.
+"""
+from collections import Counter
+from sqlalchemy import bindparam
+from database_setup import Category, Item, parsePrice
+from queries import adjustItemCounts, insertItems, recordChanges
+
+
+# Operations accepted in one batch
+MAX_BATCH_SIZE = 1000
+
+# Fields an operation may set, as (request field, Item column)
+FIELDS = [('name', 'name'), ('description', 'description'),
+          ('price', 'price_cents'), ('category_id', 'category_id')]
+
+
+class OperationError(Exception):
+    """An operation of a batch that can't be applied
+
+    Attributes:
+        message (str): the reason, reported to the client
+        status  (int): the HTTP status of the operation's result
+    """
+
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.message = message
+        self.status = status
+
+
+def isId(value):
+    """Return whether a JSON value is a row id."""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def validateOperation(operation):
+    """Check an operation and normalize its fields.
+
+    Args:
+        operation (dict): The operation as sent by the client.
+
+    Returns:
+        tuple: (op, item id or None, dict of the Item columns to set)
+
+    Raises:
+        OperationError: If the operation is malformed.
+    """
+    if not isinstance(operation, dict):
+        raise OperationError('operation is not a JSON object')
+    op = operation.get('op')
+    if op not in ('create', 'update', 'delete'):
+        raise OperationError("op must be 'create', 'update' or 'delete'")
+    item_id = operation.get('id')
+    if op == 'create':
+        if item_id is not None:
+            raise OperationError('create must not have an id')
+    elif not isId(item_id):
+        raise OperationError('%s needs the id of an item' % op)
+    if op == 'delete':
+        return op, item_id, {}
+
+    values = {}
+    for field, column in FIELDS:
+        if field in operation:
+            values[column] = operation[field]
+    if op == 'create':
+        for column in ('name', 'category_id'):
+            if values.get(column) is None:
+                raise OperationError('%s is required' % column)
+    elif not values:
+        raise OperationError('update changes no fields')
+    if 'name' in values:
+        name = values['name']
+        if not isinstance(name, type(u'')) or not name.strip():
+            raise OperationError('name must be a non-empty string')
+        if len(name.strip()) > 80:
+            raise OperationError('name is longer than 80 characters')
+        values['name'] = name.strip()
+    if 'description' in values:
+        description = values['description']
+        if description is not None and not isinstance(
+                description, type(u'')):
+            raise OperationError('description must be a string')
+        values['description'] = (description or '').strip() or None
+    if 'price_cents' in values:
+        price = values['price_cents']
+        if isinstance(price, bool) or not isinstance(
+                price, (type(u''), int, float, type(None))):
+            raise OperationError('price must be an amount in dollars')
+        try:
+            values['price_cents'] = parsePrice(
+                None if price is None else '%s' % price)
+        except ValueError:
+            raise OperationError('price must be an amount in dollars')
+    if 'category_id' in values and not isId(values['category_id']):
+        raise OperationError('category_id must be the id of a category')
+    return op, item_id, values
+
+
+def applyItemBatch(session, operations, user_id, atomic=False):
+    """Check a batch of item operations and apply the valid ones.
+
+    Operations on items of other users, on missing items or categories,
+    or on an item an earlier operation of the batch already touches are
+    rejected. Nothing is committed; the caller commits the session.
+
+    Args:
+        session    (Session): The session to write in.
+        operations (list): The operations, see the module docstring.
+        user_id    (int): The id of the user sending the batch.
+        atomic     (bool): Apply nothing if any operation is rejected.
+
+    Returns:
+        dict: 'results', one dict per operation in order with its 'status'
+              (201 created, 200 updated or deleted, 4xx rejected) and the
+              item 'id' and new 'revision' or an 'error'; 'applied', the
+              number of applied operations; 'item_ids' and 'category_ids',
+              the sets of changed items and categories; 'counts_changed',
+              whether any category item count changed.
+    """
+    checked = []
+    for operation in operations:
+        try:
+            checked.append(validateOperation(operation))
+        except OperationError as e:
+            checked.append(e)
+
+    item_ids = set(c[1] for c in checked if isinstance(c, tuple) and c[1])
+    category_ids = set(c[2]['category_id'] for c in checked if isinstance(
+        c, tuple) and c[2].get('category_id') is not None)
+    items = {}
+    if item_ids:
+        items = dict((row[0], row[1:]) for row in session.query(
+            Item.id, Item.user_id, Item.category_id).filter(
+                Item.id.in_(item_ids)))
+    if category_ids:
+        category_ids = set(row[0] for row in session.query(
+            Category.id).filter(Category.id.in_(category_ids)))
+
+    touched = set()
+    for index, check in enumerate(checked):
+        if isinstance(check, OperationError):
+            continue
+        op, item_id, values = check
+        try:
+            if op != 'create':
+                if item_id not in items:
+                    raise OperationError('item %d not found' % item_id, 404)
+                if items[item_id][0] != user_id:
+                    raise OperationError(
+                        'item %d belongs to another user' % item_id, 403)
+                if item_id in touched:
+                    raise OperationError(
+                        'item %d is changed twice in the batch' % item_id,
+                        409)
+                touched.add(item_id)
+            if ('category_id' in values and
+                    values['category_id'] not in category_ids):
+                raise OperationError(
+                    'category %d not found' % values['category_id'], 404)
+        except OperationError as e:
+            checked[index] = e
+
+    results = [{'status': c.status, 'error': c.message}
+               if isinstance(c, OperationError) else None for c in checked]
+    outcome = {'results': results, 'applied': 0, 'item_ids': set(),
+               'category_ids': set(), 'counts_changed': False}
+    if atomic and any(results):
+        for index, result in enumerate(results):
+            if result is None:
+                results[index] = {'status': 424,
+                                  'error': 'not applied, batch rejected'}
+        return outcome
+
+    # Apply the valid operations, grouped by kind
+    valid = [(index, check) for index, check in enumerate(checked)
+             if results[index] is None]
+    creates = [(i, c[2]) for i, c in valid if c[0] == 'create']
+    updates = [(i, c[1], c[2]) for i, c in valid if c[0] == 'update']
+    deletes = [(i, c[1]) for i, c in valid if c[0] == 'delete']
+    counts = Counter()
+    total = 0
+
+    if creates:
+        # Every create sets all columns, so they share one statement
+        rows = [dict(dict((column, None) for _, column in FIELDS),
+                     user_id=user_id, **values) for _, values in creates]
+        created = insertItems(session, rows)
+        for (index, values), (item_id, revision) in zip(creates, created):
+            counts[values['category_id']] += 1
+            results[index] = {'status': 201, 'id': item_id,
+                              'revision': revision}
+        total += len(created)
+
+    if updates:
+        revisions = recordChanges(
+            session, 'item', [item_id for _, item_id, _ in updates],
+            'update')
+        groups = {}
+        for (index, item_id, values), revision in zip(updates, revisions):
+            row = dict(('new_' + k, v) for k, v in values.items())
+            row.update(item_id=item_id, new_revision=revision)
+            groups.setdefault(tuple(sorted(values)), []).append(row)
+            previous_category_id = items[item_id][1]
+            if values.get('category_id', previous_category_id) != (
+                    previous_category_id):
+                counts[previous_category_id] -= 1
+                counts[values['category_id']] += 1
+            results[index] = {'status': 200, 'id': item_id,
+                              'revision': revision}
+        for columns, rows in groups.items():
+            session.execute(Item.__table__.update().where(
+                Item.id == bindparam('item_id')).values(dict(
+                    (c, bindparam('new_' + c))
+                    for c in columns + ('revision',))), rows)
+
+    if deletes:
+        ids = [item_id for _, item_id in deletes]
+        revisions = recordChanges(session, 'item', ids, 'delete')
+        session.query(Item).filter(Item.id.in_(ids)).delete(
+            synchronize_session=False)
+        for (index, item_id), revision in zip(deletes, revisions):
+            counts[items[item_id][1]] -= 1
+            results[index] = {'status': 200, 'id': item_id,
+                              'revision': revision}
+        total -= len(ids)
+
+    for category_id, delta in counts.items():
+        adjustItemCounts(session, category_id, delta, 0)
+    adjustItemCounts(session, None, total)
+
+    outcome['applied'] = len(valid)
+    outcome['item_ids'] = set(
+        r['id'] for r in results if r.get('status') in (200, 201))
+    # Items from before categories were required may have none
+    outcome['category_ids'] = (set(counts) | set(
+        items[item_id][1] for _, item_id, _ in updates)) - set([None])
+    outcome['counts_changed'] = any(counts.values())
+    return outcome
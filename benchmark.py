@@ -0,0 +1,988 @@
+"""
+    Measure the response time of the catalog routes.
+
+    Usage:
+        python benchmark.py routes [--repeat N] [--page-cache]
+        python benchmark.py indexes [--repeat N] [--page-cache]
+        python benchmark.py concurrency [--readers N] [--duration SECONDS]
+        python benchmark.py search [--items N] [--repeat N]
+        python benchmark.py load [--repeat N] [--output FILE]
+                                 [--compare FILE]
+        python benchmark.py serialize [--sizes N,N] [--repeat N]
+        python benchmark.py login [--repeat N] [--workers N]
+                                  [--latency MS]
+        python benchmark.py sessions [--repeat N]
+        python benchmark.py batch [--batch-size N]
+        python benchmark.py serve [--workers N] [--readers N]
+                                  [--duration SECONDS]
+
+    The benchmarks run against itemcatalog.db through the Flask test client,
+    so run create_sample_catalog.py or `manage.py generate` first.
+
+    `routes` reports the latency of every read route. `indexes` drops the
+    indexes declared in database_setup.py, measures the routes, restores
+    the indexes with the migration from manage.py and measures again.
+    Both clear the page cache before every request, so pages are rendered
+    from the database; --page-cache measures cache hits instead.
+    `concurrency` measures the home page latency seen by concurrent readers
+    while items are being added; it writes "Benchmark item" rows into the
+    catalog. Compare runs with SQLITE_JOURNAL_MODE=DELETE and the default
+    WAL mode to see the effect of write-ahead logging.
+    `search` builds a synthetic catalog (one million items by default) in
+    a temporary database and times full-text searches against it.
+    `load` requests every route of the app, reads and writes, as an
+    anonymous visitor and as a logged-in user, and reports latency
+    percentiles, throughput and SQL queries per request. It creates and
+    then deletes a "Benchmark category" with one item per repeat. --output
+    saves the results as JSON and --compare prints the change against
+    results saved earlier.
+    `serialize` builds synthetic catalogs of 10,000 and 100,000 items in
+    temporary databases and times encoding all items as JSON through ORM
+    objects and serialize (the former path of the catalog JSON API)
+    against Core row tuples with every installed JSON backend.
+    `login` serves a burst of Google logins mixed with home page loads on
+    a fixed number of request workers, once with logins answered inline
+    and once with logins on a LoginQueue, against the stub provider from
+    oauth_stub.py. It adds up to ten "Stub user" rows to the catalog.
+    `sessions` compares Flask's signed cookie sessions with the memory and
+    SQL session stores: the size of the Cookie header of a logged-in user,
+    the time to open the session, and the time of a JSON request.
+    `batch` creates, reprices and deletes 500 items in a new "Benchmark
+    category", once with one form post per item and once with one
+    /api/v2/items:batch request per step, and reports the time and SQL
+    statements of each step. The category is deleted afterwards.
+    `serve` starts the development server (app.run() in debug mode, as
+    application.py runs it) and then server.py with --workers processes
+    (with --unshared-caches, as the benchmark doesn't write), and reports
+    the throughput and latency of each over HTTP while --readers client
+    processes request the read routes for --duration seconds.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from collections import OrderedDict
+from datetime import datetime
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import requests
+from flask import request
+from flask.sessions import SecureCookieSessionInterface
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import sessionmaker
+import application
+from application import app, session
+from database_setup import Base, CatalogState, Category, Item, User
+from database_setup import createDatabaseEngine, engine
+from generate import generateCatalog, vocabulary
+from manage import migrateIndexes
+from oauth import GoogleProvider, LoginQueue
+from oauth_stub import startStubServer
+from search import searchItemIds
+from serializers import itemDict, itemSelect, jsonBackend
+from sessions import MemorySessionStore, ServerSessionInterface
+from sessions import SQLSessionStore
+
+
+def catalogRoutes():
+    """Return the read routes to measure, using ids from the database.
+
+    Returns:
+        list: (name, url) tuples.
+    """
+    item = session.query(Item).order_by(Item.id.desc()).first()
+    if item is None:
+        raise SystemExit('The catalog is empty, add some items first.')
+    category_id, item_id = item.category_id, item.id
+    return [
+        ('catalog', '/'),
+        ('catalog page 2', '/?before_id=%d' % item_id),
+        ('category', '/categories/%d/' % category_id),
+        ('item', '/categories/%d/item/%d/' % (category_id, item_id)),
+        ('categories JSON', '/api/v1/categories/json'),
+        ('item JSON', '/api/v1/categories/%d/item/%d/json'
+         % (category_id, item_id)),
+        ('catalog JSON', '/api/v1/catalog/json'),
+        ('catalog JSON v2', '/api/v2/catalog/json'),
+    ]
+
+
+def timeRoutes(routes, repeat, page_cache=False):
+    """Request every route `repeat` times as a visitor not logged in.
+
+    Args:
+        routes     (list): (name, url) tuples.
+        repeat     (int): The number of requests per route.
+        page_cache (bool): Serve pages from the page cache; otherwise it
+                           is cleared before every request, so each one
+                           renders its page.
+
+    Returns:
+        dict: route name -> list of response times in milliseconds.
+    """
+    client = app.test_client()
+    timings = {}
+    for name, url in routes:
+        timings[name] = []
+        for _ in range(repeat):
+            if not page_cache:
+                application.pageCache.backend.clear()
+            start = timeit.default_timer()
+            response = client.get(url)
+            response.get_data()
+            timings[name].append((timeit.default_timer() - start) * 1000)
+            if response.status_code != 200:
+                raise SystemExit('%s returned %d' % (url,
+                                                     response.status_code))
+    return timings
+
+
+def printPagePath(page_cache):
+    """Print whether the pages timed come from the page cache."""
+    if page_cache:
+        print('pages: served from the page cache')
+    else:
+        print('pages: rendered, the page cache is cleared before every '
+              'request')
+
+
+def percentile(values, percent):
+    """Return a percentile of a list of numbers.
+
+    Args:
+        values  (list): The numbers.
+        percent (int): The percentile, 50 for the median.
+
+    Returns:
+        float: The nearest-rank percentile.
+    """
+    values = sorted(values)
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def printTimings(routes, *runs):
+    """Print the median response time of every route for one or more runs.
+
+    Args:
+        routes (list): (name, url) tuples.
+        runs   (tuple): (title, timings) tuples as returned by timeRoutes.
+    """
+    print('%-18s' % 'route' + ''.join('%14s' % title for title, _ in runs))
+    for name, _ in routes:
+        print('%-18s' % name + ''.join(
+            '%11.2f ms' % percentile(timings[name], 50)
+            for _, timings in runs))
+
+
+def dropIndexes(engine):
+    """Drop the declared indexes that exist in the database.
+
+    Args:
+        engine (Engine): The engine of the database.
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing:
+                index.drop(engine)
+
+
+def readUnderWrites(readers, duration):
+    """Load the catalog page from several threads while items are written.
+
+    One thread keeps posting new items through newItem while the reader
+    threads request the home page.
+
+    Args:
+        readers  (int): The number of reader threads.
+        duration (float): How long to run, in seconds.
+
+    Returns:
+        tuple: (read timings in milliseconds, number of items written)
+    """
+    item = session.query(Item).order_by(Item.id.desc()).first()
+    session.remove()
+    stop = threading.Event()
+    timings = []
+    writes = [0]
+
+    def read():
+        client = app.test_client()
+        while not stop.is_set():
+            start = timeit.default_timer()
+            client.get('/').get_data()
+            timings.append((timeit.default_timer() - start) * 1000)
+
+    def write():
+        client = app.test_client()
+        with client.session_transaction() as login_session:
+            login_session['user_id'] = item.user_id
+        while not stop.is_set():
+            client.post('/categories/item/new', data={
+                'name': 'Benchmark item', 'description': '', 'price': '1',
+                'category': item.category_id})
+            writes[0] += 1
+
+    threads = [threading.Thread(target=read) for _ in range(readers)]
+    threads.append(threading.Thread(target=write))
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return timings, writes[0]
+
+
+def loginBurst(logins, workers, pages_per_login=5):
+    """Serve a burst of Google logins mixed with home page loads.
+
+    The requests are handed to a fixed number of request workers, like
+    a server with that many worker threads, and every login asks the
+    provider (the stub, see oauth_stub.py) three times. Queued logins are
+    polled for every 100 ms through the same workers.
+
+    Args:
+        logins          (int): The number of logins.
+        workers         (int): The number of request workers.
+        pages_per_login (int): The page loads requested with every login.
+
+    Returns:
+        tuple: (login timings, page timings), in milliseconds from the
+               moment the request was queued until it was answered.
+    """
+    pool = ThreadPool(workers)
+    timings = {'login': [], 'page': []}
+    failures = []
+    remaining = [logins * (1 + pages_per_login)]
+    lock = threading.Lock()
+    finished = threading.Event()
+
+    def done(kind, queued):
+        with lock:
+            timings[kind].append((timeit.default_timer() - queued) * 1000)
+            remaining[0] -= 1
+            if not remaining[0]:
+                finished.set()
+
+    def answer(client, response, queued):
+        if response.status_code == 202:
+            url = response.headers['Location']
+            threading.Timer(0.1, pool.apply_async, (
+                lambda: answer(client, client.get(url), queued),)).start()
+        else:
+            if response.status_code != 200:
+                failures.append(response.status_code)
+            done('login', queued)
+
+    def login(number, queued):
+        client = app.test_client()
+        with client.session_transaction() as login_session:
+            login_session['state'] = 'benchmark'
+        answer(client, client.post('/gconnect?state=benchmark',
+                                   data='user%d' % (number % 10)), queued)
+
+    def page(queued):
+        app.test_client().get('/').get_data()
+        done('page', queued)
+
+    for number in range(logins):
+        pool.apply_async(login, (number, timeit.default_timer()))
+        for _ in range(pages_per_login):
+            pool.apply_async(page, (timeit.default_timer(),))
+    finished.wait()
+    pool.terminate()
+    if failures:
+        raise SystemExit('%d logins failed with status %s' % (
+            len(failures), failures[0]))
+    return timings['login'], timings['page']
+
+
+def buildSearchCatalog(path, items, categories=100):
+    """Fill a new SQLite database with a synthetic catalog to search.
+
+    Args:
+        path       (str): The path of the database file to create.
+        items      (int): The number of items.
+        categories (int): The number of categories.
+
+    Returns:
+        Engine: The engine of the new database.
+    """
+    search_engine = createDatabaseEngine('sqlite:///' + path)
+    Base.metadata.create_all(search_engine)
+    with open(os.devnull, 'w') as log:
+        generateCatalog(search_engine, users=1, categories=categories,
+                        items=items, seed=42, log=log)
+    return search_engine
+
+
+def timeSearches(search_engine, repeat):
+    """Time typical searches against a search catalog.
+
+    Args:
+        search_engine (Engine): The engine of the catalog to search.
+        repeat        (int): The number of runs per search.
+
+    Returns:
+        tuple: (list of (name, url) tuples, dict of timings) in the format
+               used by printTimings.
+    """
+    words = vocabulary(random.Random(42))
+    searches = [
+        ('one word', words[100], None),
+        ('two words', '%s %s' % (words[200], words[300]), None),
+        ('prefix', words[400][:3], None),
+        ('category filter', words[500], 7),
+        ('no match', 'zzzzzz', None),
+    ]
+    search_session = sessionmaker(bind=search_engine)()
+    timings = {}
+    for name, query, category_id in searches:
+        timings[name] = []
+        for _ in range(repeat):
+            start = timeit.default_timer()
+            searchItemIds(search_session, query, category_id)
+            timings[name].append((timeit.default_timer() - start) * 1000)
+    search_session.close()
+    return [(name, query) for name, query, _ in searches], timings
+
+
+def serializationPaths():
+    """Return the ways to encode all catalog items as JSON to compare.
+
+    Returns:
+        list: (name, function taking a session and returning the JSON)
+    """
+    def orm(session):
+        items = session.query(Item).order_by(Item.id.desc())
+        return json.dumps({'Items': [i.serialize for i in items]},
+                          sort_keys=True, separators=(',', ':'))
+    paths = [('ORM + json', orm)]
+    for name in ('json', 'ujson', 'orjson'):
+        try:
+            encode = jsonBackend(name)[1]
+        except ValueError:
+            continue
+
+        def core(session, encode=encode):
+            rows = session.execute(itemSelect(newest_first=True))
+            return encode({'Items': [itemDict(row) for row in rows]})
+        paths.append(('Core + ' + name, core))
+    return paths
+
+
+def timeSerialization(serialize_engine, repeat):
+    """Time every serialization path against a catalog.
+
+    Args:
+        serialize_engine (Engine): The engine of the catalog.
+        repeat           (int): The number of runs per path.
+
+    Returns:
+        tuple: (list of (name, None) tuples, dict of timings) in the format
+               used by printTimings.
+    """
+    Session = sessionmaker(bind=serialize_engine)
+    paths = serializationPaths()
+    timings = {}
+    for name, path in paths:
+        timings[name] = []
+        for _ in range(repeat):
+            serialize_session = Session()
+            start = timeit.default_timer()
+            path(serialize_session)
+            timings[name].append((timeit.default_timer() - start) * 1000)
+            serialize_session.close()
+    return [(name, None) for name, _ in paths], timings
+
+
+# A session as left by a Google login
+LOGGED_IN_SESSION = {
+    'state': 'X' * 32,
+    'provider': 'google',
+    'username': 'Benchmark User',
+    'email': 'benchmark.user@example.com',
+    'picture': 'https://lh3.googleusercontent.com/a-/%s/photo.jpg' % (
+        'a' * 80),
+    'access_token': 'ya29.' + 'b' * 160,
+    'gplus_id': '1' * 21,
+    'user_id': 1,
+}
+
+
+def timeSessions(repeat):
+    """Compare the session stores for a logged-in visitor.
+
+    For every store the session of a logged-in user is saved, then opened
+    `repeat` times like every request opens it, and a JSON endpoint that
+    doesn't use the session is requested `repeat` times.
+
+    Args:
+        repeat (int): The number of runs per store.
+
+    Returns:
+        list: (store, Cookie header bytes, median microseconds to open the
+              session, median milliseconds per JSON request) tuples.
+    """
+    url = '/api/v1/categories/JSON'
+    stores = [
+        ('cookie', SecureCookieSessionInterface()),
+        ('memory', ServerSessionInterface(MemorySessionStore(),
+                                          cleanup_interval=0)),
+        ('sql', ServerSessionInterface(SQLSessionStore(engine),
+                                       cleanup_interval=0)),
+    ]
+    original = app.session_interface
+    results = []
+    try:
+        for name, interface in stores:
+            app.session_interface = interface
+            client = app.test_client()
+            with client.session_transaction() as login_session:
+                login_session.update(LOGGED_IN_SESSION)
+            cookie = [c for c in client.cookie_jar
+                      if c.name == app.session_cookie_name][0]
+            header = '%s=%s' % (cookie.name, cookie.value)
+
+            opens = []
+            with app.test_request_context(url, headers={'Cookie': header}):
+                for _ in range(repeat):
+                    start = timeit.default_timer()
+                    interface.open_session(app, request)
+                    opens.append((timeit.default_timer() - start) * 1e6)
+            requests = []
+            for _ in range(repeat):
+                start = timeit.default_timer()
+                client.get(url).get_data()
+                requests.append((timeit.default_timer() - start) * 1000)
+            results.append((name, len(header), percentile(opens, 50),
+                            percentile(requests, 50)))
+            if hasattr(interface, 'store'):
+                interface.store.delete(cookie.value)
+    finally:
+        app.session_interface = original
+    return results
+
+
+def timeBatchEdits(size):
+    """Compare item form posts with the batch API.
+
+    A logged-in user creates `size` items in a new category, changes the
+    price of all of them and deletes them again, first with one form post
+    per item and then with one batch request per step.
+
+    Args:
+        size (int): The number of items.
+
+    Returns:
+        list: (step, form milliseconds, form statements, batch
+              milliseconds, batch statements) tuples.
+    """
+    user_id = session.query(func.min(User.id)).scalar()
+    if user_id is None:
+        raise SystemExit('The catalog has no users, add some items first.')
+    session.remove()
+    user = app.test_client()
+    with user.session_transaction() as login_session:
+        login_session['user_id'] = user_id
+        login_session['username'] = 'Benchmark'
+    user.post('/categories/new', data={'name': 'Benchmark category'})
+    category_id = engine.execute(select([func.max(Category.id)])).scalar()
+    counter = QueryCounter(engine)
+
+    def itemIds():
+        return [row[0] for row in engine.execute(select([Item.id]).where(
+            Item.category_id == category_id).order_by(Item.id))]
+
+    def measure(requests):
+        queries = counter.count
+        start = timeit.default_timer()
+        for url, data in requests:
+            if isinstance(data, dict):
+                response = user.post(url, data=data)
+            else:
+                response = user.post(url, data=data,
+                                     content_type='application/json')
+            if response.status_code >= 400:
+                raise SystemExit('POST %s returned %d' % (
+                    url, response.status_code))
+        return ((timeit.default_timer() - start) * 1000,
+                counter.count - queries)
+
+    def forms(step):
+        if step == 'create':
+            return [('/categories/item/new', {
+                'name': 'Benchmark item %d' % i, 'description': '',
+                'price': '1.00', 'category': str(category_id)})
+                for i in range(size)]
+        url = '/categories/%d/item/%%d/' % category_id
+        if step == 'update':
+            return [(url % i + 'edit', {
+                'name': '', 'description': '', 'price': '2.00',
+                'category': ''}) for i in itemIds()]
+        return [(url % i + 'delete', {}) for i in itemIds()]
+
+    def batch(step):
+        if step == 'create':
+            operations = [{'op': 'create', 'name': 'Benchmark item %d' % i,
+                           'price': '1.00', 'category_id': category_id}
+                          for i in range(size)]
+        elif step == 'update':
+            operations = [{'op': 'update', 'id': i, 'price': '2.00'}
+                          for i in itemIds()]
+        else:
+            operations = [{'op': 'delete', 'id': i} for i in itemIds()]
+        return [('/api/v2/items:batch',
+                 json.dumps({'operations': operations}))]
+
+    steps = ['create', 'update', 'delete']
+    try:
+        timings = [measure(forms(step)) for step in steps]
+        timings = [form + measure(batch(step))
+                   for step, form in zip(steps, timings)]
+    finally:
+        counter.close()
+        user.post('/categories/%d/delete/' % category_id)
+    return [(step,) + timing for step, timing in zip(steps, timings)]
+
+
+DEV_SERVER = (
+    'import application; application.create_app({"DEBUG": True, '
+    '"SECRET_KEY": "benchmark"}); application.app.run(host="127.0.0.1", '
+    'port=%d, use_reloader=False)')
+
+
+def freePort():
+    """Return a TCP port that is free on localhost."""
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def fetchUntil(args):
+    """Request URLs in turn until a deadline; runs in a client process.
+
+    Args:
+        args (tuple): (list of URLs, deadline as a time.time() value)
+
+    Returns:
+        list: Response times in milliseconds.
+    """
+    urls, deadline = args
+    timings = []
+    while time.time() < deadline:
+        for url in urls:
+            start = timeit.default_timer()
+            response = requests.get(url)
+            if response.status_code != 200:
+                raise SystemExit('%s returned %d' % (
+                    url, response.status_code))
+            timings.append((timeit.default_timer() - start) * 1000)
+    return timings
+
+
+def serverThroughput(command, port, paths, clients, duration):
+    """Start a server process and load it with concurrent clients.
+
+    Args:
+        command  (list): The command starting the server.
+        port     (int): The port the server listens on.
+        paths    (list): The paths to request.
+        clients  (int): The number of client processes.
+        duration (float): Seconds to load the server for.
+
+    Returns:
+        list: Response times in milliseconds of all requests.
+    """
+    env = dict(os.environ, SECRET_KEY='benchmark')
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen(command, env=env, stdout=devnull,
+                                  stderr=devnull)
+    base = 'http://127.0.0.1:%d' % port
+    try:
+        for _ in range(300):
+            try:
+                requests.get(base + '/')
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        else:
+            raise SystemExit('%s did not start' % ' '.join(command))
+        pool = Pool(clients)
+        try:
+            deadline = time.time() + duration
+            runs = pool.map(fetchUntil, [
+                ([base + path for path in paths], deadline)] * clients)
+        finally:
+            pool.close()
+        return [timing for run in runs for timing in run]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+class QueryCounter(object):
+    """Counts the SQL statements executed through an engine
+
+    Attributes:
+        count (int): the number of statements executed so far
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+    def close(self):
+        """Stop counting."""
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def loadTest(repeat):
+    """Request every route of the app, reads and writes.
+
+    Reads are made by an anonymous visitor, who is served from the page
+    cache after the first request, and by a logged-in user, whose pages
+    are always rendered. Every repeat the logged-in user then creates,
+    edits and deletes a category with one item.
+
+    Args:
+        repeat (int): The number of requests per route.
+
+    Returns:
+        dict: route name -> {'method', 'url', 'times' (milliseconds),
+              'queries' (per request)}.
+    """
+    item = session.query(Item).order_by(Item.id.desc()).first()
+    if item is None:
+        raise SystemExit('The catalog is empty, add some items first.')
+    category_id, item_id, user_id = item.category_id, item.id, item.user_id
+    word = item.name.split()[0]
+    since = session.query(CatalogState.compacted_revision).scalar()
+    session.remove()
+
+    anonymous = app.test_client()
+    user = app.test_client()
+    with user.session_transaction() as login_session:
+        login_session['user_id'] = user_id
+        login_session['username'] = 'Benchmark'
+    counter = QueryCounter(engine)
+    results = OrderedDict()
+
+    def measure(name, client, method, url, data=None):
+        queries = counter.count
+        start = timeit.default_timer()
+        response = client.open(url, method=method, data=data)
+        response.get_data()
+        elapsed = (timeit.default_timer() - start) * 1000
+        if response.status_code >= 400:
+            raise SystemExit('%s %s returned %d' % (
+                method, url, response.status_code))
+        result = results.setdefault(name, {
+            'method': method, 'url': url, 'times': [], 'queries': []})
+        result['times'].append(elapsed)
+        result['queries'].append(counter.count - queries)
+
+    def newest(model):
+        return engine.execute(select([func.max(model.id)])).scalar()
+
+    item_url = '/categories/%d/item/%d/' % (category_id, item_id)
+    reads = [
+        ('catalog', '/'),
+        ('catalog page 2', '/?before_id=%d' % item_id),
+        ('category', '/categories/%d/' % category_id),
+        ('category by price', '/categories/%d/?sort=price&max_price=100'
+         % category_id),
+        ('item', item_url),
+        ('search', '/search?q=%s' % word),
+        ('categories JSON', '/api/v1/categories/json'),
+        ('item JSON', '/api/v1/categories/%d/item/%d/json'
+         % (category_id, item_id)),
+        ('catalog JSON', '/api/v1/catalog/json'),
+        ('catalog JSON v2', '/api/v2/catalog/json'),
+        ('items JSON by price', '/api/v2/items?sort=price&min_price=10'),
+        ('changes JSON', '/api/v2/changes?since=%d' % since),
+        ('search JSON', '/api/v2/search?q=%s' % word),
+    ]
+    try:
+        for _ in range(repeat):
+            for name, url in reads:
+                measure(name, anonymous, 'GET', url)
+            for name, url in reads[:6]:
+                measure(name + ' (user)', user, 'GET', url)
+            measure('new item form', user, 'GET', '/categories/item/new')
+            measure('edit item form', user, 'GET', item_url + 'edit')
+
+            measure('new category', user, 'POST', '/categories/new',
+                    {'name': 'Benchmark category'})
+            new_category = '/categories/%d/' % newest(Category)
+            measure('edit category', user, 'POST', new_category + 'edit/',
+                    {'name': 'Benchmark category'})
+            measure('new item', user, 'POST', '/categories/item/new', {
+                'name': 'Benchmark item', 'description': 'Benchmark',
+                'price': '1.00', 'category': new_category.split('/')[2]})
+            new_item = new_category + 'item/%d/' % newest(Item)
+            measure('edit item', user, 'POST', new_item + 'edit', {
+                'name': 'Benchmark item', 'description': 'Edited',
+                'price': '2.00', 'category': ''})
+            measure('delete item', user, 'POST', new_item + 'delete')
+            measure('delete category', user, 'POST',
+                    new_category + 'delete/')
+    finally:
+        counter.close()
+    return results
+
+
+def summarizeLoad(results):
+    """Compute the statistics of every route measured by loadTest.
+
+    Args:
+        results (dict): The results of loadTest.
+
+    Returns:
+        OrderedDict: route name -> dict of 'method', 'url', 'requests',
+                     'p50', 'p95', 'p99' and 'mean' (milliseconds),
+                     'throughput' (requests per second) and 'queries'
+                     (mean SQL queries per request).
+    """
+    summary = OrderedDict()
+    for name, result in results.items():
+        times = result['times']
+        summary[name] = {
+            'method': result['method'],
+            'url': result['url'],
+            'requests': len(times),
+            'p50': percentile(times, 50),
+            'p95': percentile(times, 95),
+            'p99': percentile(times, 99),
+            'mean': sum(times) / len(times),
+            'throughput': len(times) * 1000 / max(sum(times), 1e-9),
+            'queries': float(sum(result['queries'])) / len(times),
+        }
+    return summary
+
+
+def printLoad(summary, baseline=None):
+    """Print the statistics of a load test.
+
+    Args:
+        summary  (dict): The routes as returned by summarizeLoad.
+        baseline (dict): Routes of an earlier run to compare the median
+                         latency and queries with (optional).
+    """
+    print('%-24s%10s%10s%10s%10s%9s' % ('route', 'p50 ms', 'p95 ms',
+                                        'p99 ms', 'req/s', 'queries') +
+          ('%10s%9s' % ('p50 diff', 'queries') if baseline else ''))
+    for name, route in summary.items():
+        line = '%-24s%10.2f%10.2f%10.2f%10.0f%9.1f' % (
+            name, route['p50'], route['p95'], route['p99'],
+            route['throughput'], route['queries'])
+        if baseline and name in baseline:
+            before = baseline[name]
+            line += '%+9.0f%%%+9.1f' % (
+                (route['p50'] / before['p50'] - 1) * 100,
+                route['queries'] - before['queries'])
+        print(line)
+    times = [route['mean'] * route['requests'] for route in summary.values()]
+    requests = sum(route['requests'] for route in summary.values())
+    print('%d requests, %.0f requests/s overall' % (
+        requests, requests * 1000 / max(sum(times), 1e-9)))
+
+
+def saveResults(path, summary, repeat):
+    """Write the results of a load test to a JSON file.
+
+    Args:
+        path    (str): The path of the file.
+        summary (dict): The routes as returned by summarizeLoad.
+        repeat  (int): The number of requests per route.
+    """
+    counts = dict((model.__tablename__, engine.execute(
+        select([func.count()]).select_from(model.__table__)).scalar())
+        for model in (Category, Item))
+    with open(path, 'w') as f:
+        json.dump(OrderedDict([
+            ('created', datetime.utcnow().isoformat() + 'Z'),
+            ('python', platform.python_version()),
+            ('database', engine.dialect.name),
+            ('categories', counts['category']),
+            ('items', counts['catalog_item']),
+            ('repeat', repeat),
+            ('routes', summary),
+        ]), f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measure the response time of the catalog routes.')
+    parser.add_argument('benchmark',
+                        choices=['routes', 'indexes', 'concurrency',
+                                 'search', 'load', 'serialize', 'login',
+                                 'sessions', 'batch', 'serve'])
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='requests per route (default: 20)')
+    parser.add_argument('--readers', type=int, default=4,
+                        help='concurrent reader threads, client '
+                             'processes for serve (default: 4)')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to run concurrency for (default: 10)')
+    parser.add_argument('--items', type=int, default=1000000,
+                        help='items in the search catalog (default: 1000000)')
+    parser.add_argument('--sizes', default='10000,100000',
+                        help='catalog sizes to serialize (default: '
+                             '10000,100000)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='request workers for login, server '
+                             'processes for serve (default: 4)')
+    parser.add_argument('--latency', type=int, default=100,
+                        help='milliseconds the stub provider takes to '
+                             'answer (default: 100)')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='items edited by batch (default: 500)')
+    parser.add_argument('--page-cache', action='store_true',
+                        help='time routes and indexes with pages served '
+                             'from the page cache')
+    parser.add_argument('--output', metavar='FILE',
+                        help='save the load test results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the load test with saved results')
+    args = parser.parse_args(argv)
+
+    if args.benchmark == 'search':
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'search.db')
+        start = timeit.default_timer()
+        search_engine = buildSearchCatalog(path, args.items)
+        print('Built a catalog of %d items in %.1f s' % (
+            args.items, timeit.default_timer() - start))
+        searches, timings = timeSearches(search_engine, args.repeat)
+        printTimings(searches, ('median', timings))
+        search_engine.dispose()
+        shutil.rmtree(directory)
+        return
+
+    if args.benchmark == 'serialize':
+        runs = []
+        for size in [int(size) for size in args.sizes.split(',')]:
+            directory = tempfile.mkdtemp()
+            serialize_engine = createDatabaseEngine(
+                'sqlite:///' + os.path.join(directory, 'serialize.db'))
+            Base.metadata.create_all(serialize_engine)
+            with open(os.devnull, 'w') as log:
+                generateCatalog(serialize_engine, items=size, log=log)
+            paths, timings = timeSerialization(serialize_engine, args.repeat)
+            runs.append(('%d items' % size, timings))
+            serialize_engine.dispose()
+            shutil.rmtree(directory)
+        printTimings(paths, *runs)
+        return
+
+    if not app.secret_key:
+        app.secret_key = 'benchmark'
+    routes = catalogRoutes()
+
+    if args.benchmark == 'load':
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)['routes']
+        summary = summarizeLoad(loadTest(args.repeat))
+        printLoad(summary, baseline)
+        if args.output:
+            saveResults(args.output, summary, args.repeat)
+    elif args.benchmark == 'routes':
+        printPagePath(args.page_cache)
+        printTimings(routes, ('median', timeRoutes(routes, args.repeat,
+                                                   args.page_cache)))
+    elif args.benchmark == 'indexes':
+        printPagePath(args.page_cache)
+        dropIndexes(engine)
+        before = timeRoutes(routes, args.repeat, args.page_cache)
+        migrateIndexes(engine)
+        application.pageCache.backend.clear()
+        after = timeRoutes(routes, args.repeat, args.page_cache)
+        printTimings(routes, ('no indexes', before), ('indexes', after))
+    elif args.benchmark == 'login':
+        providers = application.providers
+        google = providers['google']
+        stub = startStubServer(google.client_id, args.latency / 1000.0)
+        application.providers = {'google': GoogleProvider(
+            google.client_id, google.client_secret, stub.url, stub.url,
+            stub.url + '/oauth2/v3/token')}
+        print('%-10s%14s%14s%14s' % ('logins', 'login p50', 'page p50',
+                                     'page p95'))
+        for title, queue in (('inline', None),
+                             ('queued', LoginQueue(args.repeat))):
+            application.loginQueue = queue
+            logins, pages = loginBurst(args.repeat, args.workers)
+            print('%-10s%11.2f ms%11.2f ms%11.2f ms' % (
+                title, percentile(logins, 50), percentile(pages, 50),
+                percentile(pages, 95)))
+        application.providers = providers
+        application.loginQueue = None
+        stub.shutdown()
+    elif args.benchmark == 'sessions':
+        print('%-8s%14s%16s%16s' % ('store', 'cookie bytes', 'open session',
+                                    'JSON request'))
+        for name, size, opened, requested in timeSessions(args.repeat):
+            print('%-8s%14d%13.1f us%13.2f ms' % (name, size, opened,
+                                                  requested))
+    elif args.benchmark == 'batch':
+        print('%-8s%14s%12s%14s%12s' % ('items', 'forms', 'statements',
+                                        'batch', 'statements'))
+        for step, form, form_queries, batched, batch_queries in (
+                timeBatchEdits(args.batch_size)):
+            print('%-8s%11.1f ms%12d%11.1f ms%12d' % (
+                step, form, form_queries, batched, batch_queries))
+    elif args.benchmark == 'serve':
+        paths = [url for name, url in routes if 'catalog JSON' not in name]
+        print('%-22s%12s%14s%14s' % ('server', 'requests/s', 'p50', 'p95'))
+        servers = [
+            ('development server',
+             lambda port: [sys.executable, '-c', DEV_SERVER % port]),
+            ('server.py',
+             lambda port: [sys.executable, 'server.py', '--host',
+                           '127.0.0.1', '--port', str(port),
+                           '--workers', str(args.workers),
+                           '--unshared-caches']),
+        ]
+        for title, command in servers:
+            port = freePort()
+            timings = serverThroughput(command(port), port, paths,
+                                       args.readers, args.duration)
+            print('%-22s%12.1f%11.2f ms%11.2f ms' % (
+                title, len(timings) / args.duration, percentile(timings, 50),
+                percentile(timings, 95)))
+    elif args.benchmark == 'concurrency':
+        if engine.dialect.name == 'sqlite':
+            print('journal mode: %s' % engine.execute(
+                'PRAGMA journal_mode').scalar())
+        timings, writes = readUnderWrites(args.readers, args.duration)
+        print('%d reads, %d writes in %.1f s' % (len(timings), writes,
+                                                 args.duration))
+        for percent in (50, 95, 99):
+            print('read p%d: %8.2f ms' % (percent,
+                                          percentile(timings, percent)))
+        print('read max: %8.2f ms' % max(timings))
+
+
+if __name__ == '__main__':
+    main()
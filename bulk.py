@@ -0,0 +1,244 @@
+"""
+    Bulk import and export of catalog items as CSV or NDJSON.
+
+    Both directions stream: the importer reads and validates one row at a
+    time and writes them in large batches with Core inserts, one
+    transaction per batch; the exporter reads plain column tuples from a
+    server-side cursor instead of building ORM objects.
+
+    Files have one item per row with the fields name, description, price
+    and category (the category name). Exports also include the item id.
+"""
+from __future__ import print_function
+import csv
+import io
+import json
+import sys
+import timeit
+from collections import Counter
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+from database_setup import Category, Item, formatPrice, parsePrice
+from queries import adjustItemCounts, insertItems, recordChanges
+
+
+FIELDS = ['name', 'description', 'price', 'category']
+EXPORT_FIELDS = ['id'] + FIELDS
+
+# Text types of the fields read from CSV (py2 str) and JSON (unicode)
+TEXT_TYPES = (str, type(u''))
+
+# Rows written per transaction
+DEFAULT_BATCH_SIZE = 5000
+
+
+def fileFormat(path, fmt=None):
+    """Return the format of a data file, from fmt or its file extension.
+
+    Args:
+        path (str): The path of the file.
+        fmt  (str): 'csv' or 'ndjson', None to use the file extension.
+
+    Returns:
+        str: 'csv' or 'ndjson'.
+    """
+    if fmt:
+        return fmt
+    if path.endswith('.csv'):
+        return 'csv'
+    if path.endswith('.ndjson') or path.endswith('.jsonl'):
+        return 'ndjson'
+    raise ValueError('Unknown format of %s, pass --format' % path)
+
+
+def readRows(stream, fmt):
+    """Read rows from a CSV or NDJSON stream, one at a time.
+
+    Args:
+        stream (file): The text stream to read.
+        fmt    (str): 'csv' or 'ndjson'.
+
+    Yields:
+        tuple: (line number, dict of fields), the fields None if the line
+               is not JSON
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for number, line in enumerate(stream, 1):
+            if line.strip():
+                try:
+                    yield number, json.loads(line)
+                except ValueError:
+                    yield number, None
+
+
+def validateRow(row):
+    """Check an imported row and normalize its fields.
+
+    Args:
+        row (dict): The fields read from the file.
+
+    Returns:
+        dict: name, description, price_cents and category of the item.
+
+    Raises:
+        ValueError: If the row can't be imported.
+    """
+    if not isinstance(row, dict):
+        raise ValueError('not a JSON object')
+    for field in ('name', 'description', 'category'):
+        if not isinstance(row.get(field) or '', TEXT_TYPES):
+            raise ValueError('%s must be a string' % field)
+    price = row.get('price')
+    if isinstance(price, (int, float)) and not isinstance(price, bool):
+        price = '%s' % price
+    elif not isinstance(price or '', TEXT_TYPES):
+        raise ValueError('price must be an amount in dollars')
+    name = (row.get('name') or '').strip()
+    category = (row.get('category') or '').strip()
+    if not name:
+        raise ValueError('name is required')
+    if len(name) > 80:
+        raise ValueError('name is longer than 80 characters')
+    if not category:
+        raise ValueError('category is required')
+    return {
+        'name': name,
+        'description': (row.get('description') or '').strip() or None,
+        'price_cents': parsePrice(price),
+        'category': category,
+    }
+
+
+def importItems(engine, rows, user_id, create_categories=False,
+                batch_size=DEFAULT_BATCH_SIZE, log=sys.stderr):
+    """Insert items into the catalog in batched transactions.
+
+    Category names are resolved with a map loaded once at the start.
+    Every batch is inserted with one Core executemany statement and logged
+    in the change log and the item counts within the same transaction.
+    Invalid rows are reported and skipped.
+
+    Args:
+        engine            (Engine): The engine of the catalog database.
+        rows              (iterable): (line number, fields) tuples.
+        user_id           (int): The id of the user owning the items.
+        create_categories (bool): Create unknown categories instead of
+                                  rejecting their items.
+        batch_size        (int): The number of rows per transaction.
+        log               (file): Where to report progress and errors.
+
+    Returns:
+        dict: Counts of 'imported' and 'rejected' rows and the ids of the
+              categories that received items ('category_ids').
+    """
+    session = sessionmaker(bind=engine)()
+    categories = dict(session.query(Category.name, Category.id))
+    result = {'imported': 0, 'rejected': 0, 'category_ids': set()}
+    start = timeit.default_timer()
+    batch = []
+
+    def flush():
+        insertItems(session, batch)
+        added = Counter(row['category_id'] for row in batch)
+        for category_id, count in added.items():
+            adjustItemCounts(session, category_id, count)
+        session.commit()
+        result['imported'] += len(batch)
+        del batch[:]
+        elapsed = timeit.default_timer() - start
+        print('%d rows imported, %.0f rows/s' % (
+            result['imported'], result['imported'] / elapsed), file=log)
+
+    for number, row in rows:
+        try:
+            item = validateRow(row)
+            category_id = categories.get(item['category'])
+            if category_id is None:
+                if not create_categories:
+                    raise ValueError(
+                        'unknown category %r' % item['category'])
+                category = Category(name=item['category'], user_id=user_id)
+                session.add(category)
+                session.flush()
+                category.revision = recordChanges(
+                    session, 'category', [category.id], 'create')[0]
+                category_id = categories[category.name] = category.id
+        except ValueError as e:
+            result['rejected'] += 1
+            print('line %d: %s' % (number, e), file=log)
+            continue
+        result['category_ids'].add(category_id)
+        batch.append({
+            'name': item['name'],
+            'description': item['description'],
+            'price_cents': item['price_cents'],
+            'category_id': category_id,
+            'user_id': user_id,
+        })
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    session.commit()
+    session.close()
+    return result
+
+
+def exportItems(engine, stream, fmt, batch_size=DEFAULT_BATCH_SIZE,
+                log=sys.stderr):
+    """Write all catalog items to a CSV or NDJSON stream.
+
+    Args:
+        engine     (Engine): The engine of the catalog database.
+        stream     (file): The text stream to write to.
+        fmt        (str): 'csv' or 'ndjson'.
+        batch_size (int): The number of rows fetched per round trip.
+        log        (file): Where to report progress.
+
+    Returns:
+        int: The number of exported items.
+    """
+    items = select([Item.id, Item.name, Item.description, Item.price_cents,
+                    Category.name]).select_from(
+        Item.__table__.outerjoin(Category.__table__)).order_by(Item.id)
+    if fmt == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(EXPORT_FIELDS)
+        write = writer.writerows
+    else:
+        def write(rows):
+            stream.writelines(
+                json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n'
+                for row in rows)
+
+    exported = 0
+    start = timeit.default_timer()
+    connection = engine.connect().execution_options(stream_results=True)
+    try:
+        result = connection.execute(items)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            write([(row[0], row[1], row[2], formatPrice(row[3]), row[4])
+                   for row in rows])
+            exported += len(rows)
+        elapsed = timeit.default_timer() - start
+        print('%d rows exported, %.0f rows/s' % (
+            exported, exported / max(elapsed, 1e-9)), file=log)
+    finally:
+        connection.close()
+    return exported
+
+
+def openData(path, mode):
+    """Open a data file as a text stream, '-' for stdin or stdout."""
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return io.open(stream.fileno(), mode, newline='', encoding='utf-8',
+                       closefd=False)
+    return io.open(path, mode, newline='', encoding='utf-8')
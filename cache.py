@@ -0,0 +1,248 @@
+"""
+    Caching of rendered catalog pages.
+
+    Pages are stored in a cache backend: LocalCache keeps them in the
+    process, RedisCache shares them between processes. Each cached page is
+    tagged with the catalog data it shows ("items", "category:3", ...).
+    Writes invalidate tags rather than pages, and a page is only served
+    while every one of its tags is unchanged.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from database_setup import envSetting
+
+
+class CacheBackend(object):
+    """Interface of the stores used by PageCache
+
+    Values are strings. A ttl of 0 keeps an entry until it is evicted,
+    None uses the backend's default ttl.
+    """
+
+    def get(self, key):
+        """Return the value stored for key, or None"""
+        raise NotImplementedError
+
+    def getMany(self, keys):
+        """Return a list with the value (or None) for every key"""
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ttl=None):
+        """Store value for key"""
+        raise NotImplementedError
+
+    def add(self, key, value, ttl=None):
+        """Store value for key unless the key exists; return whether it did"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove key"""
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove all entries"""
+        raise NotImplementedError
+
+
+class LocalCache(CacheBackend):
+    """In-process cache with per-entry expiry and LRU eviction
+
+    Attributes:
+        maxsize (int): the maximum number of entries kept
+        ttl     (int): the default number of seconds an entry is kept
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires and expires < time.time():
+                return None
+            # Re-insert to mark the entry as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + ttl if ttl else 0)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not (entry[1] and
+                                          entry[1] < time.time()):
+                return False
+        self.set(key, value, ttl)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def purge(self):
+        """Remove the expired entries; return how many there were"""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (_, expires) in self._entries.items()
+                       if expires and expires < now]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+
+class RedisCache(CacheBackend):
+    """Cache shared between processes, stored in Redis
+
+    Requires the redis package. Eviction is left to the Redis server's
+    maxmemory policy.
+
+    Attributes:
+        client (StrictRedis): the Redis connection
+        ttl    (int): the default number of seconds an entry is kept
+        prefix (str): prefix of all keys written by this cache
+    """
+
+    def __init__(self, url, ttl=300, prefix='itemcatalog:'):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _decode(self, value):
+        return value.decode('utf-8') if value is not None else None
+
+    def get(self, key):
+        return self._decode(self.client.get(self.prefix + key))
+
+    def getMany(self, keys):
+        if not keys:
+            return []
+        values = self.client.mget([self.prefix + key for key in keys])
+        return [self._decode(value) for value in values]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.client.set(self.prefix + key, value, ex=ttl or None)
+
+    def add(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        return bool(self.client.set(self.prefix + key, value,
+                                    ex=ttl or None, nx=True))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+class PageCache(object):
+    """Cache of rendered pages, invalidated by tag
+
+    Every tag has a random version token. A page is stored together with
+    the versions of its tags at the time it was rendered, and invalidating
+    a tag gives it a new version, which turns all pages rendered before
+    into misses. Tags that are missing from the backend (never used, or
+    evicted) get a fresh version, so eviction can't revive stale pages.
+
+    Attributes:
+        backend (CacheBackend): the store for pages and tag versions
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def tagVersions(self, tags):
+        """Return the current versions of tags.
+
+        Args:
+            tags (list): The tag names.
+
+        Returns:
+            list: The version of each tag.
+        """
+        keys = ['tag:' + tag for tag in tags]
+        versions = self.backend.getMany(keys)
+        for index, version in enumerate(versions):
+            if version is None:
+                self.backend.add(keys[index], uuid.uuid4().hex, 0)
+                versions[index] = self.backend.get(keys[index])
+        return versions
+
+    def get(self, key, tags):
+        """Return a cached page, or None if it is missing or stale.
+
+        Args:
+            key  (str): The cache key of the page.
+            tags (list): The tags of the page.
+
+        Returns:
+            str: The rendered page.
+        """
+        entry = self.backend.get('page:' + key)
+        if entry is None:
+            return None
+        versions, page = json.loads(entry)
+        if versions != self.tagVersions(tags):
+            return None
+        return page
+
+    def set(self, key, versions, page):
+        """Store a rendered page.
+
+        Args:
+            key      (str): The cache key of the page.
+            versions (list): The tag versions read before rendering began,
+                             so writes made while rendering invalidate it.
+            page     (str): The rendered page.
+        """
+        self.backend.set('page:' + key, json.dumps([versions, page]))
+
+    def invalidate(self, *tags):
+        """Mark all pages with any of the tags as stale.
+
+        Args:
+            tags (str): The tag names.
+        """
+        for tag in tags:
+            self.backend.set('tag:' + tag, uuid.uuid4().hex, 0)
+
+
+def createPageCache():
+    """Create the page cache configured in the environment:
+        PAGE_CACHE_URL  (str): redis:// URL of a shared cache (default:
+                               cache in the process)
+        PAGE_CACHE_TTL  (int): seconds a page is kept (default: 300)
+        PAGE_CACHE_SIZE (int): pages kept by the in-process cache
+                               (default: 1024)
+
+    Returns:
+        PageCache: The page cache.
+    """
+    url = os.environ.get('PAGE_CACHE_URL')
+    ttl = envSetting('PAGE_CACHE_TTL', 300)
+    if url:
+        return PageCache(RedisCache(url, ttl=ttl))
+    return PageCache(LocalCache(envSetting('PAGE_CACHE_SIZE', 1024), ttl))
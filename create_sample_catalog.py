@@ -3,17 +3,28 @@
     Populate item catalog database with sample item data.
 
     Test data descriptions source: Wikipedia
+
+    Usage:
+        python create_sample_catalog.py [--fixture FILE] [--cache FILE]
+                                        [--workers N] [--rate N]
+
+    Descriptions are fetched before the database is touched and kept in
+    a cache file, so running the script again fetches nothing. Pass
+    --fixture sample_descriptions.json to work offline.
 """
+import argparse
 import sys
 import warnings
 from database_setup import *
 from application import session
+from queries import adjustItemCounts, recordChange
+from descriptions import DescriptionCache, FixtureSource, WikipediaSource
+from descriptions import fetchDescriptions
 
 
 def clearDatabase():
-    """Delete all tables and recreate"""
-    Base.metadata.drop_all(engine)
-    Base.metadata.create_all(engine)
+    """Delete all tables and recreate, keeping the catalog revision"""
+    recreateTables(engine)
 
 
 def createCategory(name, user_id):
@@ -28,31 +39,32 @@ def createCategory(name, user_id):
     """
     c = Category(name=name, user_id=user_id)
     session.add(c)
+    session.flush()
+    c.revision = recordChange(session, 'category', c.id, 'create')
     session.commit()
     print 'Category "' + name + '" created.'
     return c
 
 
-def createItem(name, category, price, user_id):
+def createItem(name, category, price, user_id, description=None):
     """Create a new catalog item
 
     Args:
-        name     (str): The name for the item.
-        category (obj): The category object.
-        price    (str): The item price.
-        user_id  (int): The id of the creating user.
+        name        (str): The name for the item.
+        category    (obj): The category object.
+        price       (str): The item price.
+        user_id     (int): The id of the creating user.
+        description (str): The item description.
 
     Returns:
         Item: The created Item object.
     """
-    try:
-        description = wikipedia.summary(name)
-    except wikipedia.exceptions.DisambiguationError as e:
-        description = wikipedia.summary(name + " " + category.name)
-
     i = Item(name=name, description=description,
              category_id=category.id, price=price, user_id=user_id)
     session.add(i)
+    session.flush()
+    i.revision = recordChange(session, 'item', i.id, 'create')
+    adjustItemCounts(session, category.id, 1)
     session.commit()
     print 'Item "' + name + '" added.'
     return i
@@ -112,8 +124,62 @@ def install_and_import(package):
         globals()[package] = importlib.import_module(package)
 
 
-# install wikipedia using PIP if necessary and import the module
-install_and_import('wikipedia')
+# Sample items per category: (name, price)
+SAMPLE_ITEMS = [
+    ('Fruit', [
+        ('Apple', '0.49'),
+        ('Banana', '0.29'),
+        ('Grapes', '1.99'),
+        ('Oranges', '0.59'),
+        ('Strawberries', '2.22'),
+    ]),
+    ('Vegetables', [
+        ('Broccoli', '1.99'),
+        ('Eggplant', '1.99'),
+        ('Lettuce', '2.50'),
+        ('Spinach', '3'),
+        ('Tomato', '3'),
+    ]),
+    ('Drinks', [
+        ('Beer', '2.50'),
+        ('Coca Cola', '1'),
+        ('Mineral water', '1.50'),
+        ('Orange juice', '2'),
+        ('Sparkling Water', '1.50'),
+    ]),
+]
+
+parser = argparse.ArgumentParser(
+    description='Replace the catalog with sample data.')
+parser.add_argument('--fixture', metavar='FILE',
+                    help='read descriptions from a JSON file of name -> '
+                         'description instead of Wikipedia')
+parser.add_argument('--cache', metavar='FILE',
+                    default='descriptions_cache.json',
+                    help='cache of fetched descriptions '
+                         '(default: %(default)s)')
+parser.add_argument('--workers', type=int, default=4,
+                    help='concurrent lookups (default: %(default)s)')
+parser.add_argument('--rate', type=float, default=5,
+                    help='maximum lookups per second (default: %(default)s)')
+args = parser.parse_args()
+
+# supress BeautifulSoup warnings
+if not sys.warnoptions:
+    warnings.simplefilter("ignore")
+
+# Fetch descriptions before any data is dropped
+if args.fixture:
+    source = FixtureSource(args.fixture)
+else:
+    # install wikipedia using PIP if necessary and import the module
+    install_and_import('wikipedia')
+    source = WikipediaSource()
+print "Fetching item descriptions..."
+descriptions = fetchDescriptions(
+    [(name, category) for category, items in SAMPLE_ITEMS
+     for name, _ in items],
+    source, DescriptionCache(args.cache), args.workers, args.rate)
 
 # Clear database tables
 clearDatabase()
@@ -125,93 +191,11 @@ sampleUser = createUser('Sample Data', 'john@smith.com',
                         'https://upload.wikimedia.org/wikipedia/commons/7/' +
                         '7c/Profile_avatar_placeholder_large.png')
 
-# supress BeautifulSoup warnings
-if not sys.warnoptions:
-    warnings.simplefilter("ignore")
-
-
-# fruit
-fruit = createCategory('Fruit', sampleUser.id)
-createItem('Apple',
-           fruit,
-           '0.49',
-           sampleUser.id)
-
-createItem('Banana',
-           fruit,
-           '0.29',
-           sampleUser.id)
-
-createItem('Grapes',
-           fruit,
-           '1.99',
-           sampleUser.id)
-
-createItem('Oranges',
-           fruit,
-           '0.59',
-           sampleUser.id)
-
-createItem('Strawberries',
-           fruit,
-           '2.22',
-           sampleUser.id)
-
-# vegetables
-print
-vegetables = createCategory('Vegetables', sampleUser.id)
-createItem('Broccoli',
-           vegetables,
-           '1.99',
-           sampleUser.id)
-
-createItem('Eggplant',
-           vegetables,
-           '1.99',
-           sampleUser.id)
-
-createItem('Lettuce',
-           vegetables,
-           '2.50',
-           sampleUser.id)
-
-createItem('Spinach',
-           vegetables,
-           '3',
-           sampleUser.id)
-
-createItem('Tomato',
-           vegetables,
-           '3',
-           sampleUser.id)
-
-# drinks
-print
-drinks = createCategory('Drinks', sampleUser.id)
-createItem('Beer',
-           drinks,
-           '2.50',
-           sampleUser.id)
-
-createItem('Coca Cola',
-           drinks,
-           '1',
-           sampleUser.id)
-
-createItem('Mineral water',
-           drinks,
-           '1.50',
-           sampleUser.id)
-
-createItem('Orange juice',
-           drinks,
-           '2',
-           sampleUser.id)
-
-createItem('Sparkling Water',
-           drinks,
-           '1.50',
-           sampleUser.id)
+for categoryName, items in SAMPLE_ITEMS:
+    print
+    category = createCategory(categoryName, sampleUser.id)
+    for name, price in items:
+        createItem(name, category, price, sampleUser.id, descriptions[name])
 
 print
 print "Database refreshed and filled with sample data."
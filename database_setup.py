@@ -1,6 +1,56 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, create_engine
+import os
+from datetime import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from sqlalchemy import Column, ForeignKey, Integer, String, Index, DateTime
+from sqlalchemy import DDL, Text, create_engine, event, exc, select
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref
+from sqlalchemy.pool import QueuePool, StaticPool
+
+
+DEFAULT_DATABASE_URL = 'sqlite:///itemcatalog.db'
+
+
+def parsePrice(text):
+    """Convert a price typed by a user, e.g. "$1,299.5", to cents.
+
+    Args:
+        text (str): The price in dollars, empty or None for no price.
+
+    Returns:
+        int: The price in cents, or None.
+
+    Raises:
+        ValueError: If the text is not a string holding a non-negative
+                    amount.
+    """
+    if text is not None and not isinstance(text, (str, type(u''))):
+        raise ValueError('price %r is not text' % (text,))
+    text = (text or '').strip().lstrip('$').replace(',', '')
+    if not text:
+        return None
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        raise ValueError('price %r is not a number' % text)
+    if not amount.is_finite() or amount < 0:
+        raise ValueError('price %r is not a valid amount' % text)
+    return int((amount * 100).quantize(Decimal(1), ROUND_HALF_UP))
+
+
+def formatPrice(cents):
+    """Format a price in cents as dollars, e.g. 129950 as "1299.50".
+
+    Args:
+        cents (int): The price in cents, or None.
+
+    Returns:
+        str: The price, or None.
+    """
+    if cents is None:
+        return None
+    return '%d.%02d' % divmod(cents, 100)
 
 
 Base = declarative_base()
@@ -18,7 +68,7 @@ class User(Base):
     __tablename__ = 'user'
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
-    email = Column(String, nullable=False)
+    email = Column(String, nullable=False, unique=True, index=True)
     picture = Column(String)
 
 
@@ -26,15 +76,21 @@ class Category(Base):
     """Class for category data
 
     Attributes:
-        id      (int): category id
-        name    (str): category name
-        user_id (int): id of user who created the category
+        id         (int): category id
+        name       (str): category name
+        user_id    (int): id of user who created the category
+        revision   (int): catalog revision of the last change to the
+                          category
+        item_count (int): number of items in the category
     """
     __tablename__ = 'category'
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
-    user_id = Column(Integer, ForeignKey('user.id'))
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)
     user = relationship(User)
+    revision = Column(Integer, nullable=False, default=0, server_default='0')
+    item_count = Column(
+        Integer, nullable=False, default=0, server_default='0')
 
     @property
     def serialize(self):
@@ -53,8 +109,11 @@ class Item(Base):
         name        (str): item name
         description (str): item description
         category_id (int): id of the corresponding item category
-        price       (str): price for the item
+        price_cents (int): price for the item in cents
+        price       (str): price for the item in dollars, e.g. "2.50";
+                           stored as price_cents
         user_id     (int): id of user who created the category
+        revision    (int): catalog revision of the last change to the item
     """
 
     __tablename__ = 'catalog_item'
@@ -62,12 +121,26 @@ class Item(Base):
     name = Column(String(80), nullable=False)
     id = Column(Integer, primary_key=True)
     description = Column(String(250))
-    category_id = Column(Integer, ForeignKey('category.id'))
-    category = relationship(
-        "Category", backref=backref("catalog_items", cascade="all, delete"))
-    price = Column(String(8))
-    user_id = Column(Integer, ForeignKey('user.id'))
-    user = relationship(User)
+    # Items are deleted by the database along with their category or user
+    category_id = Column(
+        Integer, ForeignKey('category.id', ondelete='CASCADE'))
+    category = relationship("Category", backref=backref(
+        "catalog_items", cascade="all, delete", passive_deletes=True))
+    price_cents = Column(Integer)
+    user_id = Column(
+        Integer, ForeignKey('user.id', ondelete='CASCADE'), index=True)
+    user = relationship(User, backref=backref(
+        "items", cascade="all, delete", passive_deletes=True))
+    revision = Column(Integer, nullable=False, default=0, server_default='0')
+
+    @property
+    def price(self):
+        """Return the price in dollars, e.g. "2.50", or None"""
+        return formatPrice(self.price_cents)
+
+    @price.setter
+    def price(self, text):
+        self.price_cents = parsePrice(text)
 
     @property
     def serialize(self):
@@ -76,11 +149,260 @@ class Item(Base):
             'id': self.id,
             'name': self.name,
             'description': self.description,
-            'price': '$' + self.price,
+            'price': '$' + self.price if self.price is not None else None,
             'category_id': self.category_id,
             'user_id': self.user_id
         }
 
 
-engine = create_engine('sqlite:///itemcatalog.db')
+class CatalogState(Base):
+    """Class for catalog wide data, stored in a single row
+
+    Attributes:
+        id         (int): always 1
+        revision   (int): catalog revision, advanced on every item or
+                          category write
+        updated_at (datetime): time (UTC) of the last write
+        compacted_revision (int): revision up to which the change log was
+                                  truncated
+        item_count (int): number of items in the catalog
+    """
+    __tablename__ = 'catalog_state'
+    id = Column(Integer, primary_key=True)
+    revision = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    compacted_revision = Column(
+        Integer, nullable=False, default=0, server_default='0')
+    item_count = Column(
+        Integer, nullable=False, default=0, server_default='0')
+
+
+class CatalogChange(Base):
+    """Class for the catalog change log, one row per catalog revision
+
+    Attributes:
+        revision   (int): catalog revision created by the change
+        entity     (str): 'item' or 'category'
+        entity_id  (int): id of the changed item or category
+        action     (str): 'create', 'update' or 'delete'
+        created_at (datetime): time (UTC) of the change
+    """
+    __tablename__ = 'catalog_change'
+    revision = Column(Integer, primary_key=True, autoincrement=False)
+    entity = Column(String(16), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    action = Column(String(16), nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class LoginSession(Base):
+    """Class for server-side session data, see sessions.py
+
+    Attributes:
+        id         (str): random session id, sent as the session cookie
+        data       (str): session data, serialized as tagged JSON
+        expires_at (datetime): time (UTC) after which the session is void
+    """
+    __tablename__ = 'login_session'
+    id = Column(String(64), primary_key=True)
+    data = Column(Text, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+event.listen(CatalogState.__table__, 'after_create', DDL(
+    "INSERT INTO catalog_state (id, revision, updated_at) "
+    "VALUES (1, 0, CURRENT_TIMESTAMP)"))
+
+
+# Category listings filter on category_id and page by descending id
+Index('ix_catalog_item_category_id_id', Item.category_id, Item.id.desc())
+
+# Cheapest first listings page by (price_cents, id), in a category or not
+Index('ix_catalog_item_price_cents_id', Item.price_cents, Item.id)
+Index('ix_catalog_item_category_id_price_cents_id', Item.category_id,
+      Item.price_cents, Item.id)
+
+# Full-text index over item names and descriptions (SQLite FTS5). It reads
+# the text from catalog_item and is kept in sync by triggers.
+SEARCH_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS catalog_item_fts USING fts5("
+    "name, description, content='catalog_item', content_rowid='id', "
+    "prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS catalog_item_fts_insert "
+    "AFTER INSERT ON catalog_item BEGIN "
+    "INSERT INTO catalog_item_fts (rowid, name, description) "
+    "VALUES (new.id, new.name, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS catalog_item_fts_delete "
+    "AFTER DELETE ON catalog_item BEGIN "
+    "INSERT INTO catalog_item_fts (catalog_item_fts, rowid, name, "
+    "description) VALUES ('delete', old.id, old.name, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS catalog_item_fts_update "
+    "AFTER UPDATE OF name, description ON catalog_item BEGIN "
+    "INSERT INTO catalog_item_fts (catalog_item_fts, rowid, name, "
+    "description) VALUES ('delete', old.id, old.name, old.description); "
+    "INSERT INTO catalog_item_fts (rowid, name, description) "
+    "VALUES (new.id, new.name, new.description); END",
+]
+
+for statement in SEARCH_INDEX_DDL:
+    event.listen(Item.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Item.__table__, 'before_drop',
+             DDL('DROP TABLE IF EXISTS catalog_item_fts').execute_if(
+                 dialect='sqlite'))
+
+
+# Change log compaction looks for newer changes of the same entity
+Index('ix_catalog_change_entity', CatalogChange.entity,
+      CatalogChange.entity_id, CatalogChange.revision)
+
+
+def envSetting(name, default):
+    """Return an integer setting from the environment.
+
+    Args:
+        name    (str): The name of the environment variable.
+        default (int): The value to use when the variable is not set.
+
+    Returns:
+        int: The setting.
+    """
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def sqlitePragmas():
+    """Return the pragmas set on every SQLite connection.
+
+    Foreign keys are always enforced, so that deleting a category or user
+    deletes their items in the database. Write-ahead logging lets readers
+    carry on while a request commits. The other pragmas are configured
+    from the environment:
+        SQLITE_JOURNAL_MODE (str): journal mode (default: WAL)
+        SQLITE_SYNCHRONOUS  (str): fsync level (default: NORMAL)
+        SQLITE_CACHE_SIZE   (int): page cache size, negative values are in
+                                   KiB (default: -65536, 64 MiB)
+        SQLITE_MMAP_SIZE    (int): bytes of the file read through memory
+                                   mapping (default: 268435456, 256 MiB)
+        SQLITE_BUSY_TIMEOUT (int): milliseconds to wait for a lock
+                                   (default: 5000)
+
+    Returns:
+        list: (pragma, value) tuples.
+    """
+    journal_mode = os.environ.get('SQLITE_JOURNAL_MODE') or 'WAL'
+    synchronous = os.environ.get('SQLITE_SYNCHRONOUS') or 'NORMAL'
+    if not (journal_mode.isalpha() and synchronous.isalpha()):
+        raise ValueError('Invalid SQLite journal mode or synchronous level')
+    return [
+        ('foreign_keys', 'ON'),
+        ('journal_mode', journal_mode),
+        ('synchronous', synchronous),
+        ('cache_size', envSetting('SQLITE_CACHE_SIZE', -65536)),
+        ('mmap_size', envSetting('SQLITE_MMAP_SIZE', 268435456)),
+        ('busy_timeout', envSetting('SQLITE_BUSY_TIMEOUT', 5000)),
+    ]
+
+
+def createDatabaseEngine(url=None):
+    """Create the engine for the catalog database.
+
+    The application and the maintenance scripts all share the engine this
+    factory builds. Connections are kept in a bounded QueuePool and checked
+    with a ping before use; SQLite connections get the pragmas from
+    sqlitePragmas(), in-memory ones only enforce foreign keys. Pooled
+    connections are never shared with a forked process: a process that
+    checks out a connection its parent opened gets a new one instead. The
+    pool is sized from the environment:
+        DB_POOL_SIZE    (int): connections kept open (default: 5)
+        DB_MAX_OVERFLOW (int): extra connections under load (default: 10)
+        DB_POOL_TIMEOUT (int): seconds to wait for a connection (default: 30)
+        DB_POOL_RECYCLE (int): seconds before a connection is replaced
+                               (default: 3600)
+
+    Args:
+        url (str): The database URL. Defaults to the DATABASE_URL
+                   environment variable, then to the local SQLite file.
+
+    Returns:
+        Engine: The database engine.
+    """
+    url = make_url(
+        url or os.environ.get('DATABASE_URL') or DEFAULT_DATABASE_URL)
+    options = {'pool_pre_ping': True}
+    pragmas = []
+    if url.drivername.startswith('sqlite'):
+        # Pooled SQLite connections are handed from thread to thread
+        options['connect_args'] = {'check_same_thread': False}
+        if url.database in (None, '', ':memory:'):
+            # An in-memory database only exists within its one connection
+            options['poolclass'] = StaticPool
+            pragmas = [('foreign_keys', 'ON')]
+        else:
+            pragmas = sqlitePragmas()
+    if options.get('poolclass') is None:
+        options.update(
+            poolclass=QueuePool,
+            pool_size=envSetting('DB_POOL_SIZE', 5),
+            max_overflow=envSetting('DB_MAX_OVERFLOW', 10),
+            pool_timeout=envSetting('DB_POOL_TIMEOUT', 30),
+            pool_recycle=envSetting('DB_POOL_RECYCLE', 3600))
+    engine = create_engine(url, **options)
+
+    @event.listens_for(engine, 'connect')
+    def rememberProcess(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def checkProcess(dbapi_connection, connection_record, connection_proxy):
+        # Leave the parent's connection alone and let the pool reconnect
+        if connection_record.info['pid'] != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                'Connection was opened by process %d'
+                % connection_record.info['pid'])
+
+    if pragmas:
+        @event.listens_for(engine, 'connect')
+        def setSqlitePragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas:
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+            cursor.close()
+    return engine
+
+
+
+def recreateTables(engine):
+    """Drop and create all tables, carrying the catalog revision over.
+
+    Revisions never go backwards, so that ETags and change log positions
+    clients hold from the old catalog can't match the new one. When the
+    old catalog had changes, the new one starts one revision later with
+    its change log truncated up to there, so mirror clients reload it.
+
+    Args:
+        engine (Engine): The engine of the database.
+
+    Returns:
+        int: The catalog revision of the new, empty catalog.
+    """
+    state = CatalogState.__table__
+    try:
+        revision = engine.execute(select([state.c.revision]).where(
+            state.c.id == 1)).scalar() or 0
+    except exc.DBAPIError:
+        # There are no tables yet
+        revision = 0
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    if revision:
+        revision += 1
+        engine.execute(state.update().where(state.c.id == 1).values(
+            revision=revision, compacted_revision=revision,
+            updated_at=datetime.utcnow()))
+    return revision
+
+
+engine = createDatabaseEngine()
 Base.metadata.create_all(engine)
@@ -0,0 +1,158 @@
+"""
+    Item description lookups for the sample catalog generator.
+
+    Descriptions come from a pluggable source: WikipediaSource queries the
+    live Wikipedia API, FixtureSource reads a local JSON file for offline
+    use. fetchDescriptions() runs the lookups on a bounded thread pool with
+    a rate limit and keeps the results in a DescriptionCache on disk, so
+    regenerating the sample catalog doesn't fetch anything twice.
+"""
+from __future__ import print_function
+import io
+import json
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+
+class WikipediaSource(object):
+    """Description source backed by the Wikipedia API
+
+    Requires the wikipedia package.
+    """
+
+    def __init__(self):
+        import wikipedia
+        self.wikipedia = wikipedia
+
+    def fetch(self, name, hint):
+        """Return the summary of the Wikipedia article about name.
+
+        Args:
+            name (str): The item name.
+            hint (str): A word added to ambiguous names, e.g. the category.
+
+        Returns:
+            str: The description.
+        """
+        try:
+            return self.wikipedia.summary(name)
+        except self.wikipedia.exceptions.DisambiguationError:
+            return self.wikipedia.summary(name + ' ' + hint)
+
+
+class FixtureSource(object):
+    """Description source reading a JSON file of name -> description
+
+    Attributes:
+        descriptions (dict): the descriptions by item name
+    """
+
+    def __init__(self, path):
+        with io.open(path, encoding='utf-8') as f:
+            self.descriptions = json.load(f)
+
+    def fetch(self, name, hint):
+        """Return the description of name from the fixture, or None."""
+        return self.descriptions.get(name)
+
+
+class DescriptionCache(object):
+    """Descriptions fetched earlier, kept in a JSON file
+
+    Attributes:
+        path (str): the path of the cache file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._descriptions = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with io.open(path, encoding='utf-8') as f:
+                self._descriptions = json.load(f)
+
+    def get(self, name):
+        """Return the cached description of name, or None."""
+        with self._lock:
+            return self._descriptions.get(name)
+
+    def set(self, name, description):
+        """Cache the description of name."""
+        with self._lock:
+            self._descriptions[name] = description
+
+    def save(self):
+        """Write the cache to disk, replacing the file atomically."""
+        with self._lock:
+            data = json.dumps(self._descriptions, indent=1, sort_keys=True,
+                              ensure_ascii=False)
+        temporary = self.path + '.tmp'
+        with io.open(temporary, 'w', encoding='utf-8') as f:
+            f.write(type(u'')(data))
+        os.rename(temporary, self.path)
+
+
+class RateLimiter(object):
+    """Spaces out calls from any number of threads
+
+    Attributes:
+        interval (float): the minimum number of seconds between calls
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next call is allowed."""
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def fetchDescriptions(lookups, source, cache, workers=4, rate=5):
+    """Return descriptions for a list of items, fetching only cache misses.
+
+    Failed lookups are reported and left out, so they are retried on the
+    next run.
+
+    Args:
+        lookups (list): (name, hint) tuples, see WikipediaSource.fetch.
+        source  (object): The source to fetch missing descriptions from.
+        cache   (DescriptionCache): The cache of fetched descriptions.
+        workers (int): The number of concurrent lookups.
+        rate    (float): The maximum number of lookups per second.
+
+    Returns:
+        dict: name -> description, None for failed lookups.
+    """
+    missing = [lookup for lookup in lookups if cache.get(lookup[0]) is None]
+    limiter = RateLimiter(rate)
+
+    def fetch(lookup):
+        limiter.wait()
+        try:
+            return lookup[0], source.fetch(*lookup)
+        except Exception as e:
+            print('No description for "%s": %s' % (lookup[0], e),
+                  file=sys.stderr)
+            return lookup[0], None
+
+    if missing:
+        pool = ThreadPool(max(1, min(workers, len(missing))))
+        try:
+            for name, description in pool.imap_unordered(fetch, missing):
+                if description is not None:
+                    cache.set(name, description)
+        finally:
+            pool.close()
+            pool.join()
+        cache.save()
+    return dict((name, cache.get(name)) for name, _ in lookups)
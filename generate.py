@@ -0,0 +1,105 @@
+"""
+    Deterministic synthetic catalogs for load testing.
+
+    generateCatalog() fills a database with any number of users, categories
+    and items made up from a seeded random number generator, so the same
+    arguments always produce the same catalog. Rows are written with Core
+    executemany inserts in large batches, one transaction per batch, which
+    keeps catalogs of millions of items practical to build.
+
+    Generated rows are not written to the change log. The catalog revision
+    is advanced past the log instead, so mirror clients reload the catalog.
+"""
+from __future__ import print_function
+import random
+import sys
+import timeit
+from datetime import datetime
+from sqlalchemy.orm import sessionmaker
+from database_setup import CatalogState, Category, Item, User
+from queries import repairItemCounts
+
+
+# Rows written per transaction
+DEFAULT_BATCH_SIZE = 50000
+
+SYLLABLES = ['ba', 'ce', 'di', 'fo', 'gu', 'ka', 'le', 'mi', 'no', 'pu',
+             'ra', 'se', 'ti', 'vo', 'xu', 'za', 'an', 'el', 'or', 'um']
+
+
+def vocabulary(rng, size=5000):
+    """Return made-up words to fill a synthetic catalog with.
+
+    Args:
+        rng  (Random): The random number generator to use.
+        size (int): The number of words.
+
+    Returns:
+        list: The words, sorted.
+    """
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES)
+                          for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def generateCatalog(engine, users=10, categories=50, items=100000, seed=42,
+                    batch_size=DEFAULT_BATCH_SIZE, log=sys.stderr):
+    """Add a synthetic catalog to an empty database.
+
+    Item names are two words and descriptions thirty words drawn from
+    vocabulary(Random(seed)); categories and items are spread evenly over
+    the users at random.
+
+    Args:
+        engine     (Engine): The engine of the database, with empty tables.
+        users      (int): The number of users.
+        categories (int): The number of categories.
+        items      (int): The number of items.
+        seed       (int): The seed of the random number generator.
+        batch_size (int): The number of items per transaction.
+        log        (file): Where to report progress.
+
+    Returns:
+        int: The catalog revision the generated catalog was given.
+    """
+    rng = random.Random(seed)
+    words = vocabulary(rng)
+    start = timeit.default_timer()
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [{
+            'name': 'User %d' % i,
+            'email': 'user%d@example.com' % i,
+            'picture': None} for i in range(1, users + 1)])
+        connection.execute(Category.__table__.insert(), [{
+            'name': ' '.join(rng.sample(words, 2)).capitalize(),
+            'user_id': rng.randint(1, users)}
+            for _ in range(categories)])
+    for offset in range(0, items, batch_size):
+        with engine.begin() as connection:
+            connection.execute(Item.__table__.insert(), [{
+                'name': ' '.join(rng.sample(words, 2)).capitalize(),
+                'description': ' '.join(rng.choice(words)
+                                        for _ in range(30)),
+                'price_cents': (rng.randint(0, 999) * 100 +
+                                rng.randint(0, 99)),
+                'category_id': rng.randint(1, categories),
+                'user_id': rng.randint(1, users)}
+                for _ in range(min(batch_size, items - offset))])
+        done = min(offset + batch_size, items)
+        print('%d items generated, %.0f rows/s' % (
+            done, done / (timeit.default_timer() - start)), file=log)
+
+    repairItemCounts(sessionmaker(bind=engine)())
+
+    # Clients mirroring the change log can't rebuild the generated rows
+    # from it, so mark the log as truncated up to the new revision.
+    with engine.begin() as connection:
+        connection.execute(CatalogState.__table__.update().where(
+            CatalogState.id == 1).values(
+                revision=CatalogState.revision + 1,
+                compacted_revision=CatalogState.revision + 1,
+                updated_at=datetime.utcnow()))
+        return connection.execute(CatalogState.__table__.select().where(
+            CatalogState.id == 1)).first().revision
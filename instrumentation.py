@@ -0,0 +1,272 @@
+"""
+    Optional per-request instrumentation of the Flask app.
+
+    instrumentApp() hooks into the app and the database engine and, for
+    every request, measures the wall time, the time spent rendering
+    templates and the number and duration of SQL statements. The numbers
+    are:
+        - sent back in a Server-Timing header, shown by browser devtools
+        - summed up per endpoint and served from /metrics in the Prometheus
+          text format, to local clients only unless configured otherwise;
+          the totals are those of the answering process, labelled with
+          its pid, so under server.py every scrape sees one worker
+        - checked for N+1 query patterns: a statement executed again and
+          again with different parameters in one request is logged as a
+          warning
+    A sample of requests can also be profiled with cProfile; profiles of
+    the slow ones are written to disk for pstats or snakeviz.
+
+    SQL statements run by streamed responses after the view returned are
+    not counted.
+"""
+import cProfile
+import os
+import random
+import re
+import threading
+import timeit
+from collections import Counter
+from flask import Response, abort, g, has_app_context, request
+from flask import before_render_template, signals_available, template_rendered
+from sqlalchemy import event
+
+
+# Who may read /metrics: 'local' clients, 'public' or nobody ('off')
+METRICS_ACCESS = ('local', 'public', 'off')
+
+# Addresses of local clients
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+# Upper bounds of the request duration histogram buckets, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class EndpointStats(object):
+    """Running totals of the requests to one endpoint
+
+    Attributes:
+        requests      (int): the number of requests
+        buckets       (list): requests per DURATION_BUCKETS bucket
+        duration      (float): total wall time in seconds
+        sql_count     (int): total SQL statements
+        sql_time      (float): total SQL time in seconds
+        template_time (float): total template render time in seconds
+        n_plus_one    (int): requests flagged as N+1 suspects
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.duration = 0.0
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.n_plus_one = 0
+
+
+class RequestMetrics(object):
+    """Request statistics of the app, by endpoint
+
+    Attributes:
+        endpoints (dict): endpoint name -> EndpointStats
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, duration, sql_count, sql_time,
+               template_time, n_plus_one):
+        """Add a finished request to the totals of its endpoint."""
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+            stats.requests += 1
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    stats.buckets[index] += 1
+            stats.duration += duration
+            stats.sql_count += sql_count
+            stats.sql_time += sql_time
+            stats.template_time += template_time
+            stats.n_plus_one += 1 if n_plus_one else 0
+
+    def prometheus(self):
+        """Return the statistics in the Prometheus text exposition format.
+
+        Every sample is labelled with the pid of this process, as each
+        worker process keeps its own totals.
+
+        Returns:
+            str: The metrics.
+        """
+        pid = os.getpid()
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = [
+                '# HELP itemcatalog_request_duration_seconds '
+                'Wall time of requests.',
+                '# TYPE itemcatalog_request_duration_seconds histogram']
+            for name, stats in endpoints:
+                for bound, count in zip(DURATION_BUCKETS, stats.buckets):
+                    lines.append(
+                        'itemcatalog_request_duration_seconds_bucket'
+                        '{pid="%d",endpoint="%s",le="%s"} %d'
+                        % (pid, name, bound, count))
+                lines.append('itemcatalog_request_duration_seconds_bucket'
+                             '{pid="%d",endpoint="%s",le="+Inf"} %d'
+                             % (pid, name, stats.requests))
+                lines.append('itemcatalog_request_duration_seconds_sum'
+                             '{pid="%d",endpoint="%s"} %f'
+                             % (pid, name, stats.duration))
+                lines.append('itemcatalog_request_duration_seconds_count'
+                             '{pid="%d",endpoint="%s"} %d'
+                             % (pid, name, stats.requests))
+            for metric, kind, description, attribute, fmt in (
+                    ('sql_queries_total', 'counter',
+                     'SQL statements executed.', 'sql_count', '%d'),
+                    ('sql_duration_seconds_total', 'counter',
+                     'Time spent executing SQL.', 'sql_time', '%f'),
+                    ('template_duration_seconds_total', 'counter',
+                     'Time spent rendering templates.', 'template_time',
+                     '%f'),
+                    ('n_plus_one_suspects_total', 'counter',
+                     'Requests repeating an SQL statement.', 'n_plus_one',
+                     '%d')):
+                lines.append('# HELP itemcatalog_%s %s' % (metric,
+                                                         description))
+                lines.append('# TYPE itemcatalog_%s %s' % (metric, kind))
+                for name, stats in endpoints:
+                    lines.append((
+                        'itemcatalog_%s{pid="%d",endpoint="%s"} ' + fmt) % (
+                            metric, pid, name, getattr(stats, attribute)))
+        return '\n'.join(lines) + '\n'
+
+
+def instrumentApp(app, engine, n_plus_one_threshold=5, profile_rate=0.0,
+                  profile_threshold=0.5, profile_dir='profiles',
+                  metrics_access='local'):
+    """Measure every request of an app and serve the totals from /metrics.
+
+    Args:
+        app                  (Flask): The app to instrument.
+        engine               (Engine): The engine of the app's database.
+        n_plus_one_threshold (int): How many runs of one statement in a
+                                    request flag it as N+1 queries.
+        profile_rate         (float): The fraction of requests to profile,
+                                      0 to turn profiling off.
+        profile_threshold    (float): The duration in seconds above which
+                                      a profiled request is saved.
+        profile_dir          (str): The directory to save profiles in.
+        metrics_access       (str): Who may read /metrics, one of
+                                    METRICS_ACCESS; 'local' answers 404
+                                    to clients on other hosts.
+
+    Returns:
+        RequestMetrics: The statistics collected.
+    """
+    if metrics_access not in METRICS_ACCESS:
+        raise ValueError('metrics_access must be one of %s, not %r' % (
+            ', '.join(METRICS_ACCESS), metrics_access))
+    metrics = RequestMetrics()
+
+    @app.before_request
+    def startRequest():
+        g.instrumentation = {
+            'start': timeit.default_timer(),
+            'sql_count': 0,
+            'sql_time': 0.0,
+            'template_time': 0.0,
+            'statements': Counter(),
+            'profiler': None,
+        }
+        if profile_rate and random.random() < profile_rate:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is active in this process
+                return
+            g.instrumentation['profiler'] = profiler
+
+    @app.after_request
+    def finishRequest(response):
+        timings = g.pop('instrumentation', None)
+        if timings is None:
+            return response
+        duration = timeit.default_timer() - timings['start']
+        endpoint = request.endpoint or 'unknown'
+
+        repeated = [(statement, count)
+                    for statement, count in timings['statements'].items()
+                    if count >= n_plus_one_threshold]
+        for statement, count in repeated:
+            app.logger.warning(
+                'Possible N+1 queries in %s: %d times %s', endpoint, count,
+                re.sub(r'\s+', ' ', statement)[:200])
+
+        profiler = timings['profiler']
+        if profiler is not None:
+            profiler.disable()
+            if duration >= profile_threshold:
+                if not os.path.isdir(profile_dir):
+                    os.makedirs(profile_dir)
+                path = os.path.join(profile_dir, '%s-%d-%dms.prof' % (
+                    endpoint, os.getpid(), duration * 1000))
+                profiler.dump_stats(path)
+                app.logger.info('Saved the profile of %s to %s',
+                                request.full_path, path)
+
+        metrics.record(endpoint, duration, timings['sql_count'],
+                       timings['sql_time'], timings['template_time'],
+                       bool(repeated))
+        response.headers['Server-Timing'] = ', '.join([
+            'app;dur=%.1f' % (duration * 1000),
+            'sql;dur=%.1f;desc="%d queries"' % (timings['sql_time'] * 1000,
+                                               timings['sql_count']),
+            'template;dur=%.1f' % (timings['template_time'] * 1000)])
+        return response
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def startStatement(conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault('statement_start', []).append(
+            timeit.default_timer())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def finishStatement(conn, cursor, statement, parameters, context,
+                        executemany):
+        elapsed = timeit.default_timer() - conn.info['statement_start'].pop()
+        timings = g.get('instrumentation') if has_app_context() else None
+        if timings is not None:
+            timings['sql_count'] += 1
+            timings['sql_time'] += elapsed
+            timings['statements'][statement] += 1
+
+    # Flask only sends template signals when blinker is installed
+    if signals_available:
+        @before_render_template.connect_via(app)
+        def startTemplate(sender, template, context, **extra):
+            timings = g.get('instrumentation')
+            if timings is not None:
+                timings['template_start'] = timeit.default_timer()
+
+        @template_rendered.connect_via(app)
+        def finishTemplate(sender, template, context, **extra):
+            timings = g.get('instrumentation')
+            if timings is not None and 'template_start' in timings:
+                timings['template_time'] += (timeit.default_timer() -
+                                             timings.pop('template_start'))
+
+    if metrics_access != 'off':
+        @app.route('/metrics')
+        def showMetrics():
+            """Return the request statistics of this process for Prometheus"""
+            if (metrics_access == 'local' and
+                    request.remote_addr not in LOCAL_ADDRESSES):
+                abort(404)
+            return Response(metrics.prometheus(),
+                            mimetype='text/plain; version=0.0.4')
+
+    return metrics
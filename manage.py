@@ -0,0 +1,423 @@
+"""
+    Maintenance commands for the item catalog database.
+
+    Usage:
+        python manage.py migrate
+        python manage.py compact-changes [--before REVISION]
+        python manage.py repair-counts
+        python manage.py import FILE --user-email EMAIL [--create-categories]
+        python manage.py export FILE
+        python manage.py generate [--users N] [--categories N] [--items N]
+                                  [--seed N] [--replace]
+
+    `migrate` brings an existing itemcatalog.db up to date with the schema
+    declared in database_setup.py without rebuilding its data. Every
+    migration step checks what is already in place, so it is safe to run
+    the command repeatedly.
+
+    `compact-changes` drops superseded entries from the change log served
+    by /api/v2/changes. With --before it also truncates the log up to that
+    revision; mirror clients that are further behind must reload the
+    catalog.
+
+    `repair-counts` recomputes the item counts stored on the categories
+    and the catalog, should they ever drift from the items.
+
+    `import` and `export` load and dump catalog items as CSV or NDJSON
+    files (chosen by file extension or --format); use - for stdin or
+    stdout. See bulk.py for the file layout.
+
+    `generate` fills an empty database with a synthetic catalog for load
+    testing, the same one for the same arguments (see generate.py). With
+    --replace it deletes the existing catalog first.
+"""
+from __future__ import print_function
+import argparse
+import sys
+from sqlalchemy import MetaData, bindparam, func, inspect, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import AddConstraint, CreateColumn, CreateIndex
+from sqlalchemy.schema import CreateTable
+from database_setup import Base, Item, SEARCH_INDEX_DDL, User, engine
+from database_setup import parsePrice, recreateTables
+from queries import compactChanges, repairItemCounts
+from cache import createPageCache
+from snapshots import createSnapshotCache
+import bulk
+import generate
+
+
+def migrateColumns(engine):
+    """Add the columns declared on the models that the database lacks.
+
+    New columns must be nullable or have a server default, so that the
+    existing rows get a value.
+
+    Args:
+        engine (Engine): The engine of the database to migrate.
+
+    Returns:
+        list: The names of the added columns.
+    """
+    inspector = inspect(engine)
+    added = []
+    for table in Base.metadata.sorted_tables:
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                    engine.dialect.identifier_preparer.format_table(table),
+                    CreateColumn(column).compile(dialect=engine.dialect)))
+                added.append('%s.%s' % (table.name, column.name))
+    return added
+
+
+def migratePrices(engine):
+    """Convert prices stored as text to the price_cents column.
+
+    Databases created before prices were stored in cents have a price text
+    column, which the app no longer reads. Prices that can't be converted
+    are reported and left empty.
+
+    Args:
+        engine (Engine): The engine of the database to migrate.
+
+    Returns:
+        list: A description of the converted prices, if there were any.
+    """
+    columns = inspect(engine).get_columns(Item.__tablename__)
+    if 'price' not in set(column['name'] for column in columns):
+        return []
+    rows = engine.execute(
+        "SELECT id, price FROM catalog_item WHERE price_cents IS NULL "
+        "AND price IS NOT NULL AND price != ''").fetchall()
+    prices = []
+    for item_id, price in rows:
+        try:
+            prices.append({'item_id': item_id, 'cents': parsePrice(price)})
+        except ValueError as e:
+            print('item %d: %s' % (item_id, e), file=sys.stderr)
+    if not prices:
+        return []
+    engine.execute(Item.__table__.update().where(
+        Item.id == bindparam('item_id')).values(
+            price_cents=bindparam('cents')), prices)
+    return ['%d prices' % len(prices)]
+
+
+def foreignKeyActions(engine, table):
+    """Return the ON DELETE action of each foreign key of a table.
+
+    SQLAlchemy doesn't reflect the actions of SQLite foreign keys, so they
+    are read with PRAGMA foreign_key_list there.
+
+    Args:
+        engine (Engine): The engine of the database.
+        table  (Table): The table.
+
+    Returns:
+        dict: The action, e.g. 'CASCADE' or 'NO ACTION', by column name.
+    """
+    if engine.dialect.name == 'sqlite':
+        return dict((row['from'], row['on_delete'].upper()) for row in
+                    engine.execute('PRAGMA foreign_key_list(%s)' % table.name))
+    return dict(
+        (fk['constrained_columns'][0],
+         (fk['options'].get('ondelete') or 'NO ACTION').upper())
+        for fk in inspect(engine).get_foreign_keys(table.name))
+
+
+def rebuildSqliteTable(engine, table):
+    """Recreate a SQLite table as declared, keeping its rows.
+
+    SQLite can't alter constraints, so the table is copied to a new table
+    and replaced by it in one transaction, with foreign key enforcement
+    off while the rows are moved. Indexes and search index triggers are
+    recreated.
+
+    Args:
+        engine (Engine): The engine of the database.
+        table  (Table): The declared table.
+
+    Raises:
+        IntegrityError: If rows reference rows that don't exist.
+    """
+    metadata = MetaData()
+    for other in Base.metadata.sorted_tables:
+        if other is not table:
+            other.tometadata(metadata)
+    new = table.tometadata(metadata, name=table.name + '_new')
+    columns = ', '.join(c.name for c in table.columns)
+    statements = [
+        str(CreateTable(new).compile(dialect=engine.dialect)),
+        'INSERT INTO %s (%s) SELECT %s FROM %s' % (
+            new.name, columns, columns, table.name),
+        'DROP TABLE %s' % table.name,
+        'ALTER TABLE %s RENAME TO %s' % (new.name, table.name),
+    ] + [str(CreateIndex(index).compile(dialect=engine.dialect))
+         for index in table.indexes]
+    if table is Item.__table__ and (
+            'catalog_item_fts' in inspect(engine).get_table_names()):
+        statements += SEARCH_INDEX_DDL
+
+    connection = engine.raw_connection()
+    try:
+        dbapi_connection = connection.connection
+        isolation_level = dbapi_connection.isolation_level
+        dbapi_connection.isolation_level = None
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA foreign_keys = OFF')
+        try:
+            cursor.execute('BEGIN')
+            for statement in statements:
+                cursor.execute(statement)
+            violations = cursor.execute(
+                'PRAGMA foreign_key_check(%s)' % table.name).fetchall()
+            if violations:
+                raise IntegrityError(
+                    'PRAGMA foreign_key_check', None, ValueError(
+                        '%d rows of %s reference missing rows' % (
+                            len(violations), table.name)))
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        finally:
+            cursor.execute('PRAGMA foreign_keys = ON')
+            dbapi_connection.isolation_level = isolation_level
+    finally:
+        connection.close()
+
+
+def migrateForeignKeys(engine):
+    """Add the ON DELETE actions declared on the item foreign keys.
+
+    Items are deleted by the database along with their category or user.
+    Run after migrateColumns and migratePrices: SQLite tables are rebuilt
+    with only the declared columns.
+
+    Args:
+        engine (Engine): The engine of the database to migrate.
+
+    Returns:
+        list: The changed foreign key columns.
+    """
+    table = Item.__table__
+    actions = foreignKeyActions(engine, table)
+    changed = sorted(
+        fk.parent.name for fk in table.foreign_keys if fk.ondelete and
+        actions.get(fk.parent.name) != fk.ondelete.upper())
+    if not changed:
+        return []
+    if engine.dialect.name == 'sqlite':
+        rebuildSqliteTable(engine, table)
+    else:
+        preparer = engine.dialect.identifier_preparer
+        with engine.begin() as connection:
+            for fk in inspect(engine).get_foreign_keys(table.name):
+                if fk['constrained_columns'][0] in changed:
+                    connection.execute('ALTER TABLE %s DROP CONSTRAINT %s' % (
+                        preparer.format_table(table),
+                        preparer.quote(fk['name'])))
+            for constraint in table.foreign_key_constraints:
+                if constraint.column_keys[0] in changed:
+                    connection.execute(AddConstraint(constraint))
+    return ['%s.%s' % (table.name, name) for name in changed]
+
+
+def migrateIndexes(engine):
+    """Create the indexes declared on the models that the database lacks.
+
+    Args:
+        engine (Engine): The engine of the database to migrate.
+
+    Returns:
+        list: The names of the created indexes.
+    """
+    inspector = inspect(engine)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                created.append(index.name)
+    if created:
+        # Give the query planner statistics for the new indexes
+        engine.execute('ANALYZE')
+    return created
+
+
+def migrateSearchIndex(engine):
+    """Create and fill the full-text search index if the database lacks it.
+
+    Only SQLite databases have a search index.
+
+    Args:
+        engine (Engine): The engine of the database to migrate.
+
+    Returns:
+        list: The name of the index if it was created.
+    """
+    if engine.dialect.name != 'sqlite':
+        return []
+    exists = 'catalog_item_fts' in inspect(engine).get_table_names()
+    with engine.begin() as connection:
+        for statement in SEARCH_INDEX_DDL:
+            connection.execute(statement)
+        if not exists:
+            connection.execute("INSERT INTO catalog_item_fts "
+                               "(catalog_item_fts) VALUES ('rebuild')")
+    return [] if exists else ['catalog_item_fts']
+
+
+def migrateItemCounts(engine):
+    """Fill in the stored item counts, e.g. after migrateColumns added them.
+
+    Args:
+        engine (Engine): The engine of the database to migrate.
+
+    Returns:
+        list: A description of the repaired counts, if any were wrong.
+    """
+    repaired = repairItemCounts(sessionmaker(bind=engine)())
+    return ['%d item counts' % repaired] if repaired else []
+
+
+# Migration steps in the order they are applied
+MIGRATIONS = [
+    migrateColumns,
+    migratePrices,
+    migrateForeignKeys,
+    migrateIndexes,
+    migrateSearchIndex,
+    migrateItemCounts,
+]
+
+
+def migrate(engine):
+    """Apply all migration steps to a database.
+
+    Args:
+        engine (Engine): The engine of the database to migrate.
+    """
+    Base.metadata.create_all(engine)
+    for step in MIGRATIONS:
+        try:
+            applied = step(engine)
+        except IntegrityError as e:
+            sys.exit('%s failed, fix the existing data first:\n%s'
+                     % (step.__name__, e.orig))
+        if applied:
+            print('%s: %s' % (step.__name__, ', '.join(applied)))
+        else:
+            print('%s: up to date' % step.__name__)
+
+
+def invalidateCategories(*tags):
+    """Make running app processes reload the categories and pages.
+
+    Only processes sharing the page cache through PAGE_CACHE_URL are
+    reached; others see the change when their cached copies expire.
+
+    Args:
+        tags (str): Page cache tags to invalidate as well.
+    """
+    pageCache = createPageCache()
+    createSnapshotCache(pageCache).invalidateCategories()
+    pageCache.invalidate('categories', *tags)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Maintenance commands for the item catalog database.')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('migrate', help='update the database schema')
+    compact = commands.add_parser('compact-changes',
+                                  help='shrink the change log')
+    compact.add_argument('--before', type=int, metavar='REVISION',
+                         help='also drop all changes up to this revision')
+    commands.add_parser('repair-counts',
+                        help='recompute the stored item counts')
+    load = commands.add_parser('import', help='import items from a file')
+    load.add_argument('file')
+    load.add_argument('--user-email', required=True,
+                      help='email address of the user owning the items')
+    load.add_argument('--create-categories', action='store_true',
+                      help='create categories that do not exist yet')
+    dump = commands.add_parser('export', help='export items to a file')
+    dump.add_argument('file')
+    synthetic = commands.add_parser(
+        'generate', help='fill the database with a synthetic catalog')
+    synthetic.add_argument('--users', type=int, default=10,
+                           help='number of users (default: %(default)s)')
+    synthetic.add_argument('--categories', type=int, default=50,
+                           help='number of categories (default: %(default)s)')
+    synthetic.add_argument('--items', type=int, default=100000,
+                           help='number of items (default: %(default)s)')
+    synthetic.add_argument('--seed', type=int, default=42,
+                           help='random seed (default: %(default)s)')
+    synthetic.add_argument('--batch-size', type=int,
+                           default=generate.DEFAULT_BATCH_SIZE,
+                           help='items per batch (default: %(default)s)')
+    synthetic.add_argument('--replace', action='store_true',
+                           help='delete the existing catalog first')
+    for command in (load, dump):
+        command.add_argument('--format', choices=['csv', 'ndjson'])
+        command.add_argument('--batch-size', type=int,
+                             default=bulk.DEFAULT_BATCH_SIZE,
+                             help='rows per batch (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'migrate':
+        migrate(engine)
+    elif args.command == 'compact-changes':
+        session = sessionmaker(bind=engine)()
+        removed = compactChanges(session, args.before)
+        print('Removed %d changes.' % removed)
+    elif args.command == 'repair-counts':
+        repaired = repairItemCounts(sessionmaker(bind=engine)())
+        invalidateCategories()
+        print('Repaired %d item counts.' % repaired)
+    elif args.command == 'import':
+        session = sessionmaker(bind=engine)()
+        user = session.query(User).filter_by(email=args.user_email).first()
+        session.close()
+        if user is None:
+            sys.exit('No user with email address %s.' % args.user_email)
+        with bulk.openData(args.file, 'r') as stream:
+            result = bulk.importItems(
+                engine,
+                bulk.readRows(stream, bulk.fileFormat(args.file,
+                                                      args.format)),
+                user.id, args.create_categories, args.batch_size)
+        invalidateCategories('items', *[
+            'category-items:%d' % c for c in result['category_ids']])
+        print('Imported %d items, rejected %d.' % (result['imported'],
+                                                  result['rejected']))
+    elif args.command == 'export':
+        with bulk.openData(args.file, 'w') as stream:
+            bulk.exportItems(engine, stream,
+                             bulk.fileFormat(args.file, args.format),
+                             args.batch_size)
+    elif args.command == 'generate':
+        if args.replace:
+            # Continue from the old revision so it never goes backwards
+            recreateTables(engine)
+        elif engine.execute(
+                select([func.count()]).select_from(User.__table__)).scalar():
+            sys.exit('The database is not empty, pass --replace to delete '
+                     'the existing catalog.')
+        revision = generate.generateCatalog(
+            engine, args.users, args.categories, args.items, args.seed,
+            args.batch_size)
+        createPageCache().backend.clear()
+        print('Generated %d users, %d categories and %d items at revision '
+              '%d.' % (args.users, args.categories, args.items, revision))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
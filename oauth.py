@@ -0,0 +1,613 @@
+"""
+    Google and Facebook login.
+
+    Each provider sends its API calls through its own requests.Session.
+    The session keeps a pool of kept-alive connections to the provider
+    between logins, and every call has a connect and a read timeout, so
+    a slow provider can't hold a request worker for long. The base URLs of
+    the provider APIs can be changed, so that a local stub server (see
+    oauth_stub.py) can stand in for Google and Facebook in load tests.
+
+    The settings are read and checked once, by a ProviderRegistry, which
+    reads them again on SIGHUP or, if asked to watch them, when a client
+    secrets file changes.
+
+    A LoginQueue runs logins on a thread pool of their own. The login
+    request then returns right away, and the browser polls for the result
+    instead of keeping a request worker waiting on the provider.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import signal
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
+from database_setup import envSetting
+
+
+GOOGLE_API_URL = 'https://www.googleapis.com'
+GOOGLE_TOKEN_URL = 'https://oauth2.googleapis.com/token'
+GOOGLE_ACCOUNTS_URL = 'https://accounts.google.com'
+FACEBOOK_GRAPH_URL = 'https://graph.facebook.com'
+FACEBOOK_API_VERSION = 'v3.1'
+
+
+class LoginError(Exception):
+    """A login that failed or that the provider rejected
+
+    Attributes:
+        message (str): the reason, shown to the user
+        status  (int): the HTTP status to answer the login request with
+    """
+
+    def __init__(self, message, status=401):
+        Exception.__init__(self, message)
+        self.message = message
+        self.status = status
+
+
+def createHttpSession(pool_size=10):
+    """Create an HTTP session keeping connections to a provider alive.
+
+    Args:
+        pool_size (int): The number of connections kept open per host.
+
+    Returns:
+        requests.Session: The session.
+    """
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    return http
+
+
+class Provider(object):
+    """Base class of the login providers
+
+    Attributes:
+        name    (str): 'google' or 'facebook'
+        http    (requests.Session): the session API calls are made with
+        timeout (tuple): connect and read timeout of every call, in seconds
+    """
+    name = None
+
+    def __init__(self, http=None, timeout=(3, 10)):
+        self.http = http or createHttpSession()
+        self.timeout = timeout
+
+    def call(self, method, url, **kwargs):
+        """Call the provider API and decode the JSON it answers with.
+
+        Args:
+            method (str): The HTTP method.
+            url    (str): The URL of the API.
+            kwargs (dict): Further arguments of requests.Session.request.
+
+        Returns:
+            tuple: (HTTP status, decoded JSON or None)
+
+        Raises:
+            LoginError: If the provider could not be reached in time.
+        """
+        try:
+            response = self.http.request(
+                method, url, timeout=self.timeout, **kwargs)
+        except requests.RequestException:
+            raise LoginError('%s could not be reached.' % self.name.title(),
+                             502)
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+
+
+def idTokenClaims(id_token):
+    """Return the claims of an OpenID Connect ID token.
+
+    The signature is not checked: the token comes straight from Google's
+    token endpoint over HTTPS.
+
+    Args:
+        id_token (str): The ID token, a JSON Web Token.
+
+    Returns:
+        dict: The claims.
+
+    Raises:
+        LoginError: If the token can't be decoded.
+    """
+    try:
+        payload = id_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(
+            payload.encode('ascii')).decode('utf-8'))
+    except (AttributeError, IndexError, TypeError, ValueError):
+        raise LoginError('Failed to upgrade the authorization code.')
+
+
+class GoogleProvider(Provider):
+    """Google sign-in, with the one-time code sent by the login page
+
+    Attributes:
+        client_id     (str): the OAuth client id of the app
+        client_secret (str): the OAuth client secret of the app
+        api_url       (str): base URL of the token info and user info APIs
+        accounts_url  (str): base URL of the token revocation API
+        token_url     (str): URL of the token endpoint, the token_uri of
+                             the client secrets file
+    """
+    name = 'google'
+
+    def __init__(self, client_id, client_secret, api_url=GOOGLE_API_URL,
+                 accounts_url=GOOGLE_ACCOUNTS_URL,
+                 token_url=GOOGLE_TOKEN_URL, http=None, timeout=(3, 10)):
+        Provider.__init__(self, http, timeout)
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.api_url = api_url.rstrip('/')
+        self.accounts_url = accounts_url.rstrip('/')
+        self.token_url = token_url
+
+    def login(self, code):
+        """Exchange a one-time code for an access token and the user.
+
+        Args:
+            code (str): The one-time authorization code.
+
+        Returns:
+            dict: The user's profile: provider, username, email, picture,
+                  access_token and gplus_id.
+
+        Raises:
+            LoginError: If the code or the token is not valid.
+        """
+        # Upgrade the authorization code into an access token
+        status, token = self.call(
+            'POST', self.token_url, data={
+                'code': code,
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+                'redirect_uri': 'postmessage',
+                'grant_type': 'authorization_code'})
+        if status != 200 or not token or 'access_token' not in token:
+            raise LoginError('Failed to upgrade the authorization code.')
+        access_token = token['access_token']
+        gplus_id = idTokenClaims(token.get('id_token')).get('sub')
+
+        # Check that the access token is valid.
+        status, result = self.call(
+            'GET', self.api_url + '/oauth2/v1/tokeninfo',
+            params={'access_token': access_token})
+        if result is None:
+            raise LoginError('Invalid token info.', 500)
+        if result.get('error') is not None:
+            raise LoginError(result.get('error'), 500)
+        # Verify that the access token is used for the intended user.
+        if result.get('user_id') != gplus_id:
+            raise LoginError("Token's user ID doesn't match given user ID.")
+        # Verify that the access token is valid for this app.
+        if result.get('issued_to') != self.client_id:
+            raise LoginError("Token's client ID does not match app's.")
+
+        status, data = self.call(
+            'GET', self.api_url + '/oauth2/v1/userinfo',
+            params={'access_token': access_token, 'alt': 'json'})
+        if status != 200 or not data or 'email' not in data:
+            raise LoginError('Failed to get the user info.', 502)
+        return {
+            'provider': self.name,
+            'username': data.get('name') or data['email'].split('@')[0],
+            'email': data['email'],
+            'picture': data.get('picture'),
+            'access_token': access_token,
+            'gplus_id': gplus_id,
+        }
+
+    def revoke(self, access_token):
+        """Revoke an access token.
+
+        Args:
+            access_token (str): The token.
+
+        Returns:
+            bool: Whether Google revoked the token.
+        """
+        try:
+            status, _ = self.call(
+                'GET', self.accounts_url + '/o/oauth2/revoke',
+                params={'token': access_token})
+        except LoginError:
+            return False
+        return status == 200
+
+
+class FacebookProvider(Provider):
+    """Facebook login, with the access token sent by the login page
+
+    The token is checked with the app secret before it is used: Graph API
+    debug_token must report it valid and issued to this app, so a token
+    the user gave another app can't log in here, and the profile is read
+    with an appsecret_proof of it.
+
+    Attributes:
+        app_id     (str): the Facebook app id
+        app_secret (str): the Facebook app secret
+        graph_url  (str): base URL of the Graph API
+    """
+    name = 'facebook'
+
+    def __init__(self, app_id, app_secret, graph_url=FACEBOOK_GRAPH_URL,
+                 http=None, timeout=(3, 10)):
+        Provider.__init__(self, http, timeout)
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.graph_url = graph_url.rstrip('/')
+
+    def login(self, access_token):
+        """Look up the user an access token belongs to.
+
+        Args:
+            access_token (str): The access token.
+
+        Returns:
+            dict: The user's profile: provider, username, email, picture,
+                  access_token and facebook_id.
+
+        Raises:
+            LoginError: If the token is not valid or not one of this app.
+        """
+        status, debug = self.call(
+            'GET', '%s/%s/debug_token' % (self.graph_url,
+                                          FACEBOOK_API_VERSION),
+            params={'input_token': access_token,
+                    'access_token': '%s|%s' % (self.app_id,
+                                               self.app_secret)})
+        token = (debug or {}).get('data') or {}
+        if status != 200 or not token.get('is_valid'):
+            raise LoginError('Invalid access token.')
+        if '%s' % token.get('app_id') != '%s' % self.app_id:
+            raise LoginError("Token's app ID does not match app's.")
+
+        status, data = self.call(
+            'GET', '%s/%s/me' % (self.graph_url, FACEBOOK_API_VERSION),
+            params={'fields': 'id,name,email,picture',
+                    'access_token': access_token,
+                    'appsecret_proof': self.appSecretProof(access_token)})
+        if status != 200 or not data or 'email' not in data:
+            raise LoginError('Failed to get the user info.')
+        if '%s' % data.get('id') != '%s' % token.get('user_id'):
+            raise LoginError("Token's user ID doesn't match given user ID.")
+        return {
+            'provider': self.name,
+            'username': data.get('name') or data['email'].split('@')[0],
+            'email': data['email'],
+            'picture': data.get('picture', {}).get('data', {}).get('url'),
+            'access_token': access_token,
+            'facebook_id': data['id'],
+        }
+
+    def appSecretProof(self, access_token):
+        """Return the appsecret_proof of an access token.
+
+        Args:
+            access_token (str): The user's access token.
+
+        Returns:
+            str: The HMAC-SHA256 of the token keyed with the app secret.
+        """
+        return hmac.new(self.app_secret.encode('utf-8'),
+                        access_token.encode('utf-8'),
+                        hashlib.sha256).hexdigest()
+
+    def revoke(self, facebook_id, access_token):
+        """Revoke the app's permissions of a user.
+
+        Args:
+            facebook_id  (str): The id of the user.
+            access_token (str): The user's access token.
+
+        Returns:
+            bool: Whether Facebook revoked the permissions.
+        """
+        try:
+            status, _ = self.call(
+                'DELETE', '%s/%s/permissions' % (self.graph_url, facebook_id),
+                params={'access_token': access_token,
+                    'appsecret_proof': self.appSecretProof(access_token)})
+        except LoginError:
+            return False
+        return status == 200
+
+
+GOOGLE_SECRETS_FILE = 'client_secrets.json'
+FACEBOOK_SECRETS_FILE = 'fb_client_secrets.json'
+
+
+def readSecrets(path, keys):
+    """Read the "web" settings of a client secrets file.
+
+    Args:
+        path (str): The path of the JSON file.
+        keys (list): The settings that must be set.
+
+    Returns:
+        dict: The settings.
+
+    Raises:
+        ValueError: If the file can't be read or a setting is missing.
+    """
+    try:
+        with open(path) as f:
+            settings = json.load(f)['web']
+    except (IOError, OSError, KeyError, TypeError, ValueError) as e:
+        raise ValueError('Can\'t read %s: %s' % (path, e))
+    for key in keys:
+        if not settings.get(key):
+            raise ValueError('%s has no %s' % (path, key))
+    return settings
+
+
+def providerUrl(name, default):
+    """Return a provider base URL from the environment.
+
+    Args:
+        name    (str): The name of the environment variable.
+        default (str): The URL to use when the variable is not set.
+
+    Returns:
+        str: The URL.
+
+    Raises:
+        ValueError: If the URL is not an http or https URL.
+    """
+    url = os.environ.get(name) or default
+    if not url.startswith(('http://', 'https://')):
+        raise ValueError('%s must be an http or https URL' % name)
+    return url
+
+
+def loadProviderSettings(google_path=GOOGLE_SECRETS_FILE,
+                         facebook_path=FACEBOOK_SECRETS_FILE):
+    """Read and check the login provider settings from the client secret
+    files and the environment:
+        GOOGLE_TOKEN_URL      (str): URL of the Google token endpoint
+                                     (default: token_uri of the client
+                                     secrets file)
+        GOOGLE_API_URL        (str): base URL of the Google token info and
+                                     user info APIs
+        GOOGLE_ACCOUNTS_URL   (str): base URL of Google's token revocation
+        FACEBOOK_GRAPH_URL    (str): base URL of the Facebook Graph API
+        OAUTH_CONNECT_TIMEOUT (int): seconds to wait for a connection to a
+                                     provider (default: 3)
+        OAUTH_READ_TIMEOUT    (int): seconds to wait for a provider's answer
+                                     (default: 10)
+        OAUTH_POOL_SIZE       (int): connections kept open to each provider
+                                     (default: 10)
+
+    Args:
+        google_path   (str): The Google client secrets file.
+        facebook_path (str): The Facebook client secrets file.
+
+    Returns:
+        dict: provider name -> keyword arguments of its class.
+
+    Raises:
+        ValueError: If a setting is missing or invalid.
+    """
+    google = readSecrets(google_path,
+                         ['client_id', 'client_secret', 'token_uri'])
+    facebook = readSecrets(facebook_path, ['app_id', 'app_secret'])
+    timeout = (envSetting('OAUTH_CONNECT_TIMEOUT', 3),
+               envSetting('OAUTH_READ_TIMEOUT', 10))
+    pool_size = envSetting('OAUTH_POOL_SIZE', 10)
+    if min(timeout) <= 0 or pool_size <= 0:
+        raise ValueError('OAuth timeouts and pool size must be positive')
+    return {
+        'google': {
+            'client_id': google['client_id'],
+            'client_secret': google['client_secret'],
+            'api_url': providerUrl('GOOGLE_API_URL', GOOGLE_API_URL),
+            'accounts_url': providerUrl('GOOGLE_ACCOUNTS_URL',
+                                        GOOGLE_ACCOUNTS_URL),
+            'token_url': providerUrl('GOOGLE_TOKEN_URL',
+                                     google['token_uri']),
+            'pool_size': pool_size,
+            'timeout': timeout},
+        'facebook': {
+            'app_id': facebook['app_id'],
+            'app_secret': facebook['app_secret'],
+            'graph_url': providerUrl('FACEBOOK_GRAPH_URL',
+                                     FACEBOOK_GRAPH_URL),
+            'pool_size': pool_size,
+            'timeout': timeout},
+    }
+
+
+def createProviders(settings):
+    """Create the login providers.
+
+    Args:
+        settings (dict): The settings returned by loadProviderSettings.
+
+    Returns:
+        dict: provider name -> Provider.
+    """
+    providers = {}
+    for kind in (GoogleProvider, FacebookProvider):
+        options = dict(settings[kind.name])
+        options['http'] = createHttpSession(options.pop('pool_size'))
+        providers[kind.name] = kind(**options)
+    return providers
+
+
+class ProviderRegistry(object):
+    """The login providers, created once from their settings
+
+    Logins only look the providers up, without touching the filesystem.
+    reload() reads the settings again and swaps in new providers; invalid
+    settings are logged and the running providers kept.
+
+    Attributes:
+        paths    (tuple): the Google and Facebook client secrets files
+        settings (dict): the settings the providers were created with
+        logger   (Logger): where failed reloads are reported
+    """
+
+    def __init__(self, google_path=GOOGLE_SECRETS_FILE,
+                 facebook_path=FACEBOOK_SECRETS_FILE, logger=None):
+        self.paths = (google_path, facebook_path)
+        self.logger = logger
+        # Reentrant: the SIGHUP handler may run while a reload is going on
+        self._lock = threading.RLock()
+        self._mtimes = self._readMtimes()
+        self.settings = loadProviderSettings(*self.paths)
+        self._providers = createProviders(self.settings)
+
+    def __getitem__(self, name):
+        return self._providers[name]
+
+    def _readMtimes(self):
+        mtimes = []
+        for path in self.paths:
+            try:
+                mtimes.append(os.path.getmtime(path))
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def reload(self):
+        """Read the settings again and replace the providers.
+
+        Returns:
+            bool: Whether the new settings were valid and are used now.
+        """
+        with self._lock:
+            self._mtimes = self._readMtimes()
+            try:
+                settings = loadProviderSettings(*self.paths)
+            except ValueError as e:
+                if self.logger:
+                    self.logger.error('Login providers not reloaded: %s', e)
+                return False
+            self._providers = createProviders(settings)
+            self.settings = settings
+            if self.logger:
+                self.logger.info('Login providers reloaded')
+            return True
+
+    def reloadIfChanged(self):
+        """Reload the settings if a client secrets file was modified.
+
+        Returns:
+            bool: Whether the providers were replaced.
+        """
+        with self._lock:
+            if self._readMtimes() == self._mtimes:
+                return False
+            return self.reload()
+
+    def watch(self, interval):
+        """Check the client secrets files for changes in the background.
+
+        Args:
+            interval (float): Seconds between checks.
+
+        Returns:
+            Thread: The watcher thread.
+        """
+        def check():
+            while True:
+                time.sleep(interval)
+                self.reloadIfChanged()
+        thread = threading.Thread(target=check, name='provider-watcher')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def reloadOnSignal(self, signal_number=None):
+        """Reload the settings when the process receives SIGHUP.
+
+        Only possible from the main thread, and where SIGHUP exists.
+
+        Args:
+            signal_number (int): The signal to reload on (default: SIGHUP).
+
+        Returns:
+            bool: Whether the signal handler was installed.
+        """
+        signal_number = signal_number or getattr(signal, 'SIGHUP', None)
+        if signal_number is None:
+            return False
+        try:
+            signal.signal(signal_number, lambda *args: self.reload())
+        except ValueError:
+            return False
+        return True
+
+
+class LoginQueue(object):
+    """Logins running on a thread pool, polled for by id
+
+    The pool is started with the first login, so it is created in the
+    process that serves the requests.
+
+    Attributes:
+        workers (int): the number of logins run at the same time
+        ttl     (int): seconds a login result is kept for its poll
+    """
+
+    def __init__(self, workers, ttl=300):
+        self.workers = workers
+        self.ttl = ttl
+        self._pool = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, login, credential):
+        """Start a login.
+
+        Args:
+            login      (function): The provider's login method.
+            credential (str): The code or token to log in with.
+
+        Returns:
+            str: The id to poll the login with.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            for expired in [key for key, (_, started) in self._jobs.items()
+                            if started + self.ttl < now]:
+                del self._jobs[expired]
+            self._jobs[job_id] = (
+                self._pool.apply_async(login, (credential,)), now)
+        return job_id
+
+    def result(self, job_id):
+        """Return the profile of a finished login and forget the login.
+
+        Args:
+            job_id (str): The id returned by submit.
+
+        Returns:
+            dict: The profile, or None while the login is running.
+
+        Raises:
+            KeyError: If there is no such login.
+            LoginError: If the login failed.
+        """
+        with self._lock:
+            result = self._jobs[job_id][0]
+            if not result.ready():
+                return None
+            del self._jobs[job_id]
+        return result.get()
@@ -0,0 +1,158 @@
+"""
+    Local stand-in for the Google and Facebook login APIs.
+
+    The stub answers the calls made by oauth.py like the real providers do
+    and accepts every code and token: the code or token "alice" logs in
+    "stub-alice@example.com". Every answer can be delayed to play a
+    provider on the other side of the internet. Point the app at the stub
+    to load test logins without real accounts:
+
+        python oauth_stub.py --port 8001 --latency 200
+        GOOGLE_API_URL=http://localhost:8001 \\
+            GOOGLE_TOKEN_URL=http://localhost:8001/oauth2/v3/token \\
+            GOOGLE_ACCOUNTS_URL=http://localhost:8001 \\
+            FACEBOOK_GRAPH_URL=http://localhost:8001 python application.py
+"""
+from __future__ import print_function
+import argparse
+import base64
+import json
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+from oauth import FACEBOOK_API_VERSION
+
+
+def stubIdToken(subject):
+    """Return an unsigned ID token for a user id."""
+    def encode(data):
+        return base64.urlsafe_b64encode(
+            json.dumps(data).encode('utf-8')).decode('ascii').rstrip('=')
+    return '%s.%s.' % (encode({'alg': 'none'}), encode({'sub': subject}))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers the provider API calls"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        args = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        token = args.get('access_token', '')
+        if url.path == '/oauth2/v1/tokeninfo':
+            if not token.startswith('stub-token-'):
+                return self.answer({'error': 'invalid_token'}, 400)
+            return self.answer({'user_id': token[len('stub-token-'):],
+                                'issued_to': self.server.client_id})
+        if url.path == '/oauth2/v1/userinfo':
+            name = token[len('stub-token-'):]
+            return self.answer({'name': 'Stub %s' % name, 'picture': '',
+                                'email': 'stub-%s@example.com' % name})
+        if url.path == '/%s/debug_token' % FACEBOOK_API_VERSION:
+            return self.answer({'data': {
+                'app_id': self.server.app_id, 'is_valid': True,
+                'user_id': args.get('input_token', '')}})
+        if url.path == '/%s/me' % FACEBOOK_API_VERSION:
+            return self.answer({'id': token, 'name': 'Stub %s' % token,
+                                'email': 'stub-%s@example.com' % token,
+                                'picture': {'data': {'url': ''}}})
+        if url.path == '/o/oauth2/revoke':
+            return self.answer({})
+        self.answer({'error': 'not_found'}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        if self.path == '/oauth2/v3/token' and form.get('code'):
+            code = form['code'][0]
+            return self.answer({'access_token': 'stub-token-' + code,
+                                'id_token': stubIdToken(code),
+                                'token_type': 'Bearer', 'expires_in': 3600})
+        self.answer({'error': 'invalid_grant'}, 400)
+
+    def do_DELETE(self):
+        if urlparse(self.path).path.endswith('/permissions'):
+            return self.answer({'success': True})
+        self.answer({'error': 'not_found'}, 404)
+
+    def answer(self, data, status=200):
+        time.sleep(self.server.latency)
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """The stub provider, one thread per connection
+
+    Attributes:
+        client_id (str): the Google client id the tokens are issued to
+        app_id    (str): the Facebook app id the tokens are issued to
+        latency   (float): seconds every answer is delayed by
+    """
+    daemon_threads = True
+
+    def __init__(self, address, client_id, app_id=None, latency=0.0):
+        HTTPServer.__init__(self, address, StubHandler)
+        self.client_id = client_id
+        self.app_id = app_id
+        self.latency = latency
+
+    @property
+    def url(self):
+        """The base URL of the stub"""
+        return 'http://%s:%d' % self.server_address[:2]
+
+
+def startStubServer(client_id, latency=0.0, port=0, app_id=None):
+    """Serve the stub provider from a background thread.
+
+    Args:
+        client_id (str): The Google client id of the app.
+        latency   (float): Seconds every answer is delayed by.
+        port      (int): The port to listen on, 0 for any free port.
+        app_id    (str): The Facebook app id of the app.
+
+    Returns:
+        StubServer: The running server; call shutdown() to stop it.
+    """
+    server = StubServer(('127.0.0.1', port), client_id, app_id, latency)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Stand in for the Google and Facebook login APIs.')
+    parser.add_argument('--port', type=int, default=8001,
+                        help='port to listen on (default: 8001)')
+    parser.add_argument('--latency', type=int, default=0,
+                        help='milliseconds to delay every answer by')
+    args = parser.parse_args(argv)
+    with open('client_secrets.json') as f:
+        client_id = json.load(f)['web']['client_id']
+    with open('fb_client_secrets.json') as f:
+        app_id = json.load(f)['web']['app_id']
+    server = StubServer(('127.0.0.1', args.port), client_id, app_id,
+                        args.latency / 1000.0)
+    print('Stub provider listening on %s' % server.url)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
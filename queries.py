@@ -0,0 +1,535 @@
+"""
+    Query helpers shared by the catalog views.
+
+    List pages render the category of every item, so the queries here load
+    the related rows up front instead of leaving them to lazy loading.
+    Item lists are paged by keyset, on Item.id or on (price, id), rather
+    than by offset.
+"""
+from datetime import datetime
+from sqlalchemy import and_, exists, func, or_, select
+from sqlalchemy.orm import aliased, joinedload
+from database_setup import Category, Item, CatalogState, CatalogChange
+
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Changes returned per request of the change log
+DEFAULT_CHANGE_BATCH = 100
+MAX_CHANGE_BATCH = 1000
+
+# Rows fetched per round trip when streaming the whole catalog
+STREAM_BATCH_SIZE = 1000
+
+
+class ItemPage(object):
+    """A page of catalog items
+
+    Attributes:
+        items          (list): the items on this page, newest first
+        limit          (int): the page size
+        next_before_id (int): cursor for the next (older) page, or None
+        prev_before_id (int): cursor for the previous (newer) page, None
+                              when the previous page is the first one
+        has_prev       (bool): whether there is a previous page
+        sort           (str): 'newest' or 'price' (cheapest first)
+        next_after     (tuple): (price_cents, id) cursor for the next page
+                                of a 'price' page, or None
+        prev_after     (tuple): (price_cents, id) cursor for the previous
+                                page of a 'price' page, None when the
+                                previous page is the first one
+    """
+
+    def __init__(self, items, limit, next_before_id=None,
+                 prev_before_id=None, has_prev=False, sort='newest'):
+        self.items = items
+        self.limit = limit
+        self.next_before_id = next_before_id
+        self.prev_before_id = prev_before_id
+        self.has_prev = has_prev
+        self.sort = sort
+        self.next_after = None
+        self.prev_after = None
+
+    @property
+    def next_args(self):
+        """The query string arguments selecting the next page, or None"""
+        if self.next_after is not None:
+            return {'after_price': self.next_after[0],
+                    'after_id': self.next_after[1]}
+        if self.next_before_id is not None:
+            return {'before_id': self.next_before_id}
+        return None
+
+    @property
+    def prev_args(self):
+        """The query string arguments selecting the previous page, or None"""
+        if not self.has_prev:
+            return None
+        if self.prev_after is not None:
+            return {'after_price': self.prev_after[0],
+                    'after_id': self.prev_after[1]}
+        if self.prev_before_id is not None:
+            return {'before_id': self.prev_before_id}
+        return {}
+
+
+def itemListQuery(session, category_id=None):
+    """Return a query for the items shown on a catalog list page.
+
+    The category of each item is loaded in the same SELECT, so rendering
+    the list costs a constant number of queries however many items it has.
+
+    Args:
+        session     (Session): The database session to query with.
+        category_id (int): Only return items of this category (optional).
+
+    Returns:
+        Query: The items, most recently added first.
+    """
+    items = session.query(Item).options(joinedload(Item.category))
+    if category_id is not None:
+        items = items.filter(Item.category_id == category_id)
+    return items.order_by(Item.id.desc())
+
+
+def itemDetailQuery(session, catalog_item_id):
+    """Return a query for a single item together with its category.
+
+    Args:
+        session         (Session): The database session to query with.
+        catalog_item_id (int): The id of the item.
+
+    Returns:
+        Query: The item with its category eagerly loaded.
+    """
+    return session.query(Item).options(
+        joinedload(Item.category)).filter(Item.id == catalog_item_id)
+
+
+def pageSize(limit, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """Clamp a requested page size to the allowed range.
+
+    Args:
+        limit   (int): The requested page size, None for the default.
+        default (int): The page size used when none was requested.
+        maximum (int): The largest allowed page size.
+
+    Returns:
+        int: A page size between 1 and maximum.
+    """
+    if limit is None:
+        return default
+    return max(1, min(limit, maximum))
+
+
+def priceRange(query, min_price=None, max_price=None):
+    """Filter an item query by price.
+
+    Args:
+        query     (Query): The query to filter.
+        min_price (int): The lowest price in cents (optional).
+        max_price (int): The highest price in cents (optional).
+
+    Returns:
+        Query: The filtered query.
+    """
+    if min_price is not None:
+        query = query.filter(Item.price_cents >= min_price)
+    if max_price is not None:
+        query = query.filter(Item.price_cents <= max_price)
+    return query
+
+
+def itemPage(session, category_id=None, before_id=None, limit=None,
+             min_price=None, max_price=None):
+    """Return one page of catalog items, newest first.
+
+    Pages are selected by keyset on Item.id: a page holds the newest items
+    with an id below before_id, so every page costs an indexed range scan
+    however deep into the catalog it is.
+
+    Args:
+        session     (Session): The database session to query with.
+        category_id (int): Only return items of this category (optional).
+        before_id   (int): Only return items older than this id (optional).
+        limit       (int): The requested page size (optional).
+        min_price   (int): The lowest price in cents (optional).
+        max_price   (int): The highest price in cents (optional).
+
+    Returns:
+        ItemPage: The requested page.
+    """
+    limit = pageSize(limit)
+    items = priceRange(itemListQuery(session, category_id),
+                       min_price, max_price)
+    if before_id is not None:
+        items = items.filter(Item.id < before_id)
+    items = items.limit(limit + 1).all()
+
+    page = ItemPage(items[:limit], limit)
+    if len(items) > limit:
+        page.next_before_id = items[limit - 1].id
+
+    if before_id is not None:
+        # The previous page ends with the newest `limit` items at or above
+        # before_id; one id past those marks where it starts.
+        newer = priceRange(session.query(Item.id).filter(
+            Item.id >= before_id), min_price, max_price)
+        if category_id is not None:
+            newer = newer.filter(Item.category_id == category_id)
+        newer = [row.id for row in
+                 newer.order_by(Item.id.asc()).limit(limit + 1)]
+        page.has_prev = len(newer) > 0
+        if len(newer) > limit:
+            page.prev_before_id = newer[limit]
+    return page
+
+
+def cheapestItemPage(session, category_id=None, after=None, limit=None,
+                     min_price=None, max_price=None):
+    """Return one page of catalog items, cheapest first.
+
+    Pages are selected by keyset on (price_cents, id), which the price
+    indexes cover, in the same way itemPage() pages on id. Items without
+    a price are left out.
+
+    Args:
+        session     (Session): The database session to query with.
+        category_id (int): Only return items of this category (optional).
+        after       (tuple): Only return items after this (price_cents, id)
+                             (optional).
+        limit       (int): The requested page size (optional).
+        min_price   (int): The lowest price in cents (optional).
+        max_price   (int): The highest price in cents (optional).
+
+    Returns:
+        ItemPage: The requested page.
+    """
+    def keyset(query):
+        query = priceRange(query.filter(Item.price_cents.isnot(None)),
+                           min_price, max_price)
+        if category_id is not None:
+            query = query.filter(Item.category_id == category_id)
+        return query
+
+    limit = pageSize(limit)
+    items = keyset(session.query(Item).options(joinedload(Item.category)))
+    if after is not None:
+        items = items.filter(Item.price_cents >= after[0], or_(
+            Item.price_cents > after[0], Item.id > after[1]))
+    items = items.order_by(Item.price_cents.asc(), Item.id.asc()).limit(
+        limit + 1).all()
+
+    page = ItemPage(items[:limit], limit, sort='price')
+    if len(items) > limit:
+        page.next_after = (items[limit - 1].price_cents, items[limit - 1].id)
+
+    if after is not None:
+        # The previous page ends with the `limit` items at or below after;
+        # the key one past those marks where it starts.
+        cheaper = keyset(session.query(Item.price_cents, Item.id)).filter(
+            Item.price_cents <= after[0], or_(
+                Item.price_cents < after[0], Item.id <= after[1]))
+        cheaper = cheaper.order_by(Item.price_cents.desc(),
+                                   Item.id.desc()).limit(limit + 1).all()
+        page.has_prev = len(cheaper) > 0
+        if len(cheaper) > limit:
+            page.prev_after = tuple(cheaper[limit])
+    return page
+
+
+def itemCount(session, category_id=None):
+    """Return the number of items in the catalog or in a category.
+
+    Reads the counts kept up to date by adjustItemCounts() instead of
+    counting rows.
+
+    Args:
+        session     (Session): The database session to query with.
+        category_id (int): Only count items of this category (optional).
+
+    Returns:
+        int: The number of items.
+    """
+    if category_id is None:
+        return session.query(CatalogState.item_count).filter(
+            CatalogState.id == 1).scalar()
+    return session.query(Category.item_count).filter(
+        Category.id == category_id).scalar()
+
+
+def adjustItemCounts(session, category_id, delta, total_delta=None):
+    """Update the stored item counts as part of the current transaction.
+
+    Every write adding, moving or removing items calls this before
+    committing. The counts are changed with UPDATE ... SET item_count =
+    item_count + delta, so concurrent writes don't overwrite each other.
+
+    Args:
+        session     (Session): The session holding the write.
+        category_id (int): The category whose count changes, None to only
+                           change the catalog total.
+        delta       (int): The number of items added, negative if removed.
+        total_delta (int): The change of the catalog total, if it differs
+                           from delta (0 for items moved between
+                           categories).
+    """
+    if category_id is not None and delta:
+        session.query(Category).filter(Category.id == category_id).update(
+            {Category.item_count: Category.item_count + delta},
+            synchronize_session=False)
+    total_delta = delta if total_delta is None else total_delta
+    if total_delta:
+        session.query(CatalogState).filter(CatalogState.id == 1).update(
+            {CatalogState.item_count: CatalogState.item_count + total_delta},
+            synchronize_session=False)
+
+
+def repairItemCounts(session):
+    """Recompute the stored item counts from the items and commit.
+
+    Repaired counts advance the catalog revision, so that pages and
+    fragments keyed on it show them.
+
+    Args:
+        session (Session): The database session to use.
+
+    Returns:
+        int: The number of counts that were wrong.
+    """
+    counts = select([func.count(Item.id)]).where(
+        Item.category_id == Category.id).as_scalar()
+    repaired = session.query(Category).filter(
+        Category.item_count != counts).update(
+            {Category.item_count: counts}, synchronize_session=False)
+    total = session.query(func.count(Item.id)).scalar()
+    repaired += session.query(CatalogState).filter(
+        CatalogState.id == 1, CatalogState.item_count != total).update(
+            {CatalogState.item_count: total}, synchronize_session=False)
+    if repaired:
+        bumpRevision(session)
+    session.commit()
+    return repaired
+
+
+def catalogRevision(session):
+    """Return the current catalog revision.
+
+    Args:
+        session (Session): The database session to query with.
+
+    Returns:
+        tuple: (revision, time of the last write)
+    """
+    return session.query(
+        CatalogState.revision, CatalogState.updated_at).filter(
+            CatalogState.id == 1).one()
+
+
+def bumpRevision(session, count=1):
+    """Advance the catalog revision as part of the current transaction.
+
+    Write handlers call recordChange(), which also logs the change.
+
+    Args:
+        session (Session): The session holding the write.
+        count   (int): The number of revisions to advance by.
+
+    Returns:
+        int: The new catalog revision.
+    """
+    session.query(CatalogState).filter(CatalogState.id == 1).update({
+        CatalogState.revision: CatalogState.revision + count,
+        CatalogState.updated_at: datetime.utcnow()},
+        synchronize_session=False)
+    return session.query(CatalogState.revision).filter(
+        CatalogState.id == 1).scalar()
+
+
+def recordChange(session, entity, entity_id, action):
+    """Log an item or category change as part of the current transaction.
+
+    Every item or category write calls this before committing and stores
+    the result in the revision of the row it changed. Deleting a category
+    logs only the category delete, which implies its items are gone too.
+
+    Args:
+        session   (Session): The session holding the write.
+        entity    (str): 'item' or 'category'.
+        entity_id (int): The id of the changed row, flushed if it is new.
+        action    (str): 'create', 'update' or 'delete'.
+
+    Returns:
+        int: The catalog revision of the change.
+    """
+    revision = bumpRevision(session)
+    session.add(CatalogChange(revision=revision, entity=entity,
+                              entity_id=entity_id, action=action))
+    return revision
+
+
+def recordChanges(session, entity, entity_ids, action):
+    """Log a batch of changes to one kind of row in a single statement.
+
+    Each change gets its own revision, like recordChange() would give it.
+    Bulk writes call this and store the revisions on the changed rows.
+
+    Args:
+        session    (Session): The session holding the writes.
+        entity     (str): 'item' or 'category'.
+        entity_ids (list): The ids of the changed rows.
+        action     (str): 'create', 'update' or 'delete'.
+
+    Returns:
+        list: The catalog revision of each change.
+    """
+    if not entity_ids:
+        return []
+    revisions = reserveRevisions(session, len(entity_ids))
+    logChanges(session, entity, entity_ids, action, revisions)
+    return revisions
+
+
+def reserveRevisions(session, count):
+    """Advance the catalog revision and return the revisions skipped over.
+
+    The revisions belong to the current transaction alone: concurrent
+    writers wait for it on the catalog_state row.
+
+    Args:
+        session (Session): The session holding the writes.
+        count   (int): The number of revisions to reserve.
+
+    Returns:
+        list: The reserved revisions, in ascending order.
+    """
+    last = bumpRevision(session, count)
+    return list(range(last - count + 1, last + 1))
+
+
+def logChanges(session, entity, entity_ids, action, revisions):
+    """Insert change log rows for reserved revisions in one statement.
+
+    Args:
+        session    (Session): The session holding the writes.
+        entity     (str): 'item' or 'category'.
+        entity_ids (list): The ids of the changed rows.
+        action     (str): 'create', 'update' or 'delete'.
+        revisions  (list): The revision of each change.
+    """
+    now = datetime.utcnow()
+    session.execute(CatalogChange.__table__.insert(), [{
+        'revision': revision,
+        'entity': entity,
+        'entity_id': entity_id,
+        'action': action,
+        'created_at': now} for revision, entity_id in zip(
+            revisions, entity_ids)])
+
+
+def insertItems(session, rows):
+    """Insert new items with one executemany statement and log them.
+
+    An executemany insert doesn't return the new ids, so the revisions of
+    the creates are reserved first and stored with the rows; the ids are
+    then read back by revision, which no other write can share. The ids
+    are also bounded below by the largest id before the insert so that
+    the lookup scans the primary key instead of the whole table.
+
+    Args:
+        session (Session): The session holding the write.
+        rows    (list): The column values of each new item.
+
+    Returns:
+        list: (id, revision) of each new item, in the order of rows.
+    """
+    if not rows:
+        return []
+    last_id = session.query(func.max(Item.id)).scalar() or 0
+    revisions = reserveRevisions(session, len(rows))
+    session.execute(Item.__table__.insert(), [
+        dict(row, revision=revision)
+        for row, revision in zip(rows, revisions)])
+    ids = dict(session.query(Item.revision, Item.id).filter(
+        Item.id > last_id,
+        Item.revision.between(revisions[0], revisions[-1])))
+    item_ids = [ids[revision] for revision in revisions]
+    logChanges(session, 'item', item_ids, 'create', revisions)
+    return list(zip(item_ids, revisions))
+
+
+def deleteCategoryItems(session, category_id):
+    """Delete all items of a category as part of the current transaction.
+
+    The items are removed with one DELETE statement instead of being
+    loaded and deleted one by one; the deletes are logged and the stored
+    item counts adjusted.
+
+    Args:
+        session     (Session): The session holding the write.
+        category_id (int): The id of the category to empty.
+
+    Returns:
+        int: The number of deleted items.
+    """
+    items = session.query(Item).filter(Item.category_id == category_id)
+    item_ids = [item_id for item_id, in items.with_entities(
+        Item.id).order_by(Item.id)]
+    recordChanges(session, 'item', item_ids, 'delete')
+    deleted = items.delete(synchronize_session=False)
+    adjustItemCounts(session, category_id, -deleted)
+    return deleted
+
+
+def changesSince(session, since, limit):
+    """Return the changes logged after a catalog revision.
+
+    Args:
+        session (Session): The database session to query with.
+        since   (int): The last revision the client has seen.
+        limit   (int): The maximum number of changes to return.
+
+    Returns:
+        list: CatalogChange rows, oldest first.
+    """
+    return session.query(CatalogChange).filter(
+        CatalogChange.revision > since).order_by(
+            CatalogChange.revision.asc()).limit(limit).all()
+
+
+def compactChanges(session, before_revision=None):
+    """Shrink the change log.
+
+    Changes superseded by a newer change of the same item or category are
+    always dropped: clients apply creates and updates as upserts with the
+    current data, so they only need the newest change of each row. With
+    before_revision, all changes up to that revision are dropped as well,
+    and clients that have not caught up to it must reload the catalog.
+
+    Args:
+        session         (Session): The database session to use.
+        before_revision (int): Truncate the log up to this revision.
+
+    Returns:
+        int: The number of changes removed.
+    """
+    newer = aliased(CatalogChange)
+    removed = session.query(CatalogChange).filter(exists().where(and_(
+        newer.entity == CatalogChange.entity,
+        newer.entity_id == CatalogChange.entity_id,
+        newer.revision > CatalogChange.revision))).delete(
+            synchronize_session=False)
+    if before_revision is not None:
+        before_revision = min(before_revision, catalogRevision(session)[0])
+        removed += session.query(CatalogChange).filter(
+            CatalogChange.revision <= before_revision).delete(
+                synchronize_session=False)
+        session.query(CatalogState).filter(
+            CatalogState.id == 1,
+            CatalogState.compacted_revision < before_revision).update(
+                {CatalogState.compacted_revision: before_revision},
+                synchronize_session=False)
+    session.commit()
+    return removed
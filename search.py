@@ -0,0 +1,110 @@
+"""
+    Full-text search over catalog item names and descriptions.
+
+    On SQLite the search runs against the catalog_item_fts index declared
+    in database_setup.py, ranked with BM25 so matches in the item name
+    weigh more than matches in the description. Other databases fall back
+    to a case-insensitive substring match, newest items first.
+"""
+import re
+from sqlalchemy import and_, or_, text
+from sqlalchemy.orm import joinedload
+from database_setup import Item
+
+
+# Relative weight of the name and description columns in the ranking
+NAME_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+
+
+def searchTerms(query):
+    """Split a search query into words.
+
+    Args:
+        query (str): The text typed by the user.
+
+    Returns:
+        list: The words of the query.
+    """
+    return re.findall(r'\w+', query or '', re.UNICODE)
+
+
+def matchExpression(terms):
+    """Build an FTS5 MATCH expression that finds items with all terms.
+
+    Every term also matches words it is a prefix of, so results show up
+    while the user is still typing.
+
+    Args:
+        terms (list): The words to search for.
+
+    Returns:
+        str: The MATCH expression.
+    """
+    return ' '.join('"%s"*' % term for term in terms)
+
+
+def searchItemIds(session, query, category_id=None, limit=20, offset=0):
+    """Return the ids of the items best matching a search query.
+
+    Args:
+        session     (Session): The database session to query with.
+        query       (str): The text typed by the user.
+        category_id (int): Only search items of this category (optional).
+        limit       (int): The maximum number of ids to return.
+        offset      (int): The number of best matches to skip.
+
+    Returns:
+        list: Item ids, best match first.
+    """
+    terms = searchTerms(query)
+    if not terms:
+        return []
+
+    if session.bind.dialect.name != 'sqlite':
+        ids = session.query(Item.id).filter(and_(*[
+            or_(Item.name.ilike('%' + term + '%'),
+                Item.description.ilike('%' + term + '%'))
+            for term in terms]))
+        if category_id is not None:
+            ids = ids.filter(Item.category_id == category_id)
+        ids = ids.order_by(Item.id.desc()).limit(limit).offset(offset)
+        return [row.id for row in ids]
+
+    sql = ("SELECT catalog_item.id FROM catalog_item_fts "
+           "JOIN catalog_item ON catalog_item.id = catalog_item_fts.rowid "
+           "WHERE catalog_item_fts MATCH :match ")
+    if category_id is not None:
+        sql += "AND catalog_item.category_id = :category_id "
+    sql += ("ORDER BY bm25(catalog_item_fts, :name_weight, "
+            ":description_weight) LIMIT :limit OFFSET :offset")
+    rows = session.execute(text(sql), {
+        'match': matchExpression(terms),
+        'category_id': category_id,
+        'name_weight': NAME_WEIGHT,
+        'description_weight': DESCRIPTION_WEIGHT,
+        'limit': limit,
+        'offset': offset})
+    return [row[0] for row in rows]
+
+
+def searchItems(session, query, category_id=None, limit=20, offset=0):
+    """Return the items best matching a search query.
+
+    Args:
+        session     (Session): The database session to query with.
+        query       (str): The text typed by the user.
+        category_id (int): Only search items of this category (optional).
+        limit       (int): The maximum number of items to return.
+        offset      (int): The number of best matches to skip.
+
+    Returns:
+        list: Items with their category loaded, best match first.
+    """
+    ids = searchItemIds(session, query, category_id, limit, offset)
+    if not ids:
+        return []
+    items = session.query(Item).options(
+        joinedload(Item.category)).filter(Item.id.in_(ids))
+    items = dict((i.id, i) for i in items)
+    return [items[i] for i in ids if i in items]
@@ -0,0 +1,343 @@
+"""
+    Production server: the catalog app on pre-forked worker processes.
+
+        SECRET_KEY=... python server.py [--host HOST] [--port PORT]
+                                        [--workers N] [--unshared-caches]
+
+    The master process binds the port, compiles all templates and forks
+    the workers, which accept connections on the shared socket and serve
+    every connection on its own thread. A worker first drops the database
+    connections inherited from the master and requests a few pages to
+    open its own connections and fill its caches; only then does the
+    master count it as ready. Workers that exit are replaced.
+
+    Signals to the master:
+        SIGHUP          reload the login provider settings and replace the
+                        workers: the new workers start and warm up, then
+                        the old ones finish their requests and exit
+        SIGTERM, SIGINT finish the running requests and exit
+
+    Settings from the environment:
+        WEB_WORKERS      (int): worker processes (default: 4 with a shared
+                                page cache, otherwise 1)
+        GRACEFUL_TIMEOUT (int): seconds a stopping worker may take to
+                                finish its requests (default: 30)
+
+    Every worker has its own caches, which only see the writes of other
+    workers through the page cache (see snapshots.py). More than one
+    worker therefore needs PAGE_CACHE_URL, and can't keep login sessions
+    or queued logins in process memory.
+"""
+from __future__ import print_function
+import argparse
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from werkzeug.serving import make_server
+import application
+from application import create_app
+from database_setup import engine, envSetting
+
+
+# Pages every worker requests before it accepts connections
+WARMUP_PATHS = ['/', '/api/v1/categories/json', '/api/v2/items']
+
+
+def log(message):
+    """Print a message of the master or a worker to stderr."""
+    print('[%d] %s' % (os.getpid(), message), file=sys.stderr)
+
+
+def compileTemplates(app):
+    """Load every template of an app, compiling those not yet cached."""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def warmUp(app, paths=WARMUP_PATHS):
+    """Request pages of an app to open connections and fill its caches.
+
+    Args:
+        app   (Flask): The app.
+        paths (list): The paths to request, as a visitor not logged in.
+    """
+    client = app.test_client()
+    for path in paths:
+        response = client.get(path)
+        response.close()
+        if response.status_code >= 500:
+            raise RuntimeError('%s returned %d' % (
+                path, response.status_code))
+
+
+def sharedStateProblems(worker_count, unshared_caches=False):
+    """Check that the app's state can be shared by several workers.
+
+    Args:
+        worker_count    (int): The number of workers to run.
+        unshared_caches (bool): Accept caches kept in each worker.
+
+    Returns:
+        list: What keeps the workers from serving the same users, empty if
+              nothing does.
+    """
+    if worker_count <= 1:
+        return []
+    problems = []
+    if not unshared_caches and not os.environ.get('PAGE_CACHE_URL'):
+        problems.append('set PAGE_CACHE_URL to share the caches')
+    if os.environ.get('SESSION_STORE') == 'memory':
+        problems.append('SESSION_STORE=memory keeps the login sessions '
+                        'in one worker')
+    if envSetting('LOGIN_WORKERS', 0):
+        problems.append('LOGIN_WORKERS keeps queued logins in one worker, '
+                        'so their status polls fail on the others')
+    return problems
+
+
+def runWorker(app, listener, ready_fd):
+    """Serve requests on a listening socket until SIGTERM.
+
+    Runs in a forked worker process. Requests that are running when
+    SIGTERM arrives are finished before the function returns.
+
+    Args:
+        app      (Flask): The app to serve.
+        listener (socket): The listening socket shared with the master.
+        ready_fd (int): Pipe to the master, written to once warmed up.
+    """
+    # The master stops the workers on SIGINT, and reloads them on SIGHUP
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    application.providers.reloadOnSignal()
+    engine.dispose()
+    if envSetting('OAUTH_RELOAD_INTERVAL', 0):
+        application.providers.watch(envSetting('OAUTH_RELOAD_INTERVAL', 0))
+    warmUp(app)
+
+    host, port = listener.getsockname()[:2]
+    server = make_server(host, port, app, threaded=True,
+                         fd=listener.fileno())
+    # Make server_close() wait for the running requests
+    server.daemon_threads = False
+
+    def stop(signal_number, frame):
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+
+    os.write(ready_fd, b'.')
+    os.close(ready_fd)
+    server.serve_forever()
+
+
+class PreforkServer(object):
+    """Master process forking and supervising the workers
+
+    Attributes:
+        app              (Flask): the app the workers serve
+        listener         (socket): the listening socket
+        worker_count     (int): the number of workers to keep running
+        graceful_timeout (int): seconds a stopping worker may take
+        workers          (set): pids of the workers serving requests
+        retiring         (dict): stop deadline of stopping workers by pid
+    """
+
+    def __init__(self, app, listener, worker_count, graceful_timeout=30):
+        self.app = app
+        self.listener = listener
+        self.worker_count = worker_count
+        self.graceful_timeout = graceful_timeout
+        self.workers = set()
+        self.retiring = {}
+        self._reload = False
+        self._stop = False
+
+    def run(self):
+        """Start the workers and supervise them until SIGTERM or SIGINT."""
+        compileTemplates(self.app)
+        # The workers must not share the master's database connections
+        engine.dispose()
+        signal.signal(signal.SIGHUP, self._onReload)
+        signal.signal(signal.SIGTERM, self._onStop)
+        signal.signal(signal.SIGINT, self._onStop)
+
+        self.workers.update(self.startWorkers(self.worker_count))
+        log('Serving on %s:%d with %d workers' % (
+            self.listener.getsockname()[:2] + (len(self.workers),)))
+        while not self._stop:
+            if self._reload:
+                self._reload = False
+                self.reload()
+            self.reap()
+            time.sleep(0.2)
+        self.stop()
+
+    def startWorkers(self, count):
+        """Fork workers and wait until they are warmed up.
+
+        Args:
+            count (int): The number of workers to start.
+
+        Returns:
+            set: The pids of the workers that are ready; the others were
+                 stopped.
+        """
+        pipes = {}
+        for _ in range(count):
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                status = 0
+                try:
+                    runWorker(self.app, self.listener, write_fd)
+                except BaseException:
+                    traceback.print_exc()
+                    status = 1
+                sys.stderr.flush()
+                os._exit(status)
+            os.close(write_fd)
+            pipes[read_fd] = pid
+
+        ready = set()
+        deadline = time.time() + self.graceful_timeout
+        while pipes and not self._stop and time.time() < deadline:
+            readable = select.select(
+                list(pipes), [], [], max(deadline - time.time(), 0))[0]
+            for fd in readable:
+                pid = pipes.pop(fd)
+                if os.read(fd, 1):
+                    ready.add(pid)
+                else:
+                    log('Worker %d exited while starting' % pid)
+                os.close(fd)
+        for fd, pid in pipes.items():
+            os.close(fd)
+            self.retire(pid)
+        return ready
+
+    def reload(self):
+        """Reload the provider settings and replace all workers."""
+        log('Reloading')
+        application.providers.reload()
+        new = self.startWorkers(self.worker_count)
+        if not new:
+            log('No new worker started, keeping the old workers')
+            return
+        for pid in self.workers:
+            self.retire(pid)
+        self.workers = new
+
+    def retire(self, pid):
+        """Ask a worker to finish its requests and exit."""
+        self.retiring[pid] = time.time() + self.graceful_timeout
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def reap(self):
+        """Collect exited workers, replacing crashed and killing stuck ones."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if not pid:
+                break
+            if self.retiring.pop(pid, None) is None and pid in self.workers:
+                self.workers.discard(pid)
+                if os.WIFSIGNALED(status):
+                    log('Worker %d killed by signal %d' % (
+                        pid, os.WTERMSIG(status)))
+                else:
+                    log('Worker %d exited with status %d' % (
+                        pid, os.WEXITSTATUS(status)))
+                if not self._stop:
+                    self.workers.update(self.startWorkers(1))
+        now = time.time()
+        for pid, deadline in list(self.retiring.items()):
+            if deadline < now:
+                log('Worker %d did not stop in time, killing it' % pid)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                self.retiring[pid] = now + self.graceful_timeout
+
+    def stop(self):
+        """Stop all workers, waiting for their running requests."""
+        log('Stopping')
+        for pid in self.workers:
+            self.retire(pid)
+        self.workers = set()
+        while self.retiring:
+            self.reap()
+            time.sleep(0.1)
+        self.listener.close()
+
+    def _onReload(self, signal_number, frame):
+        self._reload = True
+
+    def _onStop(self, signal_number, frame):
+        self._stop = True
+
+
+def createListener(host, port, backlog=128):
+    """Bind the listening socket the workers share.
+
+    Args:
+        host    (str): The address to listen on.
+        port    (int): The port, 0 for any free port.
+        backlog (int): Connections queued until a worker accepts them.
+
+    Returns:
+        socket: The listening socket.
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    return listener
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve the item catalog with pre-forked workers.')
+    parser.add_argument('--host', default='0.0.0.0',
+                        help='address to listen on (default: 0.0.0.0)')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port to listen on (default: 8000)')
+    parser.add_argument('--workers', type=int,
+                        default=envSetting(
+                            'WEB_WORKERS',
+                            4 if os.environ.get('PAGE_CACHE_URL') else 1),
+                        help='worker processes (default: 4 with '
+                             'PAGE_CACHE_URL, otherwise 1)')
+    parser.add_argument('--unshared-caches', action='store_true',
+                        help='allow several workers without PAGE_CACHE_URL; '
+                             'they then see the writes of the others only '
+                             'when their caches expire (for benchmarks)')
+    args = parser.parse_args(argv)
+    problems = sharedStateProblems(args.workers, args.unshared_caches)
+    if problems:
+        sys.exit('Can\'t run %d workers: %s.' % (args.workers,
+                                                 '; '.join(problems)))
+    try:
+        app = create_app()
+    except RuntimeError as e:
+        sys.exit(e)
+    server = PreforkServer(app, createListener(args.host, args.port),
+                           args.workers,
+                           envSetting('GRACEFUL_TIMEOUT', 30))
+    server.run()
+
+
+if __name__ == '__main__':
+    main()
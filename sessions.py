@@ -0,0 +1,273 @@
+"""
+    Server-side sessions.
+
+    Flask keeps the whole session (user name, email, picture URL, access
+    token, ...) in a signed cookie, which every request sends and the app
+    verifies and decodes. ServerSessionInterface keeps the session data in
+    a SessionStore instead, and the cookie only holds a random session id.
+    SQLSessionStore keeps the sessions in the login_session table, shared
+    by all app processes; MemorySessionStore keeps them in the process,
+    which suits tests and single-process servers.
+
+    Sessions expire SESSION_TTL seconds after they were last saved; a
+    background thread removes expired sessions from the store.
+"""
+import binascii
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from sqlalchemy import bindparam, select
+from werkzeug.datastructures import CallbackDict
+from cache import LocalCache
+from database_setup import LoginSession, envSetting
+
+
+class SessionStore(object):
+    """Interface of the stores used by ServerSessionInterface
+
+    Session data is a string; expiry times are UTC datetimes.
+    """
+
+    def load(self, sid):
+        """Return (data, expires_at) of a session, or None if it expired"""
+        raise NotImplementedError
+
+    def save(self, sid, data, expires_at):
+        """Store a session, replacing an earlier version"""
+        raise NotImplementedError
+
+    def delete(self, sid):
+        """Remove a session"""
+        raise NotImplementedError
+
+    def cleanup(self):
+        """Remove the expired sessions; return how many there were"""
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions kept in the process, least recently used evicted first
+
+    Attributes:
+        sessions (LocalCache): the sessions by id
+    """
+
+    def __init__(self, maxsize=10000):
+        self.sessions = LocalCache(maxsize, ttl=0)
+
+    def load(self, sid):
+        return self.sessions.get(sid)
+
+    def save(self, sid, data, expires_at):
+        ttl = (expires_at - datetime.utcnow()).total_seconds()
+        self.sessions.set(sid, (data, expires_at), ttl=max(ttl, 1))
+
+    def delete(self, sid):
+        self.sessions.delete(sid)
+
+    def cleanup(self):
+        return self.sessions.purge()
+
+
+class SQLSessionStore(SessionStore):
+    """Sessions kept in the login_session table
+
+    Attributes:
+        engine (Engine): the engine of the database holding the table
+    """
+    table = LoginSession.__table__
+
+    def __init__(self, engine):
+        self.engine = engine
+        # Every request loads its session: build and compile the query once
+        self._engine = engine.execution_options(compiled_cache={})
+        self._load = select([self.table.c.data, self.table.c.expires_at]
+                            ).where(self.table.c.id == bindparam('sid'))
+
+    def load(self, sid):
+        with self._engine.connect() as connection:
+            row = connection.execute(self._load, sid=sid).first()
+        if row is None or row.expires_at < datetime.utcnow():
+            return None
+        return row.data, row.expires_at
+
+    def save(self, sid, data, expires_at):
+        with self.engine.begin() as connection:
+            updated = connection.execute(self.table.update().where(
+                self.table.c.id == sid).values(
+                    data=data, expires_at=expires_at)).rowcount
+            if not updated:
+                connection.execute(self.table.insert().values(
+                    id=sid, data=data, expires_at=expires_at))
+
+    def delete(self, sid):
+        with self.engine.begin() as connection:
+            connection.execute(
+                self.table.delete().where(self.table.c.id == sid))
+
+    def cleanup(self):
+        with self.engine.begin() as connection:
+            return connection.execute(self.table.delete().where(
+                self.table.c.expires_at < datetime.utcnow())).rowcount
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data loaded from a SessionStore
+
+    Attributes:
+        sid        (str): the session id, None until the session is saved
+        expires_at (datetime): when the stored session expires, or None
+        modified   (bool): whether the data changed during the request
+        old_sid    (str): the id regenerate() replaced, removed from the
+                          store when the session is saved
+    """
+
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        def onUpdate(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, onUpdate)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.new = sid is None
+        self.modified = False
+        self.old_sid = None
+
+    def regenerate(self):
+        """Save the session under a new id and cookie, dropping the old one
+
+        Called when the user logs in or out, so that a session id planted
+        in the browser before the login never names a logged-in session.
+        """
+        if self.sid is not None:
+            self.old_sid = self.sid
+        self.sid = None
+        self.new = True
+        self.modified = True
+
+
+def newSessionId():
+    """Return a new random session id, 64 hex digits"""
+    return binascii.hexlify(os.urandom(32)).decode('ascii')
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface keeping sessions in a SessionStore
+
+    Sessions are saved when they change, and at the latest when less than
+    half of their lifetime is left. Requests for static files don't load
+    the session at all.
+
+    Attributes:
+        store            (SessionStore): where the sessions are kept
+        ttl              (int): seconds a session lives after it was saved
+        cleanup_interval (int): seconds between removals of expired
+                                sessions, 0 to never remove them
+    """
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, ttl=604800, cleanup_interval=3600):
+        self.store = store
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self._cleanup_pid = None
+        self._lock = threading.Lock()
+
+    def open_session(self, app, request):
+        if request.endpoint == 'static':
+            return None
+        if self.cleanup_interval and self._cleanup_pid != os.getpid():
+            self._startCleanup()
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            stored = self.store.load(sid)
+            if stored is not None:
+                data, expires_at = stored
+                return ServerSession(
+                    self.serializer.loads(data), sid, expires_at)
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.old_sid is not None:
+            self.store.delete(session.old_sid)
+
+        # A session emptied during the request is removed with its cookie
+        if not session:
+            if session.modified and (session.sid or session.old_sid):
+                if session.sid is not None:
+                    self.store.delete(session.sid)
+                response.delete_cookie(
+                    app.session_cookie_name, domain=domain, path=path)
+            return
+
+        now = datetime.utcnow()
+        if not session.modified and session.expires_at is not None and (
+                session.expires_at - now).total_seconds() > self.ttl / 2:
+            return
+        if session.sid is None:
+            session.sid = newSessionId()
+        self.store.save(session.sid, self.serializer.dumps(dict(session)),
+                        now + timedelta(seconds=self.ttl))
+        if session.new or session.permanent:
+            response.set_cookie(
+                app.session_cookie_name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain, path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app))
+
+    def _startCleanup(self):
+        # Started lazily, so that every app process gets its own thread
+        with self._lock:
+            if self._cleanup_pid == os.getpid():
+                return
+            self._cleanup_pid = os.getpid()
+
+        def cleanup():
+            while True:
+                time.sleep(self.cleanup_interval)
+                self.store.cleanup()
+        thread = threading.Thread(target=cleanup, name='session-cleanup')
+        thread.daemon = True
+        thread.start()
+
+
+def createSessionInterface(engine):
+    """Create the session interface configured in the environment:
+        SESSION_STORE            (str): 'sql' to keep sessions in the
+                                        database (default), 'memory' to keep
+                                        them in the process, or 'cookie' for
+                                        Flask's signed cookie sessions
+        SESSION_TTL              (int): seconds a session lives after its
+                                        last change (default: 604800, 7 days)
+        SESSION_CLEANUP_INTERVAL (int): seconds between removals of expired
+                                        sessions (default: 3600)
+        SESSION_MEMORY_SIZE      (int): sessions kept by the memory store
+                                        (default: 10000)
+
+    Args:
+        engine (Engine): The engine of the catalog database.
+
+    Returns:
+        SessionInterface: The session interface, None for cookie sessions.
+
+    Raises:
+        ValueError: If SESSION_STORE is not one of the above.
+    """
+    kind = os.environ.get('SESSION_STORE') or 'sql'
+    if kind == 'cookie':
+        return None
+    if kind == 'sql':
+        store = SQLSessionStore(engine)
+    elif kind == 'memory':
+        store = MemorySessionStore(envSetting('SESSION_MEMORY_SIZE', 10000))
+    else:
+        raise ValueError('Unknown session store %r' % kind)
+    return ServerSessionInterface(
+        store, envSetting('SESSION_TTL', 604800),
+        envSetting('SESSION_CLEANUP_INTERVAL', 3600))
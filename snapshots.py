@@ -0,0 +1,178 @@
+"""
+    Read-through cache of the users and categories shown on most pages.
+
+    Both tables are small and rarely written, but the sidebar, the item
+    forms and the "created by" lines read them on almost every request.
+    The cache keeps immutable snapshots of the rows (namedtuples, not ORM
+    objects), so entries can be shared between threads and sessions and
+    never change or lazy-load behind a view's back. Views call the
+    invalidate methods after writing, and every entry also expires after
+    a while.
+
+    The snapshots are kept in each app process. Given the page cache, the
+    cache also stores a tag version with every entry and bumps the tag on
+    invalidation, so with a page cache shared between processes (see
+    cache.py) a write in one process is seen by all the others on their
+    next read.
+"""
+import threading
+from collections import namedtuple
+from cache import LocalCache
+from database_setup import CatalogState, Category, User, envSetting
+
+
+CategorySnapshot = namedtuple(
+    'CategorySnapshot', ['id', 'name', 'user_id', 'revision', 'item_count'])
+
+UserSnapshot = namedtuple('UserSnapshot', ['id', 'name', 'email', 'picture'])
+
+
+class CategoryList(tuple):
+    """The snapshots of all categories
+
+    Attributes:
+        revision (int): the catalog revision the categories were loaded at,
+                        for keying what is derived from them: every write
+                        to a category or to its item count advances it,
+                        and it is the same in every app process
+    """
+
+    def __new__(cls, categories, revision):
+        categories = super(CategoryList, cls).__new__(cls, categories)
+        categories.revision = revision
+        return categories
+
+
+def snapshot(row, kind):
+    """Copy the columns of an ORM row into a snapshot.
+
+    Args:
+        row  (Base): The row, or None.
+        kind (type): CategorySnapshot or UserSnapshot.
+
+    Returns:
+        namedtuple: The snapshot, or None.
+    """
+    if row is None:
+        return None
+    return kind(*[getattr(row, field) for field in kind._fields])
+
+
+class SnapshotCache(object):
+    """Snapshots of all categories and of single users, read through
+
+    Loads are tagged with a generation number that every invalidation
+    advances, so a load that raced with a write is not cached.
+
+    Attributes:
+        entries (LocalCache): the snapshots and the tag versions they were
+                              loaded at, with LRU eviction and expiry
+        tags    (PageCache): where the tag versions of the snapshots are
+                             kept, None to only invalidate in this process
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, tags=None):
+        self.entries = LocalCache(maxsize, ttl)
+        self.tags = tags
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _version(self, key):
+        if self.tags is None:
+            return None
+        return self.tags.tagVersions(['snapshot:' + key])[0]
+
+    def _read(self, key, load):
+        version = self._version(key)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        with self._lock:
+            generation = self._generation
+        value = load()
+        with self._lock:
+            if generation == self._generation:
+                self.entries.set(key, (version, value))
+        return value
+
+    def _invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self.entries.delete(key)
+        if self.tags is not None:
+            self.tags.invalidate('snapshot:' + key)
+
+    def categories(self, session):
+        """Return all categories.
+
+        Args:
+            session (Session): The database session to load them with.
+
+        Returns:
+            CategoryList: CategorySnapshots ordered by id.
+        """
+        return self._categories(session)[0]
+
+    def category(self, session, category_id):
+        """Return one category.
+
+        Args:
+            session     (Session): The database session to load it with.
+            category_id (int): The id of the category.
+
+        Returns:
+            CategorySnapshot: The category, or None if it doesn't exist.
+        """
+        return self._categories(session)[1].get(category_id)
+
+    def _categories(self, session):
+        def load():
+            # Read the revision first: the categories are then at least as
+            # new as it, never older
+            revision = session.query(CatalogState.revision).filter(
+                CatalogState.id == 1).scalar()
+            categories = CategoryList(
+                (snapshot(c, CategorySnapshot)
+                 for c in session.query(Category).order_by(Category.id)),
+                revision)
+            return categories, dict((c.id, c) for c in categories)
+        return self._read('categories', load)
+
+    def user(self, session, user_id):
+        """Return one user.
+
+        Args:
+            session (Session): The database session to load it with.
+            user_id (int): The id of the user.
+
+        Returns:
+            UserSnapshot: The user, or None if they don't exist.
+        """
+        user = self._read('user:%s' % user_id, lambda: snapshot(
+            session.query(User).filter_by(id=user_id).first(),
+            UserSnapshot) or False)
+        return user or None
+
+    def invalidateCategories(self):
+        """Drop the categories after a category or item count changed."""
+        self._invalidate('categories')
+
+    def invalidateUser(self, user_id):
+        """Drop a user after it was written."""
+        self._invalidate('user:%s' % user_id)
+
+
+def createSnapshotCache(tags=None):
+    """Create the snapshot cache configured in the environment:
+        SNAPSHOT_CACHE_TTL  (int): seconds a snapshot is kept (default: 60)
+        SNAPSHOT_CACHE_SIZE (int): snapshots kept (default: 1024)
+
+    Args:
+        tags (PageCache): The page cache to keep the tag versions of the
+                          snapshots in (optional).
+
+    Returns:
+        SnapshotCache: The snapshot cache.
+    """
+    return SnapshotCache(envSetting('SNAPSHOT_CACHE_SIZE', 1024),
+                         envSetting('SNAPSHOT_CACHE_TTL', 60), tags)
@@ -0,0 +1,84 @@
+"""
+    Caching of compiled templates and of rendered template fragments.
+
+    Templates are compiled to Python bytecode once and kept on disk by a
+    Jinja FileSystemBytecodeCache, so app processes started later load them
+    without compiling. Parts of a template can be kept rendered with the
+    {% cache %} tag of FragmentCacheExtension:
+
+        {% cache 'item-row', item.id, item.revision %}
+            ...
+        {% endcache %}
+
+    The expressions after the tag make up the key of the fragment. They
+    must include everything the fragment shows that can change, e.g. the
+    revision of the row and whether the viewer may edit it, because cached
+    fragments are never invalidated, only evicted after a while. A fragment
+    with an undefined key part is always rendered.
+"""
+import os
+from jinja2 import FileSystemBytecodeCache, is_undefined, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from cache import LocalCache
+from database_setup import envSetting
+
+
+class FragmentCacheExtension(Extension):
+    """Jinja extension adding the {% cache key, ... %} tag
+
+    The rendered fragments are kept in the environment's fragment_cache,
+    a LocalCache; without one every fragment is rendered.
+    """
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_render', [nodes.List(key)]),
+            [], [], body).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        fragments = self.environment.fragment_cache
+        if fragments is None or any(is_undefined(part) for part in key):
+            return caller()
+        key = 'fragment:' + ':'.join('%s' % part for part in key)
+        fragment = fragments.get(key)
+        if fragment is None:
+            fragment = caller()
+            fragments.set(key, fragment)
+        return Markup(fragment)
+
+
+def createFragmentCache():
+    """Create the fragment cache configured in the environment:
+        FRAGMENT_CACHE_TTL  (int): seconds a fragment is kept (default: 300)
+        FRAGMENT_CACHE_SIZE (int): fragments kept (default: 4096)
+
+    Returns:
+        LocalCache: The fragment cache.
+    """
+    return LocalCache(envSetting('FRAGMENT_CACHE_SIZE', 4096),
+                      envSetting('FRAGMENT_CACHE_TTL', 300))
+
+
+def createBytecodeCache(directory):
+    """Create a cache of compiled templates in a directory.
+
+    Args:
+        directory (str): The directory, created if it doesn't exist.
+
+    Returns:
+        FileSystemBytecodeCache: The bytecode cache.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return FileSystemBytecodeCache(directory)
@@ -0,0 +1,118 @@
+"""
+    Shared test fixtures.
+
+    The app reads its settings from the environment when it is imported,
+    so they are set here first: the database is a SQLite file in a
+    temporary directory, sessions are kept in memory and compiled
+    templates are not cached on disk. Every test starts with an empty
+    catalog and empty caches.
+
+    Run the tests from the repository root with `python -m pytest`.
+"""
+import os
+import sys
+import tempfile
+
+DIRECTORY = tempfile.mkdtemp(prefix='itemcatalog-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+    DIRECTORY, 'itemcatalog.db')
+os.environ['SESSION_STORE'] = 'memory'
+os.environ['JINJA_CACHE_DIR'] = ''
+for name in ('PAGE_CACHE_URL', 'LOGIN_WORKERS', 'INSTRUMENTATION',
+             'OAUTH_RELOAD_INTERVAL'):
+    os.environ.pop(name, None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import pytest  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+import application  # noqa: E402
+from cache import createPageCache  # noqa: E402
+from database_setup import Base, Category, Item, User, engine  # noqa: E402
+from queries import repairItemCounts  # noqa: E402
+from snapshots import createSnapshotCache  # noqa: E402
+from templating import createFragmentCache  # noqa: E402
+
+application.create_app({'SECRET_KEY': 'test', 'TESTING': True})
+
+
+class Catalog(object):
+    """Adds rows to the test database
+
+    Items are inserted directly, so the stored item counts are repaired
+    after every insert, like `manage.py repair-counts` does.
+    """
+
+    def __init__(self):
+        self.session = application.session
+
+    def addUser(self, name='Owner'):
+        user = User(name=name, email='%s@example.com' % name.lower())
+        self.session.add(user)
+        self.session.commit()
+        return user.id
+
+    def addCategory(self, user_id, name='Balls'):
+        category = Category(name=name, user_id=user_id)
+        self.session.add(category)
+        self.session.commit()
+        return category.id
+
+    def addItems(self, category_id, user_id, count, price_cents=None):
+        items = [Item(name='Item %d' % i, description='Description %d' % i,
+                      category_id=category_id, user_id=user_id,
+                      price_cents=price_cents) for i in range(count)]
+        self.session.add_all(items)
+        self.session.commit()
+        repairItemCounts(self.session)
+        return [item.id for item in items]
+
+    def itemCounts(self):
+        """Return the stored and the actual item count of each category."""
+        self.session.expire_all()
+        return dict((c.id, (c.item_count, len(c.catalog_items)))
+                    for c in self.session.query(Category))
+
+
+@pytest.fixture(autouse=True)
+def catalog():
+    """An empty catalog with empty caches"""
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    application.pageCache = createPageCache()
+    application.snapshots = createSnapshotCache(application.pageCache)
+    application.app.jinja_env.fragment_cache = createFragmentCache()
+    yield Catalog()
+    application.session.remove()
+
+
+@pytest.fixture
+def client():
+    """A test client of a visitor who is not logged in"""
+    return application.app.test_client()
+
+
+@pytest.fixture
+def login():
+    """Return a function giving a test client logged in as a user"""
+    def login(user_id):
+        client = application.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user_id
+            session['username'] = 'User %d' % user_id
+            session['email'] = 'user%d@example.com' % user_id
+            session['picture'] = ''
+        return client
+    return login
+
+
+@pytest.fixture
+def queries():
+    """A list collecting the SQL statements executed during the test"""
+    statements = []
+
+    def collect(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', collect)
+    yield statements
+    event.remove(engine, 'before_cursor_execute', collect)
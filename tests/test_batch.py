@@ -0,0 +1,98 @@
+"""
+    Tests of the batch item API, /api/v2/items:batch.
+"""
+from batch import MAX_BATCH_SIZE
+from database_setup import CatalogChange, Item
+
+URL = '/api/v2/items:batch'
+
+
+def setUpCatalog(catalog):
+    """Add two users, one category each and items of both."""
+    owner_id = catalog.addUser('Owner')
+    other_id = catalog.addUser('Other')
+    balls = catalog.addCategory(owner_id, 'Balls')
+    bats = catalog.addCategory(other_id, 'Bats')
+    mine = catalog.addItems(balls, owner_id, 3)
+    theirs = catalog.addItems(bats, other_id, 1)
+    return owner_id, balls, bats, mine, theirs
+
+
+def test_batch_needs_a_login_and_a_valid_body(catalog, client, login):
+    assert client.post(URL, json={'operations': []}).status_code == 401
+
+    client = login(catalog.addUser())
+    assert client.post(URL, data='not json').status_code == 400
+    assert client.post(URL, json=[]).status_code == 400
+    assert client.post(URL, json={'operations': {}}).status_code == 400
+    operations = [{'op': 'delete', 'id': 1}] * (MAX_BATCH_SIZE + 1)
+    assert client.post(URL, json={
+        'operations': operations}).status_code == 413
+
+
+def test_batch_results(catalog, login):
+    owner_id, balls, bats, mine, theirs = setUpCatalog(catalog)
+    response = login(owner_id).post(URL, json={'operations': [
+        {'op': 'create', 'name': 'Ball', 'category_id': balls,
+         'price': '2.50'},
+        {'op': 'create', 'name': 'Bat', 'category_id': bats,
+         'description': 'Maple'},
+        {'op': 'update', 'id': mine[0], 'category_id': bats},
+        {'op': 'update', 'id': mine[0], 'name': 'Twice'},
+        {'op': 'delete', 'id': mine[1]},
+        {'op': 'delete', 'id': theirs[0]},
+        {'op': 'delete', 'id': 9999},
+        {'op': 'create', 'name': 'Net', 'category_id': 9999},
+        {'op': 'create', 'category_id': balls},
+        {'op': 'update', 'id': mine[2], 'price': 'cheap'},
+        {'op': 'rename', 'id': mine[2]},
+    ]})
+    assert response.status_code == 200
+    data = response.get_json()
+    results = data['Results']
+    assert [r['status'] for r in results] == [
+        201, 201, 200, 409, 200, 403, 404, 404, 400, 400, 400]
+    assert data['applied'] == 4
+    assert data['revision'] == max(
+        r['revision'] for r in results if 'revision' in r)
+
+    items = dict((i.id, i) for i in catalog.session.query(Item))
+    ball, bat = items[results[0]['id']], items[results[1]['id']]
+    assert (ball.name, ball.category_id, ball.price_cents) == (
+        'Ball', balls, 250)
+    assert (bat.name, bat.category_id, bat.description) == (
+        'Bat', bats, 'Maple')
+    assert items[mine[0]].category_id == bats
+    assert mine[1] not in items and theirs[0] in items
+    for result in results[:3] + results[4:5]:
+        assert catalog.session.query(CatalogChange).get(
+            result['revision']).entity_id == result['id']
+    assert catalog.itemCounts() == {balls: (2, 2), bats: (3, 3)}
+
+
+def test_atomic_batch_applies_nothing_if_one_fails(catalog, login):
+    owner_id, balls, bats, mine, theirs = setUpCatalog(catalog)
+    response = login(owner_id).post(URL, json={'atomic': True, 'operations': [
+        {'op': 'create', 'name': 'Ball', 'category_id': balls},
+        {'op': 'delete', 'id': theirs[0]},
+    ]})
+    assert response.status_code == 422
+    assert [r['status'] for r in response.get_json()['Results']] == [
+        424, 403]
+    assert catalog.session.query(Item).count() == 4
+    assert catalog.itemCounts() == {balls: (3, 3), bats: (1, 1)}
+
+
+def test_batch_on_items_without_a_category(catalog, login):
+    owner_id, balls, bats, mine, theirs = setUpCatalog(catalog)
+    catalog.session.query(Item).filter(Item.id.in_(mine[:2])).update(
+        {Item.category_id: None}, synchronize_session=False)
+    catalog.session.commit()
+    response = login(owner_id).post(URL, json={'operations': [
+        {'op': 'update', 'id': mine[0], 'name': 'Legacy'},
+        {'op': 'delete', 'id': mine[1]},
+    ]})
+    assert response.status_code == 200
+    assert [r['status'] for r in response.get_json()['Results']] == [
+        200, 200]
+    assert catalog.session.query(Item).get(mine[0]).name == 'Legacy'
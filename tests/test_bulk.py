@@ -0,0 +1,70 @@
+"""
+    Tests of the bulk item import.
+"""
+import io
+import json
+from bulk import importItems, readRows
+from database_setup import CatalogChange, Item, engine
+
+ROWS = [
+    {'name': 'Ball', 'category': 'Balls', 'price': '2.50'},
+    {'name': 'Cheap ball', 'category': 'Balls', 'price': 2.5},
+    {'name': 3, 'category': 'Balls'},
+    {'name': 'Bat', 'category': 7},
+    {'name': 'Glove', 'category': 'Balls', 'description': ['long']},
+    {'name': 'Net', 'category': 'Balls', 'price': {'dollars': 1}},
+    {'name': 'Cap', 'category': 'Balls', 'price': True},
+    {'name': 'Hoop', 'category': 'Balls', 'price': 'cheap'},
+    {'name': 'Rope', 'category': 'Hats'},
+    {'category': 'Balls'},
+    ['Ball', 'Balls'],
+]
+
+
+def importNdjson(lines, user_id, **kwargs):
+    log = io.StringIO()
+    stream = io.StringIO(u'\n'.join(lines) + u'\n')
+    result = importItems(engine, readRows(stream, 'ndjson'), user_id,
+                         log=log, **kwargs)
+    return result, log.getvalue()
+
+
+def test_bad_rows_are_rejected(catalog):
+    user_id = catalog.addUser()
+    category_id = catalog.addCategory(user_id, 'Balls')
+
+    lines = [json.dumps(row) for row in ROWS] + ['{not json']
+    result, log = importNdjson(lines, user_id)
+    assert result['imported'] == 2
+    assert result['rejected'] == len(lines) - 2
+    for number in range(3, len(lines) + 1):
+        assert 'line %d: ' % number in log
+    assert 'name must be a string' in log
+    assert 'category must be a string' in log
+    assert "unknown category 'Hats'" in log
+
+    items = catalog.session.query(Item).order_by(Item.id).all()
+    assert [(i.name, i.price_cents) for i in items] == [
+        ('Ball', 250), ('Cheap ball', 250)]
+    assert catalog.itemCounts() == {category_id: (2, 2)}
+
+
+def test_imported_items_are_logged_with_their_revisions(catalog):
+    user_id = catalog.addUser()
+    catalog.addCategory(user_id, 'Balls')
+    existing = catalog.addItems(catalog.addCategory(user_id, 'Bats'),
+                                user_id, 3)
+
+    lines = [json.dumps({'name': 'Ball %d' % i, 'category': 'Balls'})
+             for i in range(7)]
+    result, log = importNdjson(lines, user_id, batch_size=3)
+    assert result['imported'] == 7
+
+    items = catalog.session.query(Item).filter(
+        ~Item.id.in_(existing)).order_by(Item.id).all()
+    changes = catalog.session.query(CatalogChange).order_by(
+        CatalogChange.revision).all()
+    assert [(c.entity_id, c.action) for c in changes] == [
+        (i.id, 'create') for i in items]
+    assert [c.revision for c in changes] == [i.revision for i in items]
+    assert len(set(i.revision for i in items)) == 7
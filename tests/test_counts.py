@@ -0,0 +1,87 @@
+"""
+    Tests that the stored item counts follow item moves and deletes.
+"""
+import re
+from database_setup import Item
+from queries import itemCount
+
+
+def sidebarCounts(client):
+    """Return the item counts shown in the category sidebar, in order."""
+    page = client.get('/').get_data(as_text=True)
+    return [int(count) for count in re.findall(
+        r'<span class="badge">(\d+)</span>', page)]
+
+
+def assertCountsConsistent(catalog):
+    counts = catalog.itemCounts()
+    for stored, actual in counts.values():
+        assert stored == actual
+    assert itemCount(catalog.session) == catalog.session.query(
+        Item).count()
+
+
+def test_moving_an_item_moves_its_count(catalog, login):
+    user_id = catalog.addUser()
+    balls = catalog.addCategory(user_id, 'Balls')
+    bats = catalog.addCategory(user_id, 'Bats')
+    item_id = catalog.addItems(balls, user_id, 3)[0]
+    catalog.addItems(bats, user_id, 1)
+    client = login(user_id)
+    assert sidebarCounts(client) == [3, 1]
+
+    response = client.post(
+        '/categories/%d/item/%d/edit' % (balls, item_id),
+        data={'name': '', 'description': '', 'price': '',
+              'category': str(bats)})
+    assert response.status_code == 302
+    assert catalog.itemCounts() == {balls: (2, 2), bats: (2, 2)}
+    assertCountsConsistent(catalog)
+    assert sidebarCounts(client) == [2, 2]
+
+
+def test_deleting_a_category_deletes_its_items(catalog, login):
+    user_id = catalog.addUser()
+    balls = catalog.addCategory(user_id, 'Balls')
+    bats = catalog.addCategory(user_id, 'Bats')
+    catalog.addItems(balls, user_id, 4)
+    catalog.addItems(bats, user_id, 2)
+    client = login(user_id)
+    client.get('/categories/%d/items/' % balls)  # load some items
+
+    response = client.post('/categories/%d/delete/' % balls)
+    assert response.status_code == 302
+    assert catalog.itemCounts() == {bats: (2, 2)}
+    assert catalog.session.query(Item).filter_by(
+        category_id=balls).count() == 0
+    assertCountsConsistent(catalog)
+    assert sidebarCounts(client) == [2]
+
+
+def test_emptying_a_category(catalog, login):
+    user_id = catalog.addUser()
+    balls = catalog.addCategory(user_id, 'Balls')
+    bats = catalog.addCategory(user_id, 'Bats')
+    catalog.addItems(balls, user_id, 4)
+    catalog.addItems(bats, user_id, 2)
+    client = login(user_id)
+
+    response = client.post('/categories/%d/items/delete/' % balls)
+    assert response.status_code == 302
+    assert catalog.itemCounts() == {balls: (0, 0), bats: (2, 2)}
+    assertCountsConsistent(catalog)
+    assert sidebarCounts(client) == [0, 2]
+    changes = client.get('/api/v2/changes?since=0').get_json()['Changes']
+    assert [c['action'] for c in changes] == ['delete'] * 4
+
+
+def test_only_the_owner_may_empty_a_category(catalog, login):
+    owner_id = catalog.addUser('Owner')
+    balls = catalog.addCategory(owner_id, 'Balls')
+    catalog.addItems(balls, owner_id, 3)
+
+    login(catalog.addUser('Other')).post(
+        '/categories/%d/items/delete/' % balls)
+    assert catalog.itemCounts() == {balls: (3, 3)}
+    assert login(owner_id).post(
+        '/categories/99/items/delete/').status_code == 404
@@ -0,0 +1,49 @@
+"""
+    Tests of the item forms and of the price parsing behind them.
+"""
+import pytest
+from database_setup import Item, parsePrice
+
+
+@pytest.mark.parametrize('text, cents', [
+    ('$1,299.5', 129950), (' 2.50 ', 250), ('0', 0), ('', None),
+    (None, None)])
+def test_parse_price(text, cents):
+    assert parsePrice(text) == cents
+
+
+@pytest.mark.parametrize('value', [
+    '-1', 'cheap', 'NaN', 'Infinity', 2.5, 3, ['1'], {'dollars': 1}])
+def test_parse_price_rejects_other_values(value):
+    with pytest.raises(ValueError):
+        parsePrice(value)
+
+
+@pytest.mark.parametrize('category', ['abc', '9999'])
+def test_new_item_with_tampered_category(catalog, login, category):
+    user_id = catalog.addUser()
+    catalog.addCategory(user_id)
+    response = login(user_id).post('/categories/item/new', data={
+        'name': 'Ball', 'description': '', 'price': '',
+        'category': category})
+    assert response.status_code == 200
+    assert 'Choose one of the categories.' in response.get_data(
+        as_text=True)
+    assert catalog.session.query(Item).count() == 0
+
+
+@pytest.mark.parametrize('category', ['abc', '9999'])
+def test_edit_item_with_tampered_category(catalog, login, category):
+    user_id = catalog.addUser()
+    category_id = catalog.addCategory(user_id)
+    item_id = catalog.addItems(category_id, user_id, 1)[0]
+    response = login(user_id).post(
+        '/categories/%d/item/%d/edit' % (category_id, item_id), data={
+            'name': 'Renamed', 'description': '', 'price': '',
+            'category': category})
+    assert response.status_code == 200
+    assert 'Choose one of the categories.' in response.get_data(
+        as_text=True)
+    catalog.session.expire_all()
+    item = catalog.session.query(Item).get(item_id)
+    assert (item.name, item.category_id) == ('Item 0', category_id)
@@ -0,0 +1,39 @@
+"""
+    Tests of the /metrics endpoint of the request instrumentation.
+"""
+import os
+from flask import Flask
+from sqlalchemy import create_engine
+from instrumentation import instrumentApp
+
+
+def instrumentedClient(metrics_access):
+    app = Flask(__name__)
+
+    @app.route('/')
+    def index():
+        return 'ok'
+    instrumentApp(app, create_engine('sqlite://'),
+                  metrics_access=metrics_access)
+    return app.test_client()
+
+
+def test_metrics_are_served_to_local_clients_only():
+    client = instrumentedClient('local')
+    client.get('/')
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert ('itemcatalog_request_duration_seconds_count'
+            '{pid="%d",endpoint="index"} 1' % os.getpid()
+            in response.get_data(as_text=True))
+    response = client.get('/metrics',
+                          environ_base={'REMOTE_ADDR': '192.0.2.1'})
+    assert response.status_code == 404
+
+
+def test_metrics_access_settings():
+    remote = {'REMOTE_ADDR': '192.0.2.1'}
+    assert instrumentedClient('public').get(
+        '/metrics', environ_base=remote).status_code == 200
+    assert instrumentedClient('off').get('/metrics').status_code == 404
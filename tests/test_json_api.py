@@ -0,0 +1,112 @@
+"""
+    Tests of the conditional responses and the changes feed of the JSON API.
+"""
+from datetime import datetime
+from database_setup import CatalogState, engine, recreateTables
+from queries import compactChanges
+
+
+def setUpdatedAt(catalog, moment):
+    catalog.session.query(CatalogState).update({'updated_at': moment})
+    catalog.session.commit()
+
+
+def test_matching_etag_gets_not_modified(catalog, client):
+    user_id = catalog.addUser()
+    catalog.addItems(catalog.addCategory(user_id), user_id, 3)
+
+    response = client.get('/api/v1/catalog/json')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert response.headers['Last-Modified']
+
+    response = client.get('/api/v1/catalog/json',
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert not response.get_data()
+
+
+def test_write_changes_etag(catalog, login):
+    user_id = catalog.addUser()
+    category_id = catalog.addCategory(user_id)
+    client = login(user_id)
+    etag = client.get('/api/v1/catalog/json').headers['ETag']
+
+    response = client.post('/categories/item/new', data={
+        'name': 'Ball', 'description': '', 'price': '2.50',
+        'category': str(category_id)})
+    assert response.status_code == 302
+    response = client.get('/api/v1/catalog/json',
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_etag_decides_over_if_modified_since(catalog, client):
+    setUpdatedAt(catalog, datetime(2020, 1, 1, 10, 0, 0))
+    response = client.get('/api/v1/catalog/json', headers={
+        'If-None-Match': '"stale"',
+        'If-Modified-Since': 'Wed, 01 Jan 2030 00:00:00 GMT'})
+    assert response.status_code == 200
+
+
+def test_if_modified_since_within_the_changed_second(catalog, client):
+    setUpdatedAt(catalog, datetime(2020, 1, 1, 10, 0, 0, 500000))
+
+    response = client.get('/api/v1/catalog/json', headers={
+        'If-Modified-Since': 'Wed, 01 Jan 2020 10:00:00 GMT'})
+    assert response.status_code == 200
+    last_modified = response.headers['Last-Modified']
+    assert last_modified == 'Wed, 01 Jan 2020 10:00:01 GMT'
+
+    response = client.get('/api/v1/catalog/json', headers={
+        'If-Modified-Since': last_modified})
+    assert response.status_code == 304
+
+
+def test_changes_feed_is_gone_after_compaction(catalog, login):
+    user_id = catalog.addUser()
+    category_id = catalog.addCategory(user_id)
+    client = login(user_id)
+    for name in ('Ball', 'Bat', 'Glove'):
+        client.post('/categories/item/new', data={
+            'name': name, 'description': '', 'price': '',
+            'category': str(category_id)})
+    data = client.get('/api/v2/changes?since=0').get_json()
+    revisions = [change['revision'] for change in data['Changes']]
+    assert len(revisions) == 3
+
+    compactChanges(catalog.session, revisions[1])
+    for since in (0, revisions[0]):
+        response = client.get('/api/v2/changes?since=%d' % since)
+        assert response.status_code == 410
+        assert response.get_json()['revision'] == revisions[2]
+
+    response = client.get('/api/v2/changes?since=%d' % revisions[1])
+    assert response.status_code == 200
+    changes = response.get_json()['Changes']
+    assert [change['revision'] for change in changes] == revisions[2:]
+    assert changes[0]['data']['name'] == 'Glove'
+
+
+def test_recreated_catalog_continues_the_revisions(catalog, login):
+    user_id = catalog.addUser()
+    category_id = catalog.addCategory(user_id)
+    client = login(user_id)
+    client.post('/categories/item/new', data={
+        'name': 'Ball', 'description': '', 'price': '',
+        'category': str(category_id)})
+    response = client.get('/api/v1/catalog/json')
+    etag = response.headers['ETag']
+    since = client.get('/api/v2/changes?since=0').get_json()['revision']
+    catalog.session.remove()
+
+    revision = recreateTables(engine)
+    assert revision == since + 1
+    response = client.get('/api/v1/catalog/json',
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json() == {'Items': []}
+    assert client.get(
+        '/api/v2/changes?since=%d' % since).status_code == 410
@@ -0,0 +1,72 @@
+"""
+    Tests of the maintenance commands of manage.py.
+"""
+import io
+import pytest
+import manage
+from cache import LocalCache, PageCache
+from database_setup import Item
+from queries import catalogRevision
+from snapshots import SnapshotCache
+
+
+@pytest.fixture
+def appSnapshots(monkeypatch):
+    """The snapshots of an app process sharing the page cache of manage.py"""
+    shared = PageCache(LocalCache())
+    monkeypatch.setattr(manage, 'createPageCache', lambda: shared)
+    return SnapshotCache(tags=shared)
+
+
+def generateCatalog(replace=False):
+    manage.main(['generate', '--users', '2', '--categories', '3',
+                 '--items', '20'] + (['--replace'] if replace else []))
+
+
+def test_generate_replace_never_reuses_a_revision(catalog, client):
+    generateCatalog()
+    response = client.get('/api/v1/catalog/json')
+    etag = response.headers['ETag']
+    since = catalogRevision(catalog.session)[0]
+    catalog.session.remove()
+
+    generateCatalog(replace=True)
+    assert catalogRevision(catalog.session)[0] > since
+    assert catalog.session.query(Item).count() == 20
+    response = client.get('/api/v1/catalog/json',
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert client.get(
+        '/api/v2/changes?since=%d' % since).status_code == 410
+
+
+def test_import_reloads_the_categories_of_running_apps(
+        catalog, appSnapshots, tmpdir):
+    user_id = catalog.addUser()
+    catalog.addCategory(user_id, 'Balls')
+    loaded = appSnapshots.categories(catalog.session)
+    path = str(tmpdir.join('items.csv'))
+    with io.open(path, 'w') as f:
+        f.write(u'name,description,price,category\n'
+                u'Ball,,1.00,Balls\nBat,,2.00,Bats\n')
+
+    manage.main(['import', path, '--user-email', 'owner@example.com',
+                 '--create-categories'])
+    categories = appSnapshots.categories(catalog.session)
+    assert [(c.name, c.item_count) for c in categories] == [
+        ('Balls', 1), ('Bats', 1)]
+    assert categories.revision > loaded.revision
+
+
+def test_repair_counts_reloads_the_categories_of_running_apps(
+        catalog, appSnapshots):
+    user_id = catalog.addUser()
+    category_id = catalog.addCategory(user_id)
+    catalog.addItems(category_id, user_id, 2)
+    catalog.session.query(Item).filter_by(category_id=category_id).update(
+        {'category_id': None})
+    catalog.session.commit()
+    assert appSnapshots.categories(catalog.session)[0].item_count == 2
+
+    manage.main(['repair-counts'])
+    assert appSnapshots.categories(catalog.session)[0].item_count == 0
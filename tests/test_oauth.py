@@ -0,0 +1,48 @@
+"""
+    Tests of the login providers against the local provider stub.
+"""
+import pytest
+from oauth import FacebookProvider, GoogleProvider, LoginError
+from oauth import loadProviderSettings
+from oauth_stub import startStubServer
+
+
+@pytest.fixture
+def stub():
+    server = startStubServer('google-client', app_id='facebook-app')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_google_login_uses_the_token_uri(stub, monkeypatch):
+    monkeypatch.delenv('GOOGLE_TOKEN_URL', raising=False)
+    settings = loadProviderSettings()['google']
+    assert settings['token_url'] == (
+        'https://www.googleapis.com/oauth2/v3/token')
+
+    google = GoogleProvider('google-client', 'secret', stub.url, stub.url,
+                            stub.url + '/oauth2/v3/token')
+    profile = google.login('alice')
+    assert profile['email'] == 'stub-alice@example.com'
+    with pytest.raises(LoginError):
+        GoogleProvider('google-client', 'secret', stub.url, stub.url,
+                       stub.url + '/no-token-here').login('alice')
+
+
+def test_facebook_login_checks_the_token_app(stub):
+    facebook = FacebookProvider('facebook-app', 'secret', stub.url)
+    profile = facebook.login('alice')
+    assert (profile['email'], profile['facebook_id']) == (
+        'stub-alice@example.com', 'alice')
+
+    other_app = FacebookProvider('other-app', 'secret', stub.url)
+    with pytest.raises(LoginError):
+        other_app.login('alice')
+
+
+def test_facebook_app_secret_proof():
+    facebook = FacebookProvider('facebook-app', 'secret')
+    # hmac.new(b'secret', b'token', hashlib.sha256).hexdigest()
+    assert facebook.appSecretProof('token') == (
+        'e941110e3d2bfe82621f0e3e1434730d7305d106c5f68c87165d0b27a4611a4a')
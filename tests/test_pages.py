@@ -0,0 +1,91 @@
+"""
+    Tests of the catalog list pages.
+"""
+from snapshots import createSnapshotCache
+
+
+def test_item_list_query_count_does_not_grow_with_items(
+        catalog, login, queries):
+    user_id = catalog.addUser()
+    for name in ('Balls', 'Bats', 'Gloves'):
+        catalog.addItems(catalog.addCategory(user_id, name), user_id, 15)
+    client = login(user_id)
+    client.get('/')  # load the category and user snapshots
+
+    counts = []
+    for limit in (5, 40):
+        del queries[:]
+        response = client.get('/?limit=%d' % limit)
+        assert response.status_code == 200
+        assert response.get_data(as_text=True).count(
+            'class="name"') == limit
+        counts.append(len(queries))
+    assert counts[0] == counts[1]
+
+
+def walk(client, args, direction, cursor=None):
+    """Follow the `next` or `prev` links of /api/v2/items to the end.
+
+    The links only hold the page cursor, which replaces the cursor in the
+    other query string arguments, like the page links of the templates do.
+    """
+    pages = []
+    while cursor is not None:
+        response = client.get('/api/v2/items',
+                              query_string=dict(args, **cursor))
+        assert response.status_code == 200
+        data = response.get_json()
+        pages.append([item['id'] for item in data['Items']])
+        cursor = data[direction]
+    return pages
+
+
+def test_newest_first_pages_cover_every_item_once(catalog, client):
+    user_id = catalog.addUser()
+    ids = catalog.addItems(catalog.addCategory(user_id), user_id, 25)
+    newest_first = sorted(ids, reverse=True)
+
+    pages = walk(client, {'limit': 10}, 'next', {})
+    assert pages == [newest_first[:10], newest_first[10:20],
+                     newest_first[20:]]
+
+    data = client.get('/api/v2/items', query_string={
+        'limit': 10, 'before_id': newest_first[19]}).get_json()
+    assert [item['id'] for item in data['Items']] == newest_first[20:]
+    assert data['next'] is None
+    back = walk(client, {'limit': 10}, 'prev', data['prev'])
+    assert back == [newest_first[10:20], newest_first[:10]]
+
+
+def test_cheapest_first_pages_break_price_ties_by_id(catalog, client):
+    user_id = catalog.addUser()
+    category_id = catalog.addCategory(user_id)
+    cheap = catalog.addItems(category_id, user_id, 7, price_cents=100)
+    dear = catalog.addItems(category_id, user_id, 5, price_cents=200)
+
+    pages = walk(client, {'sort': 'price', 'limit': 4}, 'next', {})
+    assert [len(page) for page in pages] == [4, 4, 4]
+    assert sum(pages, []) == sorted(cheap) + sorted(dear)
+
+    last = client.get('/api/v2/items', query_string={
+        'sort': 'price', 'limit': 4, 'after_price': 200,
+        'after_id': pages[1][-1]}).get_json()
+    assert [item['id'] for item in last['Items']] == pages[2]
+    back = walk(client, {'sort': 'price', 'limit': 4}, 'prev', last['prev'])
+    assert back == [pages[1], pages[0]]
+
+
+def test_category_list_is_keyed_on_the_catalog_revision(catalog, login):
+    user_id = catalog.addUser()
+    category_id = catalog.addCategory(user_id)
+    first, second = createSnapshotCache(), createSnapshotCache()
+    loaded = first.categories(catalog.session)
+    assert second.categories(catalog.session).revision == loaded.revision
+
+    login(user_id).post('/categories/item/new', data={
+        'name': 'Ball', 'description': '', 'price': '',
+        'category': str(category_id)})
+    first.invalidateCategories()
+    reloaded = first.categories(catalog.session)
+    assert reloaded.revision > loaded.revision
+    assert reloaded[0].item_count == 1
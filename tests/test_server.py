@@ -0,0 +1,46 @@
+"""
+    Tests of the checks keeping several server.py workers consistent.
+"""
+import pytest
+from cache import LocalCache, PageCache
+from server import sharedStateProblems
+from snapshots import SnapshotCache
+
+
+@pytest.fixture
+def environment(monkeypatch):
+    for name in ('PAGE_CACHE_URL', 'SESSION_STORE', 'LOGIN_WORKERS'):
+        monkeypatch.delenv(name, raising=False)
+    return monkeypatch
+
+
+def test_one_worker_needs_nothing_shared(environment):
+    environment.setenv('SESSION_STORE', 'memory')
+    environment.setenv('LOGIN_WORKERS', '4')
+    assert sharedStateProblems(1) == []
+
+
+def test_several_workers_need_shared_state(environment):
+    assert len(sharedStateProblems(4)) == 1
+    assert sharedStateProblems(4, unshared_caches=True) == []
+
+    environment.setenv('PAGE_CACHE_URL', 'redis://localhost:6379/0')
+    assert sharedStateProblems(4) == []
+    environment.setenv('SESSION_STORE', 'memory')
+    environment.setenv('LOGIN_WORKERS', '4')
+    assert len(sharedStateProblems(4)) == 2
+
+
+def test_snapshots_are_invalidated_through_the_shared_cache(catalog):
+    user_id = catalog.addUser()
+    catalog.addCategory(user_id, 'Balls')
+    shared = PageCache(LocalCache())
+    first, second = SnapshotCache(tags=shared), SnapshotCache(tags=shared)
+    assert [c.name for c in second.categories(catalog.session)] == [
+        'Balls']
+
+    catalog.addCategory(user_id, 'Bats')
+    first.invalidateCategories()
+    assert [c.name for c in second.categories(catalog.session)] == [
+        'Balls', 'Bats']
+    assert second.user(catalog.session, user_id).name == 'Owner'
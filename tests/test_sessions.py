@@ -0,0 +1,53 @@
+"""
+    Tests of the server-side login sessions.
+"""
+import re
+import application
+
+
+class FakeFacebook(object):
+    """A Facebook provider vouching for every token"""
+
+    app_id = 'facebook-app'
+
+    def login(self, access_token):
+        return {'provider': 'facebook', 'username': 'Alice',
+                'email': 'alice@example.com', 'picture': None,
+                'access_token': access_token, 'facebook_id': 'alice'}
+
+    def revoke(self, facebook_id, access_token):
+        pass
+
+
+def sessionId(client):
+    """Return the session id in the cookie of a test client"""
+    for cookie in client.cookie_jar:
+        if cookie.name == application.app.session_cookie_name:
+            return cookie.value
+    return None
+
+
+def test_login_and_logout_issue_new_session_ids(catalog, client,
+                                                monkeypatch):
+    monkeypatch.setattr(application, 'providers', {
+        'google': application.providers['google'],
+        'facebook': FakeFacebook()})
+    page = client.get('/login').get_data(as_text=True)
+    state = re.search(r'state=([A-Z0-9]{32})', page).group(1)
+    planted = sessionId(client)
+    assert planted is not None
+
+    response = client.post('/fbconnect?state=%s' % state, data='token')
+    assert response.status_code == 200
+    logged_in = sessionId(client)
+    assert logged_in not in (None, planted)
+    with client.session_transaction() as session:
+        assert session['email'] == 'alice@example.com'
+
+    # The id from before the login names no session any more
+    store = application.app.session_interface.store
+    assert store.load(planted) is None
+
+    client.get('/disconnect')
+    assert sessionId(client) != logged_in
+    assert store.load(logged_in) is None